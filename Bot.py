@@ -1,10 +1,13 @@
 import asyncio
+import io
 import json
 import os
 import platform
 import random
 import sys
+import time
 import traceback
+from concurrent.futures import ProcessPoolExecutor
 
 import discord
 from aiohttp import web
@@ -13,16 +16,73 @@ from discord.ext.commands import AutoShardedBot
 
 from discord.ext.commands import Context
 
+from address_book import AddressBook
+from cache import UserAssetCache, UserSessionCache
 from config import load_config
+from database import Database
+from deposit_queue import DepositQueue
+from gas_oracle import GasOracle
+from leader import JOBS, LeaderElection
+from loop_monitor import LoopMonitor
+from metrics import Registry, instrument_loops
+from message_buffer import MessageBuffer
+from notifier import Notifier
+from profiler import SamplingProfiler
+from rpc import RPCPool
+from search_index import AutocompleteIndex
+from settings import BotSettings
+from withdraw import WithdrawEngine
 
 intents = discord.Intents.default()
 intents.members = True
 intents.presences = True
 
-bot = AutoShardedBot(command_prefix=commands.when_mentioned, intents=intents, owner_ids=load_config()['discord']['owner_ids'], help_command=None)
+# set by launcher.py when the shards are split across processes, unset this process runs them all
+cluster = {}
+if os.environ.get("NFTBOT_SHARD_IDS"):
+    cluster = {
+        'shard_ids': [int(shard_id) for shard_id in os.environ["NFTBOT_SHARD_IDS"].split(",")],
+        'shard_count': int(os.environ["NFTBOT_SHARD_COUNT"])
+    }
+bot = AutoShardedBot(command_prefix=commands.when_mentioned, intents=intents, owner_ids=load_config()['discord']['owner_ids'], help_command=None, **cluster)
+bot.cluster_id = int(os.environ.get("NFTBOT_CLUSTER_ID", 0))
+bot.cluster_count = int(os.environ.get("NFTBOT_CLUSTER_COUNT", 1))
 
 bot.config = load_config()
-bot.setting = None
+bot.db = Database(bot.config)
+bot.asset_cache = UserAssetCache(
+    maxsize=bot.config.get('cache', {}).get('user_assets_maxsize', 4096),
+    ttl=bot.config.get('cache', {}).get('user_assets_ttl', 300.0)
+)
+bot.user_cache = UserSessionCache(
+    maxsize=bot.config.get('cache', {}).get('user_session_maxsize', 8192),
+    ttl=bot.config.get('cache', {}).get('user_session_ttl', 30.0)
+)
+# served on /metrics by the verify webserver
+bot.metrics = Registry()
+# event loop lag and what blocks it
+bot.loop_monitor = LoopMonitor(bot)
+# owner `profile` command
+bot.profiler = SamplingProfiler()
+bot.search_index = AutocompleteIndex()
+bot.deposit_queue = DepositQueue()
+bot.address_book = AddressBook()
+# DMs and log channel messages, sent in the background
+bot.notifier = Notifier(
+    bot,
+    workers=bot.config.get('notify', {}).get('workers', 4),
+    maxsize=bot.config.get('notify', {}).get('maxsize', 10000),
+    max_attempts=bot.config.get('notify', {}).get('max_attempts', 5)
+)
+# one keep-alive JSON-RPC client per endpoint, shared by every cog
+bot.rpc = RPCPool(bot.config)
+# background jobs this process owns when several processes share the shards
+bot.leader = LeaderElection(bot.config, required=bot.cluster_count > 1)
+bot.gas_oracle = GasOracle(bot)
+# CPU heavy work like /metagen rarity runs here instead of blocking the event loop
+bot.rarity_pool = ProcessPoolExecutor(max_workers=bot.config['rarity'].get('process_workers', 1))
+# decoded `bot_settings`, commands read it without a query
+bot.settings = BotSettings()
 bot.server_bot = "DISCORD"
 bot.first_message = f"""
 Hello, it looks like it's your first time interact with our NFT Bot. 
@@ -47,8 +107,12 @@ Invite link: <{bot.config['discord']['invite_link']}>
 Brought to you by Art101.
 """
 bot.bot_setting = None
-# messages
-bot.message_list = []
+# guild messages waiting for `discord_messages`
+bot.message_buffer = MessageBuffer(
+    maxsize=bot.config.get('message', {}).get('maxsize', 20000),
+    seen_size=bot.config.get('message', {}).get('seen_size', 50000),
+    batch_size=bot.config.get('message', {}).get('batch_size', 500)
+)
 
 bot.HELP_MESSAGE = ""
 # https://www.smartcontracttoolkit.com/abi
@@ -58,6 +122,46 @@ with open('./erc1155.json', 'r') as f:
     bot.ERC1155_ABI = json.load(f)
 with open('./erc20.json', 'r') as f:
     bot.ERC20_ABI = json.load(f)
+bot.withdraw = WithdrawEngine(bot)
+
+
+def collect_metrics():
+    """ Gauges and histograms read from the stats the pools and queues keep, for `bot.metrics`. """
+    db_stats = bot.db.stats()
+    rpc_stats = bot.rpc.stats()
+    rpc_hosts = [stats['url'].split('/')[2] for stats in rpc_stats]
+    return [
+        ("nftbot_gateway_latency_seconds", "gauge", "Discord gateway heartbeat latency per shard",
+         [({"shard": shard_id}, latency) for shard_id, latency in bot.latencies]),
+        ("nftbot_leader", "gauge", "1 for the background jobs this process runs",
+         [({"job": job}, 1 if bot.leader.is_leader(job) else 0) for job in JOBS]),
+        ("nftbot_db_pool_connections", "gauge", "Database pool connections",
+         [({"state": "in_use"}, db_stats['in_use']), ({"state": "free"}, db_stats['free']),
+          ({"state": "max"}, db_stats['maxsize'])]),
+        ("nftbot_db_pool_wait_seconds", "histogram", "Wait for a free database connection",
+         [({}, bot.db.wait_time.snapshot())]),
+        ("nftbot_rpc_seconds", "histogram", "JSON-RPC request duration, retries included",
+         [({"host": host, "method": method}, latency)
+          for host, stats in zip(rpc_hosts, rpc_stats) for method, latency in stats['methods'].items()]),
+        ("nftbot_rpc_requests_total", "counter", "JSON-RPC requests sent",
+         [({"host": host}, stats['requests']) for host, stats in zip(rpc_hosts, rpc_stats)]),
+        ("nftbot_rpc_errors_total", "counter", "JSON-RPC requests or calls that failed",
+         [({"host": host}, stats['errors']) for host, stats in zip(rpc_hosts, rpc_stats)]),
+        ("nftbot_rpc_in_flight", "gauge", "JSON-RPC requests in flight",
+         [({"host": host}, stats['in_flight']) for host, stats in zip(rpc_hosts, rpc_stats)]),
+        ("nftbot_loop_lag_seconds", "histogram", "How late the event loop runs a sleep that just ended",
+         [({}, bot.loop_monitor.lag.snapshot())]),
+        ("nftbot_withdraw_sign_seconds", "histogram", "Withdraw transaction signing duration",
+         [({}, bot.withdraw.sign_latency.snapshot())]),
+        ("nftbot_queue_depth", "gauge", "Items waiting in the in-process queues",
+         [({"queue": "notifier"}, bot.notifier.queued),
+          ({"queue": "deposits"}, bot.deposit_queue.stats()['waiting']),
+          ({"queue": "messages"}, len(bot.message_buffer)),
+          ({"queue": "command_counts"}, bot.user_cache.stats()['pending_commands'])]),
+    ]
+
+
+bot.metrics.collector(collect_metrics)
 
 
 @bot.event
@@ -83,8 +187,13 @@ async def on_ready() -> None:
                 await channel.send(msg)
     except Exception:
         traceback.print_exc(file=sys.stdout)
+    # loops are copied per cog instance once loaded, time their iterations from here on
+    instrument_loops(bot)
+    bot.loop_monitor.start()
     status_task.start()
-    await bot.tree.sync()
+    # the command tree is the same everywhere, one sync is enough
+    if bot.cluster_id == 0:
+        await bot.tree.sync()
 
 
 @tasks.loop(minutes=2.0)
@@ -126,6 +235,14 @@ async def on_command_completion(context: Context) -> None:
         print(f"Executed {executed_command} command by {context.author} (ID: {context.author.id}) in DMs")
 
 
+@bot.event
+async def on_app_command_completion(interaction: discord.Interaction, command) -> None:
+    # from Discord creating the interaction, what the user waited
+    bot.metrics.histogram(
+        "nftbot_command_seconds", "Slash command duration", command=command.qualified_name
+    ).observe((discord.utils.utcnow() - interaction.created_at).total_seconds())
+
+
 @bot.command(usage="reconfig")
 @commands.is_owner()
 async def reconfig(ctx):
@@ -173,6 +290,137 @@ async def reload(ctx, extension):
         traceback.print_exc(file=sys.stdout)
 
 
+@bot.command(usage="dbstats")
+@commands.is_owner()
+async def dbstats(ctx):
+    """Show database pool usage"""
+    try:
+        stats = bot.db.stats()
+        await ctx.send(
+            f"{ctx.author.mention}, pool size `{stats['size']}/{stats['maxsize']}` free `{stats['free']}` "
+            f"in use `{stats['in_use']}` (max `{stats['max_in_use']}`, utilisation `{stats['utilisation']:.0%}`).\n"
+            f"Acquired `{stats['acquired']:,}` connections, wait avg `{stats['wait_avg'] * 1000:.2f}ms` "
+            f"max `{stats['wait_max'] * 1000:.2f}ms`."
+        )
+    except Exception as e:
+        traceback.print_exc(file=sys.stdout)
+
+
+@bot.command(usage="rpcstats")
+@commands.is_owner()
+async def rpcstats(ctx):
+    """Show JSON-RPC client, withdraw and notification counters"""
+    try:
+        lines = []
+        for stats in bot.rpc.stats():
+            lines.append(
+                f"`{stats['url'].split('/')[2]}` requests `{stats['requests']:,}` retried `{stats['retried']:,}` "
+                f"errors `{stats['errors']:,}` in flight `{stats['in_flight']}`"
+            )
+            for method, latency in stats['methods'].items():
+                lines.append(
+                    f"> {method}: `{latency['count']:,}` avg `{latency['avg'] * 1000:.1f}ms` "
+                    f"max `{latency['max'] * 1000:.1f}ms`"
+                )
+        if len(lines) == 0:
+            lines.append("no JSON-RPC request yet.")
+        withdraw_stats = bot.withdraw.stats()
+        lines.append(
+            f"Withdraw sent `{withdraw_stats['sent']:,}` failed `{withdraw_stats['failed']:,}`, "
+            f"rebroadcasted `{withdraw_stats['rebroadcasted']:,}` nonce gaps filled `{withdraw_stats['gaps_filled']:,}`, signing avg `{withdraw_stats['sign']['avg'] * 1000:.1f}ms`, "
+            f"next nonces `{withdraw_stats['nonces']['next_nonce']}` reserved `{withdraw_stats['nonces']['reserved']:,}` "
+            f"released `{withdraw_stats['nonces']['released']:,}`."
+        )
+        gas_stats = bot.gas_oracle.stats()
+        lines.append(
+            f"Gas oracle samples `{gas_stats['samples']}` used `{gas_stats['hits']:,}` "
+            f"stale `{gas_stats['misses']:,}` errors `{gas_stats['errors']:,}`."
+        )
+        notify_stats = bot.notifier.stats()
+        lines.append(
+            f"Notifications queued `{notify_stats['queued']:,}` for `{notify_stats['targets']:,}` targets "
+            f"(rate limited `{notify_stats['paused']}`), sent `{notify_stats['sent']:,}` "
+            f"coalesced `{notify_stats['coalesced']:,}` failed `{notify_stats['failed']:,}` "
+            f"retrying later `{notify_stats['persisted']:,}` dropped `{notify_stats['dropped']:,}`."
+        )
+        await ctx.send(f"{ctx.author.mention}, " + "\n".join(lines)[:1900])
+    except Exception as e:
+        traceback.print_exc(file=sys.stdout)
+
+
+@bot.command(usage="cachestats")
+@commands.is_owner()
+async def cachestats(ctx):
+    """Show cache, settings and message buffer counters"""
+    try:
+        stats = bot.asset_cache.stats()
+        user_stats = bot.user_cache.stats()
+        address_stats = bot.address_book.stats()
+        settings_stats = bot.settings.stats()
+        message_stats = bot.message_buffer.stats()
+        await ctx.send(
+            f"{ctx.author.mention}, user assets cache `{stats['size']}/{stats['maxsize']}` users, "
+            f"hits `{stats['hits']:,}` misses `{stats['misses']:,}` (hit ratio `{stats['hit_ratio']:.1%}`), "
+            f"invalidations `{stats['invalidations']:,}`.\n"
+            f"User sessions cache `{user_stats['size']}/{user_stats['maxsize']}` users, "
+            f"hits `{user_stats['hits']:,}` misses `{user_stats['misses']:,}` (hit ratio `{user_stats['hit_ratio']:.1%}`), "
+            f"pending command counts `{user_stats['pending_commands']:,}`, flushed `{user_stats['flushed']:,}`.\n"
+            f"Address book `{address_stats['size']:,}` verified addresses, lookups `{address_stats['lookups']:,}` "
+            f"unknown senders `{address_stats['misses']:,}` reloads `{address_stats['reloads']:,}`.\n"
+            f"Settings version `{settings_stats['version']}` reloads `{settings_stats['reloads']:,}`.\n"
+            f"Message buffer `{message_stats['waiting']:,}/{message_stats['maxsize']:,}` waiting, "
+            f"written `{message_stats['written']:,}` dropped `{message_stats['dropped']:,}` "
+            f"failed flushes `{message_stats['failures']:,}`, last flush `{message_stats['last_flush']:.0f}s` ago."
+        )
+    except Exception as e:
+        traceback.print_exc(file=sys.stdout)
+
+
+@bot.command(usage="profile <seconds> [cog]")
+@commands.is_owner()
+async def profile(ctx, seconds: int = 30, cog: str = None):
+    """Profile this process for some seconds, upload the collapsed stacks to the log channel"""
+    try:
+        profiler_config = bot.config.get('profiler', {})
+        seconds = max(1, min(seconds, profiler_config.get('max_seconds', 300)))
+        filename = None
+        if cog is not None:
+            # the cog's tasks are the stacks going through its module
+            found = next((each for name, each in bot.cogs.items() if name.lower() == cog.lower()), None)
+            if found is None:
+                await ctx.send(f"{ctx.author.mention}, there is no loaded cog `{cog}`.")
+                return
+            cog = found.qualified_name
+            filename = sys.modules[type(found).__module__].__file__
+        if bot.profiler.running:
+            await ctx.send(f"{ctx.author.mention}, a profile is already running.")
+            return
+        await ctx.send(f"{ctx.author.mention}, profiling `{cog or 'everything'}` for `{seconds}s`.")
+        collapsed, samples, kept = await bot.profiler.run(
+            seconds, profiler_config.get('interval', 0.005), filename
+        )
+        if kept == 0:
+            await ctx.send(f"{ctx.author.mention}, no sample of `{cog or 'everything'}` out of `{samples:,}`.")
+            return
+        top = "\n".join(
+            f"> `{leaf}` {count / kept:.1%}" for leaf, count in bot.profiler.top(collapsed)
+        )
+        msg = f"Profile of `{cog or 'everything'}` for `{seconds}s`, `{kept:,}/{samples:,}` samples, most sampled:\n{top}"
+        channel = bot.get_channel(bot.config['discord']['log_channel']) or \
+            bot.get_channel(bot.config['discord']['log_channel_backup'])
+        if channel is None:
+            await ctx.send(f"{ctx.author.mention}, log channel not found.")
+            return
+        await channel.send(msg[:1900], file=discord.File(
+            io.BytesIO(collapsed.encode()), filename="profile-{}-{}.folded".format(
+                (cog or "all").lower(), int(time.time())
+            )
+        ))
+        await ctx.send(f"{ctx.author.mention}, profile uploaded to {channel.mention}.")
+    except Exception as e:
+        traceback.print_exc(file=sys.stdout)
+
+
 @bot.event
 async def on_command_error(context: Context, error) -> None:
     """
@@ -230,6 +478,9 @@ async def webserver():
     async def handler_get(request):
         return web.Response(text="Hello, world")
 
+    async def handler_metrics(request):
+        return web.Response(text=bot.metrics.render(), content_type="text/plain", charset="utf-8")
+
     async def handler_post(request):
         try:
             if request.body_exists:
@@ -239,44 +490,64 @@ async def webserver():
                 address = full_payload['address']
                 user_server = full_payload['user_server']
                 if str(request.rel_url).startswith("/verify_discord/"):
+                    # the payload is only a hint, deposits are attributed from what `metamask_v1` has
+                    utils = bot.get_cog('Utils')
+                    owner = await utils.get_verified_address_owner(address) if utils else None
+                    if owner is None or (str(owner[0]), owner[1]) != (str(user_id), user_server):
+                        return web.Response(text="Not verified!")
+                    bot.address_book.set(address, user_id, user_server)
                     if user_id.isdigit() and user_server == bot.server_bot:
                         found_user = bot.get_user(int(user_id))
+                        if found_user is None and bot.cluster_count > 1:
+                            # only the first process gets the webhook, the user may be on another one's shards
+                            try:
+                                found_user = await bot.fetch_user(int(user_id))
+                            except discord.NotFound:
+                                pass
                         if found_user:
                             msg = f"You verified your account with address: `{address}`. " \
                                   f"Please only deposit gas or supported NFT from this address!"
-                            try:
-                                await found_user.send(msg)
-                                return web.Response(text="Thank you!")
-                            except Exception:
-                                traceback.print_exc(file=sys.stdout)
-                            channel = bot.get_channel(bot.config['discord']['log_channel'])
-                            if channel:
-                                await channel.send(f"[DISCORD], User {str(found_user.id)} verified address: `{address}`.")
-                            else:
-                                channel = bot.get_channel(bot.config['discord']['log_channel_backup'])
-                                if channel:
-                                    await channel.send(f"[DISCORD], User {str(found_user.id)} verified address: `{address}`.")
+                            bot.notifier.dm(found_user.id, msg)
+                            return web.Response(text="Thank you!")
                         return web.Response(text="Not found!")
         except Exception:
             traceback.print_exc(file=sys.stdout)
     app = web.Application()
+    app.router.add_get('/metrics', handler_metrics)
     app.router.add_get('/{tail:.*}', handler_get)
     app.router.add_post('/{tail:.*}', handler_post)
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, '127.0.0.1', bot.config['discord']['verify_bind_port'])
+    # each cluster process serves /metrics on its own port, the first one also gets the webhook
+    site = web.TCPSite(runner, '127.0.0.1', bot.config['discord']['verify_bind_port'] + bot.cluster_id)
     await bot.wait_until_ready()
     await site.start()
 
 
 def reload_config():
     bot.config = load_config()
+    bot.rpc.config = bot.config
+    bot.leader.config = bot.config
 
 
 async def main():
     async with bot:
+        await bot.db.open()
         bot.loop.create_task(webserver())
-        await bot.start(bot.config['discord']['token'])
+        try:
+            await bot.start(bot.config['discord']['token'])
+        finally:
+            bot.loop_monitor.stop()
+            utils = bot.get_cog('Utils')
+            if utils is not None:
+                await utils.flush_user_commands()
+            # unsent notifications are kept in `nft_notify_retry`
+            await bot.notifier.close()
+            # frees the jobs for another process right away
+            await bot.leader.close()
+            await bot.db.close()
+            await bot.rpc.close()
+            bot.rarity_pool.shutdown(wait=False, cancel_futures=True)
 
 
 asyncio.run(load_cogs())
@@ -0,0 +1,58 @@
+import time
+
+
+class AddressBook:
+    """
+    Verified (signed) `metamask_v1` addresses, lowercase address => (discord_id, user_server), kept as `bot.address_book`.
+    Deposits are attributed with it instead of joining `metamask_v1` on every crediting query.
+    Loaded in full by `Utils.reload_address_book`, then kept current by `Utils.verification_update` and the
+    `/verify_discord/` webhook. Another cluster process may get those, so a miss reloads it (`reload_due`).
+    """
+
+    def __init__(self):
+        self.owners = {}
+        self.loaded = False
+        self.loaded_at = 0.0
+        self.reloads = 0
+        self.lookups = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.owners)
+
+    def __contains__(self, address) -> bool:
+        return bool(address) and address.lower() in self.owners
+
+    def load(self, rows) -> None:
+        """ Replace everything with `metamask_v1` rows having address, discord_id and user_server. """
+        self.owners = {
+            each['address'].lower(): (each['discord_id'], each['user_server'])
+            for each in rows if each['address'] and each['discord_id']
+        }
+        self.loaded = True
+        self.loaded_at = time.monotonic()
+        self.reloads += 1
+
+    def set(self, address: str, user_id: str, user_server: str) -> None:
+        self.owners[address.lower()] = (user_id, user_server)
+
+    def get(self, address: str):
+        """ (discord_id, user_server) of a verified address, None if nobody verified it. """
+        self.lookups += 1
+        owner = self.owners.get(address.lower()) if address else None
+        if owner is None:
+            self.misses += 1
+        return owner
+
+    def reload_due(self, min_interval: float) -> bool:
+        """ Whether it was loaded over `min_interval` seconds ago, so a miss can reload it. """
+        return time.monotonic() - self.loaded_at >= min_interval
+
+    def stats(self):
+        return {
+            "size": len(self.owners),
+            "loaded": self.loaded,
+            "reloads": self.reloads,
+            "lookups": self.lookups,
+            "misses": self.misses
+        }
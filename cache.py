@@ -0,0 +1,160 @@
+import time
+from collections import OrderedDict
+
+from cachetools import TTLCache
+
+
+class Invalidations:
+    """
+    Sequence number of each key's last invalidation, so a query started before it (`current()` taken at the start)
+    can't store stale rows afterwards. Only the last `window` seconds are kept, no query runs that long, so it
+    doesn't grow with every user ever invalidated.
+    """
+
+    def __init__(self, window: float = 120.0):
+        self.window = window
+        self.sequence = 0
+        self.recent = OrderedDict()  # key => (sequence, time.monotonic()), oldest first
+
+    def current(self) -> int:
+        return self.sequence
+
+    def bump(self, key) -> None:
+        self.sequence += 1
+        now = time.monotonic()
+        self.recent.pop(key, None)
+        self.recent[key] = (self.sequence, now)
+        while self.recent:
+            _, at = next(iter(self.recent.values()))
+            if now - at < self.window:
+                break
+            self.recent.popitem(last=False)
+
+    def since(self, key, started: int) -> bool:
+        """ Whether `key` was invalidated after `started`. """
+        last = self.recent.get(key)
+        return last is not None and last[0] > started
+
+    def __len__(self):
+        return len(self.recent)
+
+
+class UserAssetCache:
+    """
+    Per-user list of owned assets (rows of `Utils.get_list_user_assets`) keyed by (user_id, user_server).
+    Entries expire after `ttl` seconds and the least recently used ones are evicted above `maxsize`.
+    Every write to `nft_credit` must call `invalidate()` for the users it touched. That only reaches this
+    process: with a cluster, the others keep serving what they cached for up to `ttl`, which is why moving an NFT
+    reads with `fresh=True`.
+    """
+
+    def __init__(self, maxsize: int = 4096, ttl: float = 300.0):
+        self.entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        # a query started before a write can't store stale rows afterwards
+        self.invalidated = Invalidations()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, user_id: str, user_server: str):
+        key = (user_id, user_server)
+        rows = self.entries.get(key)
+        if rows is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return rows
+
+    def generation(self, user_id: str, user_server: str) -> int:
+        return self.invalidated.current()
+
+    def put(self, user_id: str, user_server: str, rows, generation: int) -> None:
+        key = (user_id, user_server)
+        if self.invalidated.since(key, generation):
+            return
+        self.entries[key] = rows
+
+    def invalidate(self, user_id: str, user_server: str) -> None:
+        key = (user_id, user_server)
+        self.invalidated.bump(key)
+        self.entries.pop(key, None)
+        self.invalidations += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "maxsize": self.entries.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations
+        }
+
+
+class UserSessionCache:
+    """
+    `tbl_users` rows keyed by (user_id, user_server) for the per-command user lookup, kept for a short `ttl`.
+    Also holds the `command_called` increments not yet written; `Utils.flush_user_commands` writes them in one batch.
+    Every write to `tbl_users` must call `invalidate()` for the users it touched. That only reaches this
+    process: with a cluster, the others may show a row up to `ttl` old.
+    """
+
+    def __init__(self, maxsize: int = 8192, ttl: float = 30.0):
+        self.entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.invalidated = Invalidations()
+        self.pending_commands = {}  # (user_id, user_server) => command_called not yet written
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.flushed = 0
+
+    def get(self, user_id: str, user_server: str):
+        row = self.entries.get((user_id, user_server))
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row
+
+    def generation(self, user_id: str, user_server: str) -> int:
+        return self.invalidated.current()
+
+    def put(self, user_id: str, user_server: str, row: dict, generation: int) -> None:
+        key = (user_id, user_server)
+        if self.invalidated.since(key, generation):
+            return
+        self.entries[key] = row
+
+    def invalidate(self, user_id: str, user_server: str) -> None:
+        key = (user_id, user_server)
+        self.invalidated.bump(key)
+        self.entries.pop(key, None)
+        self.invalidations += 1
+
+    def count_command(self, user_id: str, user_server: str) -> None:
+        key = (user_id, user_server)
+        self.pending_commands[key] = self.pending_commands.get(key, 0) + 1
+
+    def take_pending(self):
+        """ Hand the pending increments to the writer; give them back with `restore_pending` if it fails. """
+        pending = self.pending_commands
+        self.pending_commands = {}
+        return pending
+
+    def restore_pending(self, pending: dict) -> None:
+        for key, count in pending.items():
+            self.pending_commands[key] = self.pending_commands.get(key, 0) + count
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "maxsize": self.entries.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "pending_commands": sum(self.pending_commands.values()),
+            "flushed": self.flushed
+        }
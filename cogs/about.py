@@ -37,22 +37,33 @@ class About(commands.Cog):
     async def about_embed(self, requested_by):
         description = ""
         try:
-            guilds = '{:,.0f}'.format(len(self.bot.guilds))
-            total_members = '{:,.0f}'.format(sum(1 for m in self.bot.get_all_members()))
-            total_unique = '{:,.0f}'.format(len(self.bot.users))
-            total_bots = '{:,.0f}'.format(sum(1 for m in self.bot.get_all_members() if m.bot is True))
-            total_online = '{:,.0f}'.format(sum(1 for m in self.bot.get_all_members() if
-                                                m.status != discord.Status.offline))
+            if self.bot.cluster_count > 1:
+                # each process only sees its own shards, they all report to `nft_cluster_stats`
+                stats = await self.utils.get_cluster_stats()
+                guilds = '{:,.0f}'.format(sum(each['guilds'] for each in stats))
+                total_members = '{:,.0f}'.format(sum(each['members'] for each in stats))
+                total_unique = '{:,.0f}'.format(sum(each['unique_users'] for each in stats))
+                total_bots = '{:,.0f}'.format(sum(each['bots'] for each in stats))
+                total_online = '{:,.0f}'.format(sum(each['online'] for each in stats))
+            else:
+                guilds = '{:,.0f}'.format(len(self.bot.guilds))
+                total_members = '{:,.0f}'.format(sum(1 for m in self.bot.get_all_members()))
+                total_unique = '{:,.0f}'.format(len(self.bot.users))
+                total_bots = '{:,.0f}'.format(sum(1 for m in self.bot.get_all_members() if m.bot is True))
+                total_online = '{:,.0f}'.format(sum(1 for m in self.bot.get_all_members() if
+                                                    m.status != discord.Status.offline))
 
             description = "Total guild(s): `{}` Total member(s): `{}`\n" \
                 "Unique: `{}` Bots: `{}`\n" \
                 "Online: `{}`\n\n".format(guilds, total_members, total_unique, total_bots, total_online)
+            if self.bot.cluster_count > 1:
+                description += "Processes reporting: `{}/{}`\n\n".format(len(stats), self.bot.cluster_count)
         except Exception:
             traceback.print_exc(file=sys.stdout)
         botdetails = discord.Embed(title='About Me', description=description, timestamp=datetime.now())
         try:
-            eth_gas = await eth_wallet_getbalance(self.bot.config['endpoint']['ethereum'], self.bot.config['wallet']['eth_address'], None, True)
-            matic_gas = await eth_wallet_getbalance(self.bot.config['endpoint']['polygon'], self.bot.config['wallet']['eth_address'], None, True) 
+            eth_gas = await eth_wallet_getbalance(self.bot.rpc.network('ethereum'), self.bot.config['wallet']['eth_address'], None, True)
+            matic_gas = await eth_wallet_getbalance(self.bot.rpc.network('polygon'), self.bot.config['wallet']['eth_address'], None, True) 
 
             if eth_gas > 0 or matic_gas > 0:
                 botdetails.add_field(name="Bot's Gas",
@@ -1,20 +1,18 @@
+import asyncio
 import sys
 import traceback
-from datetime import datetime
-import os
 import re
 import discord
 from discord import app_commands
 from discord.ext import commands
 import time
-import json
-import ujson
-import subprocess
 import functools
+import uuid
 from typing import List
 
 from cogs.utils import Utils
 from cogs.alchemy_api import check_contract_alchemy
+from rarity import compute_rarity, rarity_cursor, update_rarity
 
 class Admin(commands.Cog):
 
@@ -95,6 +93,127 @@ class Admin(commands.Cog):
             except Exception as e:
                 traceback.print_exc(file=sys.stdout)
 
+    async def get_rarity_items(self, contract: str, from_item_id: int = 0):
+        """ (item_id, asset_id_hex, meta) of a contract's items after `from_item_id`, read a page at a time. """
+        page = self.bot.config['rarity'].get('read_chunk', 5000)
+        items = []
+        while True:
+            rows = await self.utils.get_nft_items_by_contract(contract, from_item_id, page)
+            items.extend((each['item_id'], each['asset_id_hex'], each['meta']) for each in rows)
+            if len(rows) < page:
+                return items
+            from_item_id = rows[-1]['item_id']
+
+    async def generate_rarity(self, contract_id: str, full: bool = False, progress=None) -> str:
+        """
+        Rarity of a contract's items from their meta, the outcome as a message. Run by `/metagen` or, with
+        `jobs.enable`, by worker.py; `progress` is an async callback taking a short status.
+        """
+        async def report(status: str):
+            if progress is not None:
+                await progress(status)
+
+        get_contract = await self.utils.get_contract_by_id(contract_id)
+        if get_contract is None:
+            return f"the Contract `{contract_id}` was not found."
+        elif get_contract and get_contract['enable_rarity'] == 0:
+            return f"the Contract `{contract_id}` not enable with rarity."
+        contract_id = get_contract['contract_id'] # replace id
+        contract = get_contract['contract']
+        collection_name = get_contract['collection_name']
+
+        get_rarity_contract = await self.utils.get_nft_rarity_contract_id(contract_id)
+        if get_rarity_contract and int(time.time()) - 600 < get_rarity_contract['update_date']:
+            return f"the Contract `{contract}` was just recently updated."
+        if full is False and get_rarity_contract and get_rarity_contract['last_item_id'] > 0:
+            # fold only the items added since the last run
+            items = await self.get_rarity_items(contract, get_rarity_contract['last_item_id'])
+            if len(items) == 0:
+                return f"the Contract `{contract}` has no new items since last run."
+            await report(f"folding {len(items)} new items")
+            count_rows = await self.utils.get_rarity_trait_counts(contract_id)
+            stored_rows = await self.utils.get_rarity_items_stored(contract_id)
+            update = functools.partial(
+                update_rarity, get_rarity_contract['total_count'], count_rows, stored_rows, items
+            )
+            result = await self.bot.loop.run_in_executor(self.bot.rarity_pool, update)
+            if result is not None:
+                rarity_json, total_count, changed_counts, updated_rows, inserted_rows = result
+                await report(f"writing {len(inserted_rows) + len(updated_rows)} items")
+                updated_date = int(time.time())
+                records = await self.utils.save_rarity_incremental(
+                    contract_id, rarity_json, total_count, rarity_cursor(items, get_rarity_contract['last_item_id']),
+                    changed_counts,
+                    [each[:-1] + (updated_date, each[-1]) for each in updated_rows],
+                    [(contract_id,) + each + (updated_date,) for each in inserted_rows],
+                    self.bot.config['rarity'].get('write_chunk', 1000)
+                )
+                await self.utils.refresh_search_rarity_contract(contract_id)
+                return f"the Contract `{contract}` added {str(len(inserted_rows))} " \
+                       f"and updated {str(len(updated_rows))} items ({str(records)} written)."
+            # new items can't be folded in, recompute all
+
+        items = await self.get_rarity_items(contract)
+        if len(items) == 0:
+            return f"the Contract `{contract}` has no items in database."
+        await report(f"computing rarity of {len(items)} items")
+        # computed in a worker process, the event loop only waits for the result
+        create_rarity = functools.partial(compute_rarity, items)
+        rarity_json, rarity_rows, counts, incremental = await self.bot.loop.run_in_executor(
+            self.bot.rarity_pool, create_rarity
+        )
+        last_item_id = rarity_cursor(items) if incremental else 0
+        del items, create_rarity
+
+        # stream the items into staging in chunks, each row dropped once it is written, then swap them in at once
+        def drain(rows):
+            rows.reverse()
+            while rows:
+                yield (contract_id,) + rows.pop() + (updated_date,)
+
+        await report(f"writing {len(rarity_rows)} items")
+        chunk_size = self.bot.config['rarity'].get('write_chunk', 1000)
+        updated_date = int(time.time())
+        load_id = str(uuid.uuid4())
+        loaded = await self.utils.load_rarity_staging(load_id, drain(rarity_rows), chunk_size)
+        if loaded is None:
+            return f"the Contract `{contract}` failed to write rarity items."
+        # last_item_id 0 makes the next run a full one again
+        records = await self.utils.save_rarity_full(
+            contract_id, contract, collection_name, rarity_json, counts.total,
+            last_item_id, counts.rows() if incremental else [], load_id, chunk_size
+        )
+        if loaded > 0:
+            await self.utils.refresh_search_rarity_contract(contract_id)
+            return f"the Contract `{contract}` inserted/updated {str(records)}."
+        return f"the Contract `{contract}` caught 0 data."
+
+    async def wait_job(self, interaction: discord.Interaction, job_id: int, timeout: float = 840.0, on_done=None):
+        """
+        Show a queued job's progress in the command's response until it's done, or the interaction expires.
+        `on_done` is awaited once the job is DONE, for what this process keeps in memory.
+        """
+        status = None
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            await asyncio.sleep(5.0)
+            job = await self.utils.get_job(job_id)
+            if job is None:
+                continue
+            if job['status'] in ("DONE", "FAILED"):
+                if job['status'] == "DONE" and on_done is not None:
+                    await on_done()
+                await interaction.edit_original_response(
+                    content=f"{interaction.user.mention}, job `#{job_id}` {job['status'].lower()}: {job['result']}"
+                )
+                return
+            current = "{} {}".format(job['status'].lower(), job['progress'] or "")
+            if current != status:
+                status = current
+                await interaction.edit_original_response(
+                    content=f"{interaction.user.mention}, job `#{job_id}` {status}"
+                )
+
     # Thanks to: https://github.com/middlerange/rarity-analyzer
     @app_commands.check(owner_only)
     @app_commands.command(
@@ -102,9 +221,9 @@ class Admin(commands.Cog):
         description="Generate rarity from meta in database."
     )
     async def command_metagen(
-        self, interaction: discord.Interaction, contract_id: str
+        self, interaction: discord.Interaction, contract_id: str, full: bool=False
     ) -> None:
-        """ /metagen """
+        """ /metagen <contract_id> [full] """
         await interaction.response.send_message("Loading meta gen...", ephemeral=True)
         try:
             if interaction.user.id not in self.bot.config['discord']['owner_ids']:
@@ -119,98 +238,37 @@ class Admin(commands.Cog):
                 )
                 return
 
-            get_contract = await self.utils.get_contract_by_id(contract_id)
-            if get_contract is None:
-                await interaction.edit_original_response(
-                    content=f"{interaction.user.mention}, the Contract `{contract_id}` was not found."
+            if self.bot.config.get('jobs', {}).get('enable', 0) == 1:
+                # checked before it's queued, a typed id may not be one
+                get_contract = await self.utils.get_contract_by_id(contract_id)
+                if get_contract is None:
+                    await interaction.edit_original_response(
+                        content=f"{interaction.user.mention}, the Contract `{contract_id}` was not found."
+                    )
+                    return
+                contract_id = get_contract['contract_id']
+                # worker.py computes it, this process only follows the job
+                job_id = await self.utils.enqueue_job(
+                    "metagen", {"contract_id": contract_id, "full": full}, dedup_key=f"metagen:{contract_id}"
                 )
-                return
-            elif get_contract and get_contract['enable_rarity'] == 0:
+                if job_id is None:
+                    await interaction.edit_original_response(
+                        content=f"{interaction.user.mention}, the Contract `{contract_id}` is already queued."
+                    )
+                    return
                 await interaction.edit_original_response(
-                    content=f"{interaction.user.mention}, the Contract `{contract_id}` not enable with rarity."
+                    content=f"{interaction.user.mention}, queued job `#{job_id}`."
                 )
-                return
-            contract_id = get_contract['contract_id'] # replace id
-            contract = get_contract['contract']
-            collection_name = get_contract['collection_name']
-            
-            get_rarity_contract = await self.utils.get_nft_rarity_contract_id(contract_id)
-            if get_rarity_contract and int(time.time()) - 600 < get_rarity_contract['update_date']:
-                await interaction.edit_original_response(
-                    content=f"{interaction.user.mention}, the Contract `{contract}` was just recently updated."
+                # the other cluster processes pick it up from `nft_rarity` on their next index refresh
+                await self.wait_job(
+                    interaction, job_id,
+                    on_done=functools.partial(self.utils.refresh_search_rarity_contract, contract_id)
                 )
                 return
-            else:
-                get_items = await self.utils.get_nft_items_by_contract(contract)
-                if len(get_items) == 0:
-                    await interaction.edit_original_response(
-                        content=f"{interaction.user.mention}, the Contract `{contract}` has no items in database."
-                    )
-                    return
-                else:
-                    meta_list = []
-                    for each_meta in get_items:
-                        data_json = json.loads(each_meta['meta'])
-                        if "nft_item_list_id" not in data_json:
-                            data_json["nft_item_list_id"] = each_meta['item_id']
-
-                        if "token_id" not in data_json:
-                            data_json["token_id"] = int(each_meta['asset_id_hex'], 16)
-                        meta_list.append(data_json)
-                    meta_list_text = ujson.dumps(meta_list, ensure_ascii=False, escape_forward_slashes=False)
-                    # Create a temporary directory & file
-                    dir_name = f"/tmp/{contract}_{str(int(time.time()))}_meta_generate"
-                    os.mkdir(dir_name)
-                    file_name = "meta.json"
-                    file_name_out = "rarity.json"
-                    path_in = dir_name + "/" + file_name
-                    path_out = dir_name + "/" + file_name_out
-                    f = open(dir_name + "/" + file_name, "a")
-                    f.write(meta_list_text)
-                    f.close()
-
-                    def meta_gen(path_json_in: str, path_json_out: str):
-                        try:
-                            command = f"node rarity-analyzer-compute.js {path_json_in} {path_json_out}"
-                            process_meta = subprocess.Popen(command, shell=True)
-                            process_meta.wait(timeout=20000) # 20s waiting
-                            if os.path.isfile(path_json_out):
-                                return path_json_out
-                        except Exception as e:
-                            traceback.print_exc(file=sys.stdout)
-                        return None
-
-                    create_meta = functools.partial(meta_gen, path_in, path_out)
-                    generate = await self.bot.loop.run_in_executor(None, create_meta)
-                    if generate:
-                        # Insert to database
-                        path_to_file = open(generate, "r")
-                        rarity_json = path_to_file.read()
-                        path_to_file.close()
-                        await self.utils.update_nft_rarity(contract_id, contract, collection_name, rarity_json)
-                        await self.utils.clear_rarity_items(contract_id)
-                        # add rarity items
-                        rarity_json_data = json.loads(rarity_json)
-                        data_rows = []
-                        for each_item in rarity_json_data['rarity']:
-                            if each_item:
-                                data_rows.append((
-                                    contract_id, each_item['nft_item_list_id'], each_item['name'],
-                                    json.dumps(each_item['attributes']), json.dumps(each_item['missing_traits']),
-                                    json.dumps(each_item['trait_count']), each_item['trait_count']['count'],
-                                    each_item['rarity_score'], each_item['rank'], int(time.time())
-                                ))
-                        if len(data_rows) > 0:
-                            records = await self.utils.insert_rarity_items(data_rows)
-                            await interaction.edit_original_response(
-                                content=f"{interaction.user.mention}, the Contract `{contract}` "
-                                        f"inserted/updated {str(records)}."
-                            )
-                        else:
-                            await interaction.edit_original_response(
-                                content=f"{interaction.user.mention}, the Contract `{contract}` caught 0 data."
-                            )
-                        return
+
+            await interaction.edit_original_response(
+                content=f"{interaction.user.mention}, " + await self.generate_rarity(contract_id, full)
+            )
         except Exception:
             traceback.print_exc(file=sys.stdout)
 
@@ -17,6 +17,8 @@ from discord.ext import commands, tasks
 
 from cogs.utils import Utils
 from cogs.utils import print_color
+from metrics import instrument_methods
+from rpc import RPCError
 
 
 async def check_contract_alchemy(url: str, contract: str):
@@ -44,6 +46,49 @@ async def check_contract_alchemy(url: str, contract: str):
         traceback.print_exc(file=sys.stdout)
     return None
 
+# alchemy_getAssetTransfers categories of a deposit to the hot wallet, "external" is gas
+INDEXER_CATEGORIES = ["external", "erc721", "erc1155", "specialnft"]
+
+
+def _log_index(transfer: dict) -> int:
+    # uniqueId is "<hash>:log:<index>" for token transfers and "<hash>:external" for plain ones
+    parts = transfer['uniqueId'].split(":")
+    return int(parts[2]) if len(parts) > 2 and parts[1] == "log" else 0
+
+
+def nft_tx_rows(network: str, transfer: dict, block: dict):
+    """ `nft_main_wallet_nft_tx` rows of one ERC721/ERC1155 transfer, one per token of an ERC1155 batch. """
+    if transfer['category'] == "erc1155" and transfer.get('erc1155Metadata'):
+        contract_type = "ERC1155"
+        tokens = [(each['tokenId'], int(each['value'], 16)) for each in transfer['erc1155Metadata']]
+    else:
+        contract_type = "ERC721"
+        tokens = [(transfer.get('erc721TokenId') or transfer['tokenId'], 1)]
+    transaction_type = "Batch" if len(tokens) > 1 else "Single"
+    rows = []
+    for token_id, amount in tokens:
+        token_id_int = int(token_id, 16)
+        rows.append((
+            network, int(transfer['blockNum'], 16), transfer['metadata']['blockTimestamp'],
+            int(block['timestamp'], 16), block['hash'], transfer['hash'], None, _log_index(transfer),
+            str(amount), contract_type, transaction_type, transfer['rawContract']['address'].lower(),
+            token_id_int if token_id_int < 2**63 else None, hex(token_id_int),
+            transfer['from'].lower(), transfer['to'].lower(), amount, None
+        ))
+    return rows
+
+
+def gas_tx_row(network: str, transfer: dict, block: dict, tx: dict, receipt: dict):
+    """ `nft_main_wallet_tx` row of a plain transfer of ETH/MATIC. """
+    return (
+        network, transfer['hash'], int(tx['nonce'], 16), int(tx['transactionIndex'], 16),
+        tx['from'].lower(), tx['to'].lower(), int(tx['value'], 16), int(tx['gas'], 16), int(tx['gasPrice'], 16),
+        tx['input'], int(receipt['cumulativeGasUsed'], 16), int(receipt['gasUsed'], 16),
+        int(receipt['status'], 16), transfer['metadata']['blockTimestamp'], int(block['timestamp'], 16),
+        int(transfer['blockNum'], 16), block['hash']
+    )
+
+
 # Cog class
 class AlchemyAPI(commands.Cog):
 
@@ -54,78 +99,46 @@ class AlchemyAPI(commands.Cog):
         self.last_polygon = 0
 
     async def get_block_number(self, url: str, timeout: int=16):
-        json_data = {"jsonrpc":"2.0", "method": "eth_blockNumber", "params": [], "id": 1}
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    url,
-                    headers={'Content-Type': 'application/json'},
-                    json=json_data, timeout=timeout
-                ) as response:
-                    if response.status == 200:
-                        res_data = await response.read()
-                        res_data = res_data.decode('utf-8')
-                        await session.close()
-                        decoded_data = json.loads(res_data)
-                        if decoded_data and 'result' in decoded_data:
-                            return int(decoded_data['result'], 16)
-        except asyncio.TimeoutError:
-            print('timeout: {} get_block_number {}s'.format(url, timeout))
+            return int(await self.bot.rpc.get(url).call("eth_blockNumber", [], timeout), 16)
+        except RPCError as e:
+            print('RPC: {} get_block_number {}'.format(url, e))
         except Exception as e:
             traceback.print_exc(file=sys.stdout)
         return None
 
     async def call_fetch_asset_transfer(
         self, chain: str, from_block: int, to_block: int,
-        order: str="asc", max_count: int=1000, time_sleep: int=1, pageKey: str=None, timeout: int=32
+        order: str="asc", max_count: int=1000, time_sleep: int=1, pageKey: str=None, timeout: int=32,
+        to_address: str=None, category: list=None
     ):
         retry = 5
         retrying = 0
         max_count = hex(max_count)
+        params = {
+            "fromBlock": hex(from_block),
+            "toBlock": hex(to_block),
+            "category": category or [
+                    "erc20",
+                    "erc721",
+                    "erc1155",
+                    "specialnft"
+            ],
+            "withMetadata": True,
+            "excludeZeroValue": False,
+            "maxCount": max_count,
+            "order": order.lower()
+        }
+        if to_address:
+            params['toAddress'] = to_address
+        if pageKey:
+            params['pageKey'] = pageKey
         json_data = {
             "id": 1,
             "jsonrpc": "2.0",
             "method": "alchemy_getAssetTransfers",
-            "params": [
-                {
-                    "fromBlock": hex(from_block),
-                    "toBlock": hex(to_block),
-                    "category": [
-                            "erc20",
-                            "erc721",
-                            "erc1155",
-                            "specialnft"
-                    ],
-                    "withMetadata": True,
-                    "excludeZeroValue": False,
-                    "maxCount": max_count,
-                    "order": order.lower()
-                }
-            ]
+            "params": [params]
         }
-        if pageKey:
-            json_data = {
-                "id": 1,
-                "jsonrpc": "2.0",
-                "method": "alchemy_getAssetTransfers",
-                "params": [
-                    {
-                        "fromBlock": hex(from_block),
-                        "toBlock": hex(to_block),
-                        "category": [
-                                "erc20",
-                                "erc721",
-                                "erc1155",
-                                "specialnft"
-                        ],
-                        "withMetadata": True,
-                        "excludeZeroValue": False,
-                        "maxCount": max_count,
-                        "order": order.lower(),
-                        "pageKey": pageKey
-                    }
-                ]
-            }
         try:
             url = self.bot.config['alchemy_endpoint'][chain.lower()]
             print_color("{} Fetching chain: {}, from: {} to {}, maxCount {}, pageKey {} ...".format(
@@ -145,8 +158,14 @@ class AlchemyAPI(commands.Cog):
                             await session.close()
                             decoded_data = json.loads(res_data)
                             if decoded_data and "result" in decoded_data:
-                                await asyncio.sleep(1.0)
+                                await asyncio.sleep(time_sleep)
                                 return decoded_data
+                            retrying += 1
+                            print_color("{} Fetching chain: {}, from: {} to {} got error: {}. Retrying {}".format(
+                                f"{datetime.now():%Y-%m-%d %H:%M:%S}", chain.lower(), from_block, to_block,
+                                decoded_data.get('error') if decoded_data else None, retrying), color="red"
+                            )
+                            await asyncio.sleep(5.0)
                         else:
                             retrying += 1
                             print_color("{} Fetching chain: {}, from: {} to {} got status: {}. Retrying {} in {}".format(
@@ -208,11 +227,21 @@ class AlchemyAPI(commands.Cog):
 
     @tasks.loop(seconds=10.0)
     async def fetch_nft_tokens(self):
+        if not self.bot.leader.is_leader("alchemy"):
+            return
         if self.bot.config['maintenance']['disable_all_tasks'] == 1:
             print_color("{} maintenance is on.. sleep...".format(
                 f"{datetime.now():%Y-%m-%d %H:%M:%S}"), color="red")
             await asyncio.sleep(10.0)
             return
+        if self.bot.config.get('jobs', {}).get('enable', 0) == 1:
+            # worker.py runs it, outside the gateway process
+            await self.utils.enqueue_job("fetch_nft_tokens", dedup_key="fetch_nft_tokens")
+            return
+        await self.sync_nft_tokens()
+
+    async def sync_nft_tokens(self):
+        """ Fetch new tokens of the active contracts from Alchemy, one run of `fetch_nft_tokens`. """
         get_active = await self.utils.get_active_nft_conts(limit=20)
         if len(get_active) > 0:
             for each in get_active:
@@ -334,11 +363,21 @@ class AlchemyAPI(commands.Cog):
 
     @tasks.loop(seconds=10.0)
     async def fetch_image_in_nft(self):
+        if not self.bot.leader.is_leader("alchemy"):
+            return
         if self.bot.config['maintenance']['disable_all_tasks'] == 1:
             print_color("{} maintenance is on.. sleep...".format(
                 f"{datetime.now():%Y-%m-%d %H:%M:%S}"), color="red")
             await asyncio.sleep(10.0)
             return
+        if self.bot.config.get('jobs', {}).get('enable', 0) == 1:
+            # worker.py runs it, outside the gateway process
+            await self.utils.enqueue_job("fetch_image_in_nft", dedup_key="fetch_image_in_nft")
+            return
+        await self.sync_nft_images()
+
+    async def sync_nft_images(self):
+        """ Download the images of tokens not having one yet, one run of `fetch_image_in_nft`. """
         # create function for multiple thread
         # should return value of `nft_token_id` if saved.
         async def fetch_image_ipfs(image_dict, id: int, total_numbers, selected_gw):
@@ -476,22 +515,140 @@ class AlchemyAPI(commands.Cog):
         except Exception as e:
             traceback.print_exc(file=sys.stdout)
 
+    async def index_wallet(self, network: str):
+        """
+        Index the deposits to the hot wallet on `network` from its cursor in `nft_indexer_cursor` up to
+        `confirmations` blocks behind the head. Returns how many blocks were indexed.
+        """
+        indexer = self.bot.config['indexer']
+        chain = {"ETHEREUM": "eth", "POLYGON": "polygon"}[network]
+        rpc = self.bot.rpc.network(network)
+        address = self.bot.config['wallet']['eth_address'].lower()
+        head = await self.get_block_number(rpc.url)
+        if head is None:
+            return 0
+        confirmed = head - indexer['confirmations'][chain]
+
+        cursor = await self.utils.get_indexer_cursor(network, address)
+        if cursor is None:
+            last_block = indexer.get('start_block', {}).get(chain, confirmed) - 1
+        else:
+            last_block = cursor['last_block']
+            if cursor['last_block_hash'] is not None:
+                block = await rpc.call("eth_getBlockByNumber", [hex(last_block), False])
+                if block is None or block['hash'] != cursor['last_block_hash']:
+                    last_block -= indexer.get('reorg_rewind', 64)
+                    print_color("{} Indexer {}: block {} was reorganised, rewind to {}".format(
+                        f"{datetime.now():%Y-%m-%d %H:%M:%S}", network, cursor['last_block'], last_block), color="red"
+                    )
+                    if not await self.utils.rewind_indexer(network, address, last_block):
+                        return 0
+        if last_block >= confirmed:
+            return 0
+        from_block = last_block + 1
+        to_block = min(confirmed, last_block + indexer.get('max_blocks', 2000))
+
+        transfers = []
+        page_key = None
+        while True:
+            fetched = await self.call_fetch_asset_transfer(
+                chain, from_block, to_block, "asc", 1000, 0, page_key, 32, address, INDEXER_CATEGORIES
+            )
+            if fetched is None:
+                return 0
+            transfers += fetched['result']['transfers']
+            page_key = fetched['result'].get('pageKey')
+            if not page_key:
+                break
+
+        # blocks for hashes and times, plus the last one for the cursor
+        block_numbers = sorted({int(each['blockNum'], 16) for each in transfers} | {to_block})
+        blocks = await rpc.batch([("eth_getBlockByNumber", [hex(number), False]) for number in block_numbers])
+        if any(block is None for block in blocks):
+            return 0
+        blocks = dict(zip(block_numbers, blocks))
+
+        gas_transfers = [each for each in transfers if each['category'] == "external"]
+        gas_hashes = list({each['hash']: True for each in gas_transfers}.keys())
+        txs = await rpc.batch([("eth_getTransactionByHash", [tx]) for tx in gas_hashes])
+        receipts = await rpc.batch([("eth_getTransactionReceipt", [tx]) for tx in gas_hashes])
+        if any(each is None for each in txs + receipts):
+            return 0
+        txs = dict(zip(gas_hashes, txs))
+        receipts = dict(zip(gas_hashes, receipts))
+
+        gas_rows = [
+            gas_tx_row(network, each, blocks[int(each['blockNum'], 16)], txs[each['hash']], receipts[each['hash']])
+            for each in gas_transfers
+        ]
+        nft_rows = []
+        for each in transfers:
+            if each['category'] != "external":
+                nft_rows += nft_tx_rows(network, each, blocks[int(each['blockNum'], 16)])
+        saved = await self.utils.save_indexed_range(
+            network, address, gas_rows, nft_rows, to_block, blocks[to_block]['hash']
+        )
+        if saved is None:
+            return 0
+        # credited right away instead of waiting for the deposit sweeps
+        self.bot.deposit_queue.push(
+            [(network, each[1]) for each in gas_rows], [(network, each[5]) for each in nft_rows]
+        )
+        if saved[0] + saved[1] > 0:
+            print_color("{} Indexer {}: blocks {}-{}, {} gas tx(s), {} NFT tx(s)".format(
+                f"{datetime.now():%Y-%m-%d %H:%M:%S}", network, from_block, to_block, saved[0], saved[1]), color="green"
+            )
+        return to_block - last_block
+
+    @tasks.loop(seconds=10.0)
+    async def index_wallet_deposits(self):
+        # with the crediting loops, they share `bot.deposit_queue`
+        if not self.bot.leader.is_leader("deposits"):
+            return
+        if self.bot.config['maintenance']['disable_all_tasks'] == 1:
+            return
+        if self.bot.config['indexer'].get('enable', 0) != 1:
+            return
+        for network in self.bot.config['indexer']['networks']:
+            try:
+                # catch up in `max_blocks` steps, a few per run so one network can't hold the other
+                for _ in range(self.bot.config['indexer'].get('max_ranges_per_run', 5)):
+                    if await self.index_wallet(network) == 0:
+                        break
+            except RPCError as e:
+                print('Indexer: {} {}'.format(network, e))
+            except Exception as e:
+                traceback.print_exc(file=sys.stdout)
+
     @commands.Cog.listener()
     async def on_ready(self):
         if not self.fetch_nft_tokens.is_running():
             self.fetch_nft_tokens.start()
         if not self.fetch_image_in_nft.is_running():
             self.fetch_image_in_nft.start()
+        if not self.index_wallet_deposits.is_running():
+            self.index_wallet_deposits.start()
 
     async def cog_load(self) -> None:
         if not self.fetch_nft_tokens.is_running():
             self.fetch_nft_tokens.start()
         if not self.fetch_image_in_nft.is_running():
             self.fetch_image_in_nft.start()
+        if not self.index_wallet_deposits.is_running():
+            self.index_wallet_deposits.start()
 
     async def cog_unload(self) -> None:
         self.fetch_nft_tokens.cancel()
         self.fetch_image_in_nft.cancel()
+        self.index_wallet_deposits.cancel()
+
+
+# Alchemy HTTP API calls, retries included, on /metrics
+instrument_methods(
+    AlchemyAPI, "nftbot_alchemy_seconds", "Alchemy API call duration",
+    methods=["call_fetch_asset_transfer", "get_nft_collections"], errors="nftbot_alchemy_errors_total"
+)
+
 
 async def setup(bot: commands.Bot) -> None:
     await bot.add_cog(AlchemyAPI(bot))
@@ -27,12 +27,10 @@ class Collection(commands.Cog):
         """ /nftbrowse"""
         await interaction.response.send_message(f"{interaction.user.mention} browsing your NFTs...")
 
-        get_user_info = await self.utils.get_user_info(str(interaction.user.id), self.bot.server_bot)
+        get_user_info = await self.utils.get_user_session(str(interaction.user.id), self.bot.server_bot)
         if get_user_info is None:
             await interaction.edit_original_response(content=self.bot.first_message)
-            await self.utils.insert_user_info(str(interaction.user.id), self.bot.server_bot, 1)
             return
-        await self.utils.insert_user_info(str(interaction.user.id), self.bot.server_bot, 1)
 
         try:
             list_user_assets = await self.utils.get_list_user_assets(str(interaction.user.id), self.bot.server_bot)
@@ -171,18 +169,12 @@ class Collection(commands.Cog):
         interaction: discord.Interaction,
         current: str
     ) -> List[app_commands.Choice[str]]:
-        # Do stuff with the "current" parameter, e.g. querying it search results...
-        list_auto_nfts = await self.utils.get_rarity_by_item_name_search(current, 20)
-        nft_list_names = []
-        nft_item_list_ids = []
+        # Served from the in-memory index, no database query per keystroke
+        list_auto_nfts = self.bot.search_index.rarity.search(current, 25)
         if len(list_auto_nfts) > 0:
-            for each in list_auto_nfts:
-                if each['nft_item_list_id'] not in nft_item_list_ids:
-                    nft_list_names.append(each['name'])
-                    nft_item_list_ids.append(str(each['nft_item_list_id']))
             return [
-                app_commands.Choice(name=item, value=nft_item_list_ids[nft_list_names.index(item)])
-                for item in nft_list_names if current.lower() in item.lower()
+                app_commands.Choice(name=name, value=str(nft_item_list_id))
+                for nft_item_list_id, name, _ in list_auto_nfts
             ]
         else:
             nft_list_names = ["N/A"]
@@ -203,12 +195,10 @@ class Collection(commands.Cog):
         """ /nftcollection <collection> """
         await interaction.response.send_message(f"{interaction.user.mention} loading collection...")
 
-        get_user_info = await self.utils.get_user_info(str(interaction.user.id), self.bot.server_bot)
+        get_user_info = await self.utils.get_user_session(str(interaction.user.id), self.bot.server_bot)
         if get_user_info is None:
             await interaction.edit_original_response(content=self.bot.first_message)
-            await self.utils.insert_user_info(str(interaction.user.id), self.bot.server_bot, 1)
             return
-        await self.utils.insert_user_info(str(interaction.user.id), self.bot.server_bot, 1)
 
         try:
             get_collection = await self.utils.get_contract_by_id(int(collection))
@@ -250,18 +240,12 @@ class Collection(commands.Cog):
         interaction: discord.Interaction,
         current: str
     ) -> List[app_commands.Choice[str]]:
-        # Do stuff with the "current" parameter, e.g. querying it search results...
-        list_collections = await self.utils.get_list_contract_collection_search(current, 20)
-        collection_list = []
-        collection_ids = []
+        # Served from the in-memory index, no database query per keystroke
+        list_collections = self.bot.search_index.collections.search(current, 25)
         if len(list_collections) > 0:
-            for each in list_collections:
-                if each['contract_id'] not in collection_ids:
-                    collection_list.append(each['collection_name'])
-                    collection_ids.append(str(each['contract_id']))
             return [
-                app_commands.Choice(name=item, value=collection_ids[collection_list.index(item)])
-                for item in collection_list if current.lower() in item.lower()
+                app_commands.Choice(name=name, value=str(contract_id))
+                for contract_id, name, _ in list_collections
             ]
         else:
             collection_list = ["N/A"]
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import sys
 import time
@@ -11,8 +12,8 @@ from discord import app_commands
 from discord.ext import commands, tasks
 
 from cogs.utils import Utils
-from cogs.utils import check_address, \
-    transfer_nft, eth_get_tx_info, truncate
+from cogs.utils import check_address, truncate
+from withdraw import NONCE_USED, REJECTED, SentTx
 
 
 class Deposit(commands.Cog):
@@ -22,6 +23,11 @@ class Deposit(commands.Cog):
         self.utils = Utils(self.bot)
         # cache withdraw of a coin to avoid fast withdraw
         self.withdraw_tx = TTLCache(maxsize=2048, ttl=60.0) # key = user_id + user_server => time
+        # the queue consumer and the sweeps must not credit the same row twice, see `_credit_lock`
+        self.credit_lock = None
+        reconcile_interval = self.bot.config.get('deposit', {}).get('reconcile_interval', 20.0)
+        self.check_notify_deposit_gas.change_interval(seconds=reconcile_interval)
+        self.check_notify_deposit_nft.change_interval(seconds=reconcile_interval)
 
     @app_commands.command(
         name="nftransfer",
@@ -41,17 +47,15 @@ class Deposit(commands.Cog):
             await interaction.edit_original_response(
                 content=f"{interaction.user.mention}, withdraw is currently disable. Try again later!")
             return
-        get_user_info = await self.utils.get_user_info(str(interaction.user.id), self.bot.server_bot)
+        get_user_info = await self.utils.get_user_session(str(interaction.user.id), self.bot.server_bot, fresh=True)
         if get_user_info is None:
             await interaction.edit_original_response(content=self.bot.first_message)
-            await self.utils.insert_user_info(str(interaction.user.id), self.bot.server_bot, 1)
             return
         else:
             if get_user_info['is_frozen'] == 1:
                 await interaction.edit_original_response(
                     content=f"{interaction.user.mention}, please contact Bot's dev. Your account is currently locked.")
                 return
-        await self.utils.insert_user_info(str(interaction.user.id), self.bot.server_bot, 1)
 
         try:
             # check address
@@ -59,8 +63,10 @@ class Deposit(commands.Cog):
                 await interaction.edit_original_response(
                     content=f"{interaction.user.mention}, address `{address}` is invalid.")
                 return
-            # check if he's still own it when withdraw
-            list_user_assets = await self.utils.get_list_user_assets(str(interaction.user.id), self.bot.server_bot)
+            # check if he's still own it when withdraw, from the database: another process may have moved it
+            list_user_assets = await self.utils.get_list_user_assets(
+                str(interaction.user.id), self.bot.server_bot, fresh=True
+            )
             if len(list_user_assets) == 0:
                 await interaction.edit_original_response(
                     content=f"{interaction.user.mention}, you don't own any NFT."
@@ -100,24 +106,14 @@ class Deposit(commands.Cog):
                         await interaction.edit_original_response(
                             content=f"{interaction.user.mention}, failed to get item's detail.")
                         return
-                    # check if there is pending gas when withdraw
+                    # pending withdrawals are charged on confirmation, reserve gas for them too
                     withdraw_pending = await self.utils.get_pending_withdraw_tx_list_by_id_user(
                         str(interaction.user.id), self.bot.server_bot, network
                     )
-                    if len(withdraw_pending) > 0:
-                        await interaction.edit_original_response(
-                            content=f"{interaction.user.mention}, there is still a pending tx you did earlier. "
-                                    f"Please try again later!")
-                        await self.utils.log_to_channel(
-                            self.bot.config['discord']['log_channel'],
-                            f"Reject {str(interaction.user.id)} / {interaction.user.name} withdraw: `{item_name}` "
-                            f"/ `{str(token_id)}`. Pending clearing his/her own previous Tx!"
-                        )
-                        return
 
-                    # check if nonce for withdraw address
+                    # nonces come from nft_withdraw_nonce, only cap how many can wait in the mempool
                     pending_withdraw_tx_list = await self.utils.get_pending_withdraw_tx_list(network)
-                    if len(pending_withdraw_tx_list) > 0:
+                    if len(pending_withdraw_tx_list) >= self.bot.config['withdraw'].get('max_pending', 16):
                         await interaction.edit_original_response(
                             content=f"{interaction.user.mention}, there are some pending tx with fund wallet. "
                                     f"Please try again later!"
@@ -132,21 +128,22 @@ class Deposit(commands.Cog):
                     try:
                         min_gas = 0.005 # Just leave it as default
                         your_gas = 0.0
-                        await self.utils.get_bot_setting()
-                        url = self.bot.config['endpoint'][network.lower()]
+                        if not self.bot.settings.loaded:
+                            await self.utils.get_bot_setting()
                         if network == "ETHEREUM":
                             your_gas = get_user_info['eth_gas']
-                            min_gas = json.loads(self.bot.setting['min_gas_move_nft'])['ETH']
+                            min_gas = self.bot.settings.min_gas('ETH', min_gas)
                             chain_id = 1
                         elif network == "POLYGON":
                             your_gas = get_user_info['matic_gas']
-                            min_gas = json.loads(self.bot.setting['min_gas_move_nft'])['MATIC']
+                            min_gas = self.bot.settings.min_gas('MATIC', min_gas)
                             chain_id = 137
                         else:
                             await interaction.edit_original_response(
                                 content=f"{interaction.user.mention}, can't get network endpoint.")
                             return
 
+                        min_gas = min_gas * (len(withdraw_pending) + 1)
                         if your_gas < min_gas:
                             min_gas_str = "{:,.4f}".format(min_gas)
                             having_gas_str = "{:,.4f}".format(your_gas)
@@ -177,17 +174,9 @@ class Deposit(commands.Cog):
                         pass
 
                     # withdraw
-                    withdraw_tx = None
-                    if contract_type == "ERC721":
-                        withdraw_tx = await transfer_nft(
-                            url, "ERC721", contract, self.bot.ERC721_ABI, self.bot.config['wallet']['eth_address'],
-                            address, self.bot.config['wallet']['eth_key'], token_id, chain_id, 1
-                        ) # amount 1
-                    else:
-                        withdraw_tx = await transfer_nft(
-                            url, "ERC1155", contract, self.bot.ERC1155_ABI, self.bot.config['wallet']['eth_address'],
-                            address, self.bot.config['wallet']['eth_key'], token_id, chain_id, 1
-                        ) # amount 1
+                    withdraw_tx = await self.bot.withdraw.sign_transfer_nft(
+                        network, contract_type, contract, address, token_id, chain_id, 1
+                    ) # amount 1
                     if withdraw_tx is None:
                         await interaction.edit_original_response(
                             content=f"{interaction.user.mention}, internal error during withdraw."
@@ -196,21 +185,42 @@ class Deposit(commands.Cog):
                             self.bot.config['discord']['log_channel'],
                             f"[DISCORD] {str(interaction.user.id)} / {interaction.user.name} failed to withdraw: `{item_name}` / `{str(token_id)}`."
                         )
-                    else:
-                        try:
-                            await self.utils.transferred_nft(
-                                network, contract, hex(token_id), str(interaction.user.id), withdraw_tx,
-                                self.bot.server_bot, address, 1
-                            ) # amount is 1
-                            await interaction.edit_original_response(
-                                content=f"{interaction.user.mention}, you withdrew {item_name} / {collection_name} "
-                                        f"to `{address}` with tx hash `{withdraw_tx}`. Wait for confirmation!")
-                        except Exception:
-                            traceback.print_exc(file=sys.stdout)
+                        return
+                    # debited and recorded PENDING before the broadcast, whatever the node answers the
+                    # receipt and rebroadcast loop settles it
+                    debited = await self.utils.transferred_nft(
+                        network, contract, hex(token_id), str(interaction.user.id), withdraw_tx.tx_hash,
+                        self.bot.server_bot, address, 1, withdraw_tx.nonce, withdraw_tx.raw_tx
+                    ) # amount is 1
+                    if debited is False:
+                        await self.bot.withdraw.nonces.release(network, withdraw_tx.nonce)
+                        await interaction.edit_original_response(
+                            content=f"{interaction.user.mention}, that NFT doesn't belong to you.")
+                        await self.utils.log_to_channel(
+                            self.bot.config['discord']['log_channel'],
+                            f"Reject {str(interaction.user.id)} / {interaction.user.name} withdraw: `{item_name}` "
+                            f"/ `{str(token_id)}`. Couldn't debit it!"
+                        )
+                        return
+                    status = await self.bot.withdraw.broadcast(network, withdraw_tx)
+                    if status == REJECTED:
+                        await self.utils.cancel_withdraw(network, withdraw_tx.tx_hash)
+                        await interaction.edit_original_response(
+                            content=f"{interaction.user.mention}, internal error during withdraw."
+                        )
                         await self.utils.log_to_channel(
                             self.bot.config['discord']['log_channel'],
-                            f"[DISCORD] {str(interaction.user.id)} / {interaction.user.name} withdrew `{item_name}`. Tx: `{withdraw_tx}`"
+                            f"[DISCORD] {str(interaction.user.id)} / {interaction.user.name} failed to withdraw: `{item_name}` / `{str(token_id)}`."
                         )
+                        return
+                    await interaction.edit_original_response(
+                        content=f"{interaction.user.mention}, you withdrew {item_name} / {collection_name} "
+                                f"to `{address}` with tx hash `{withdraw_tx.tx_hash}`. Wait for confirmation!")
+                    await self.utils.log_to_channel(
+                        self.bot.config['discord']['log_channel'],
+                        f"[DISCORD] {str(interaction.user.id)} / {interaction.user.name} withdrew `{item_name}`. "
+                        f"Tx: `{withdraw_tx.tx_hash}` ({status.lower()})"
+                    )
         except Exception:
             traceback.print_exc(file=sys.stdout)
 
@@ -221,27 +231,20 @@ class Deposit(commands.Cog):
         current: str
     ) -> List[app_commands.Choice[str]]:
         # Do stuff with the "current" parameter, e.g. querying it search results...
-        list_user_assets = await self.utils.get_list_user_assets_search(
-            str(interaction.user.id), self.bot.server_bot, current, 10
+        list_user_assets = await self.utils.search_user_assets(
+            str(interaction.user.id), self.bot.server_bot, current, 25
         )
-        item_list = []
-        asset_ids = []
-        uniq_set = []
         if len(list_user_assets) > 0:
-            for each in list_user_assets:
-                if each['contract'].lower() + each['token_id_hex'] + each['network'] not in uniq_set:
-                    item_list.append(each['name'])
-                    asset_ids.append(str(each['nft_id']))
+            return [
+                app_commands.Choice(name=each['name'], value=str(each['nft_id']))
+                for each in list_user_assets
+            ]
         else:
             item_list = ["N/A"]
             return [
                 app_commands.Choice(name=item, value=item)
                 for item in item_list if current.lower() in item.lower()
             ]
-        return [
-            app_commands.Choice(name=item, value=asset_ids[item_list.index(item)])
-            for item in item_list if current.lower() in item.lower()
-        ]
 
     @app_commands.command(
         name="nftbalance",
@@ -253,10 +256,9 @@ class Deposit(commands.Cog):
         """ /nftbalance """
         await interaction.response.send_message(f"{interaction.user.mention} loading balance...", ephemeral=True)
 
-        get_user_info = await self.utils.get_user_info(str(interaction.user.id), self.bot.server_bot)
+        get_user_info = await self.utils.get_user_session(str(interaction.user.id), self.bot.server_bot)
         if get_user_info is None:
             await interaction.edit_original_response(content=self.bot.first_message)
-            await self.utils.insert_user_info(str(interaction.user.id), self.bot.server_bot, 1)
             return
         else:
             if get_user_info['is_frozen'] == 1:
@@ -264,7 +266,6 @@ class Deposit(commands.Cog):
                     content=f"{interaction.user.mention}, please contact Bot's dev. "
                             f"Your account is currently locked.")
                 return
-        await self.utils.insert_user_info(str(interaction.user.id), self.bot.server_bot, 1)
 
         try:
             list_user_assets = await self.utils.get_list_user_assets(str(interaction.user.id), self.bot.server_bot)
@@ -314,10 +315,9 @@ class Deposit(commands.Cog):
         """ /nftdeposit """
         await interaction.response.send_message(f"{interaction.user.mention} loading deposit...", ephemeral=True)
 
-        get_user_info = await self.utils.get_user_info(str(interaction.user.id), self.bot.server_bot)
+        get_user_info = await self.utils.get_user_session(str(interaction.user.id), self.bot.server_bot)
         if get_user_info is None:
             await interaction.edit_original_response(content=self.bot.first_message)
-            await self.utils.insert_user_info(str(interaction.user.id), self.bot.server_bot, 1)
             return
         else:
             if get_user_info['is_frozen'] == 1:
@@ -325,7 +325,6 @@ class Deposit(commands.Cog):
                     content=f"{interaction.user.mention}, please contact Bot's dev. Your account is currently locked."
                 )
                 return
-        await self.utils.insert_user_info(str(interaction.user.id), self.bot.server_bot, 1)
 
         try:
             embed = discord.Embed(
@@ -356,7 +355,8 @@ class Deposit(commands.Cog):
                                                                            get_user_info['matic_gas']),
                             inline=False)
             try:
-                await self.utils.get_bot_setting()
+                if not self.bot.settings.loaded:
+                    await self.utils.get_bot_setting()
                 embed.add_field(name="Supported Networks",
                                 value=", ".join(self.bot.config['other']['supported_network']),
                                 inline=False)
@@ -365,8 +365,8 @@ class Deposit(commands.Cog):
                     NORMAL = "🚴"
                     FAST = "🚀"
 
-                    if "eth_gas_tracker" in self.bot.setting and self.bot.setting['eth_gas_tracker']:
-                        gas_data = json.loads(self.bot.setting["eth_gas_tracker"])
+                    if self.bot.settings.eth_gas_tracker:
+                        gas_data = self.bot.settings.eth_gas_tracker
                         last_update = discord.utils.format_dt(
                             datetime.fromtimestamp(gas_data['last_update']), style='R'
                         )
@@ -374,11 +374,12 @@ class Deposit(commands.Cog):
                             SLOW, gas_data['SafeGasPrice'], NORMAL, gas_data['ProposeGasPrice'],
                             FAST, gas_data['FastGasPrice'], last_update
                         )
+                        status_str += self.gas_trend("ETHEREUM")
                         embed.add_field(name="ETH Gas Tracker",
                                         value=status_str,
                                         inline=False)
-                    if "matic_gas_tracker" in self.bot.setting and self.bot.setting['matic_gas_tracker']:
-                        gas_data = json.loads(self.bot.setting["matic_gas_tracker"])
+                    if self.bot.settings.matic_gas_tracker:
+                        gas_data = self.bot.settings.matic_gas_tracker
                         last_update = discord.utils.format_dt(
                             datetime.fromtimestamp(gas_data['last_update']), style='R'
                         )
@@ -386,6 +387,7 @@ class Deposit(commands.Cog):
                             SLOW, gas_data['safeLow'], NORMAL, gas_data['standard'],
                             FAST, gas_data['fast'], last_update
                         )
+                        status_str += self.gas_trend("POLYGON")
                         embed.add_field(name="MATIC Gas Tracker",
                                         value=status_str,
                                         inline=False)
@@ -400,163 +402,203 @@ class Deposit(commands.Cog):
         except Exception:
             traceback.print_exc(file=sys.stdout)
 
-    @tasks.loop(seconds=20.0)
-    async def check_notify_deposit_gas(self):
-        await self.bot.wait_until_ready()
-        pending_gas = await self.utils.get_confirmed_gas_tx_to_notify()
-        if len(pending_gas) > 0:
-            for each in pending_gas:
-                try:
-                    eth_gas = 0.0
-                    matic_gas = 0.0
-                    url = self.bot.config['endpoint'][each['network'].lower()]
-                    amount = each['value']/10**self.bot.config['gas_decimal'][each['network'].lower()]
-                    if each['network'] == "ETHEREUM":
-                        coin = "ETH"
-                        eth_gas = amount
-                    elif each['network'] == "POLYGON":
-                        coin = "MATIC"
-                        matic_gas = amount
-                    else:
-                        continue
-                    check_tx = await eth_get_tx_info(url, each['hash'], 8)
-                    status = "CONFIRMED"
-                    if check_tx and 'status' in check_tx and int(check_tx['status'], 16) == 0:
-                        status = "FAILED" # leave it there
-                        continue # skip this tx
-                    else:
-                        msg = "You have deposited `{:,.6f} {}` with tx `{}` from address: `{}` at height `{}`.".format(
-                            amount, coin, each['hash'], each['from_address'], each['block_number']
-                        )
-                        if each['user_server'] == self.bot.server_bot and each['discord_id'].isdigit():
-                            found_user = self.bot.get_user(int(each['discord_id']))
-                            if found_user:
-                                try:
-                                    await found_user.send(msg)
-                                except Exception:
-                                    traceback.print_exc(file=sys.stdout)
-                                await self.utils.update_confirmed_gas_tx_notify(
-                                    each['hash'], each['discord_id'], each['user_server'], eth_gas, matic_gas
-                                )
-                except Exception:
-                    traceback.print_exc(file=sys.stdout)
-
-    @tasks.loop(seconds=20.0)
-    async def check_notify_deposit_nft(self):
-        await self.bot.wait_until_ready()
-        # ERC721
-        pending_nft = await self.utils.get_confirmed_nft_tx_to_notify()
-        if len(pending_nft) > 0:
-            for each in pending_nft:
-                try:
-                    name = each['name']
-                    eth_token = 0
-                    matic_token = 0
-                    amount = each['amount']
-
-                    url = self.bot.config['endpoint'][each['network'].lower()]
-                    if each['network'] == "ETHEREUM":
-                        eth_token = each['amount']
-                    elif each['network'] == "POLYGON":
-                        matic_token = each['amount']
-                    else:
-                        continue
-
-                    if each['amount'] > 1000:
-                        print("Skipped tx {} on network: {} for amount token ID {}".format(
-                            each['transaction_hash'], each['network'], each['amount'])
+    def _credit_lock(self):
+        # created on the running loop, cogs are loaded on another one
+        if self.credit_lock is None:
+            self.credit_lock = asyncio.Lock()
+        return self.credit_lock
+
+    async def credit_gas_deposits(self, pending_gas):
+        receipts = await self.utils.get_tx_receipts([(each['network'], each['hash']) for each in pending_gas])
+        # credited in one transaction per cycle, users are told once it is written
+        credits = []
+        messages = {}
+        for each in pending_gas:
+            try:
+                eth_gas = 0.0
+                matic_gas = 0.0
+                amount = each['value']/10**self.bot.config['gas_decimal'][each['network'].lower()]
+                if each['network'] == "ETHEREUM":
+                    coin = "ETH"
+                    eth_gas = amount
+                elif each['network'] == "POLYGON":
+                    coin = "MATIC"
+                    matic_gas = amount
+                else:
+                    continue
+                check_tx = receipts.get((each['network'], each['hash']))
+                if check_tx is None:
+                    continue # no receipt (yet), the sweep tries again
+                if 'status' in check_tx and int(check_tx['status'], 16) == 0:
+                    continue # skip failed tx, leave it there
+                if each['user_server'] == self.bot.server_bot and each['discord_id'].isdigit():
+                    found_user = self.bot.get_user(int(each['discord_id']))
+                    if found_user:
+                        credits.append((each['hash'], each['discord_id'], each['user_server'], eth_gas, matic_gas))
+                        messages[each['hash']] = (
+                            found_user,
+                            "You have deposited `{:,.6f} {}` with tx `{}` from address: `{}` at height `{}`.".format(
+                                amount, coin, each['hash'], each['from_address'], each['block_number']
+                            )
                         )
-                        continue
+            except Exception:
+                traceback.print_exc(file=sys.stdout)
+        if len(credits) == 0:
+            return []
+        done = await self.utils.update_confirmed_gas_tx_notify(credits)
+        for txn in done:
+            found_user, msg = messages[txn]
+            self.bot.notifier.dm(found_user.id, msg)
+        return done
+
+    async def credit_nft_deposits(self, pending_nft):
+        receipts = await self.utils.get_tx_receipts(
+            [(each['network'], each['transaction_hash']) for each in pending_nft]
+        )
+        credits = []
+        messages = {}
+        for each in pending_nft:
+            try:
+                name = each['name']
+                eth_token = 0
+                matic_token = 0
+                amount = each['amount']
+
+                if each['network'] == "ETHEREUM":
+                    eth_token = each['amount']
+                elif each['network'] == "POLYGON":
+                    matic_token = each['amount']
+                else:
+                    continue
 
-                    crediting = (
-                        each['network'], each['token_address'],
-                        each['token_id_int'], each['token_id_hex'], each['discord_id'], 
-                        each['user_server'], amount
+                if each['amount'] > 1000:
+                    print("Skipped tx {} on network: {} for amount token ID {}".format(
+                        each['transaction_hash'], each['network'], each['amount'])
                     )
+                    continue
 
-                    check_tx = await eth_get_tx_info(url, each['transaction_hash'], 8)
-                    status = "CONFIRMED"
-                    if check_tx and 'status' in check_tx and int(check_tx['status'], 16) == 0:
-                        status = "FAILED" # leave it there
-                        continue # skip failed tx
-                    else:
-                        msg = "You have deposited `{}` of `{}` with tx `{}` from address: `{}` " \
-                              "at height `{}` on network `{}`.".format(each['amount'], name, each['transaction_hash'],
-                                                                       each['from_address'], each['block_number'],
-                                                                       each['network']
-                        )
-                        if each['user_server'] == self.bot.server_bot and each['discord_id'].isdigit():
-                            found_user = self.bot.get_user(int(each['discord_id']))
-                            if found_user:
-                                try:
-                                    await found_user.send(msg)
-                                except Exception:
-                                    traceback.print_exc(file=sys.stdout)
-                                await self.utils.insert_nft_deposited_credits(
-                                    each['discord_id'], each['user_server'], 
-                                    eth_token, matic_token, crediting, each['nft_tx_id'])
-                except Exception:
-                    traceback.print_exc(file=sys.stdout)
-        # ERC1155
-        pending_nft = await self.utils.get_confirmed_nft1155_tx_to_notify()
-        if len(pending_nft) > 0:
-            for each in pending_nft:
-                try:
-                    name = each['name']
-                    eth_token = 0
-                    matic_token = 0
-                    amount = each['amount']
-                    url = self.bot.config['endpoint'][each['network'].lower()]
-                    if each['network'] == "ETHEREUM":
-                        eth_token = each['amount']
-                    elif each['network'] == "POLYGON":
-                        matic_token = each['amount']
-                    else:
-                        continue
+                crediting = (
+                    each['network'], each['token_address'],
+                    each['token_id_int'], each['token_id_hex'], each['discord_id'], 
+                    each['user_server'], amount
+                )
 
-                    if each['amount'] > 1000:
-                        print("Skipped tx {} on network: {} for amount token ID {}".format(
-                            each['transaction_hash'], each['network'], each['amount'])
+                check_tx = receipts.get((each['network'], each['transaction_hash']))
+                if check_tx is None:
+                    continue # no receipt (yet), the sweep tries again
+                if 'status' in check_tx and int(check_tx['status'], 16) == 0:
+                    continue # skip failed tx, leave it there
+                if each['user_server'] == self.bot.server_bot and each['discord_id'].isdigit():
+                    found_user = self.bot.get_user(int(each['discord_id']))
+                    if found_user:
+                        credits.append((
+                            each['discord_id'], each['user_server'], eth_token, matic_token, crediting,
+                            each['nft_tx_id']
+                        ))
+                        messages[each['nft_tx_id']] = (
+                            found_user,
+                            "You have deposited `{}` of `{}` with tx `{}` from address: `{}` "
+                            "at height `{}` on network `{}`.".format(
+                                each['amount'], name, each['transaction_hash'], each['from_address'],
+                                each['block_number'], each['network']
+                            )
                         )
-                        continue
+            except Exception:
+                traceback.print_exc(file=sys.stdout)
+        if len(credits) == 0:
+            return []
+        done = await self.utils.insert_nft_deposited_credits(credits)
+        for nft_tx_id in done:
+            found_user, msg = messages[nft_tx_id]
+            self.bot.notifier.dm(found_user.id, msg)
+        return done
+
+    def gas_trend(self, network: str) -> str:
+        trend = self.bot.gas_oracle.trend(network)
+        if trend is None or trend[2] < 60:
+            return ""
+        current, change, seconds = trend
+        arrow = "▲" if change > 0 else "▼" if change < 0 else "="
+        return "\n`{:,.2f}` gwei {} `{:+.1%}` over {} min".format(current, arrow, change, int(seconds // 60))
+
+    @tasks.loop(seconds=0.0)
+    async def credit_new_deposits(self):
+        await self.bot.wait_until_ready()
+        if not self.bot.leader.is_leader("deposits"):
+            # only the indexer of the leader pushes to the queue
+            await asyncio.sleep(5.0)
+            return
+        if not await self.bot.deposit_queue.wait(30.0):
+            return
+        # let the rest of an indexer run arrive
+        await asyncio.sleep(0.5)
+        gas, nft = self.bot.deposit_queue.take()
+        # hashes with something left to credit: not returned yet (confirmations...), no receipt, an error
+        left_gas = set(tx for _, tx in gas)
+        left_nft = set(tx for _, tx in nft)
+        try:
+            async with self._credit_lock():
+                pending_gas = await self.utils.get_confirmed_gas_tx_to_notify(list(left_gas))
+                credited = set(await self.credit_gas_deposits(pending_gas))
+                left_gas = (left_gas - set(each['hash'] for each in pending_gas)) | \
+                    set(each['hash'] for each in pending_gas if each['hash'] not in credited)
+                nft_hashes = list(left_nft)
+                pending_nft = await self.utils.get_confirmed_nft_tx_to_notify(nft_hashes) + \
+                    await self.utils.get_confirmed_nft1155_tx_to_notify(nft_hashes)
+                credited = set(await self.credit_nft_deposits(pending_nft))
+                left_nft = (left_nft - set(each['transaction_hash'] for each in pending_nft)) | \
+                    set(each['transaction_hash'] for each in pending_nft if each['nft_tx_id'] not in credited)
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+        # tried again a few seconds later, past `deposit.retry_attempts` the reconciliation sweep has them
+        deposit_config = self.bot.config.get('deposit', {})
+        retry_gas, retry_nft = self.bot.deposit_queue.give_back(
+            gas, nft, left_gas, left_nft, deposit_config.get('retry_attempts', 6)
+        )
+        if len(retry_gas) > 0 or len(retry_nft) > 0:
+            asyncio.get_running_loop().call_later(
+                deposit_config.get('retry_delay', 5.0), self.bot.deposit_queue.push, retry_gas, retry_nft
+            )
 
-                    crediting = (
-                        each['network'], each['token_address'],
-                        each['token_id_int'], each['token_id_hex'], each['discord_id'], 
-                        each['user_server'], amount
-                    )
+    # reconciliation sweeps: catch what never went through `bot.deposit_queue` (not verified yet, restarts...)
+    @tasks.loop(seconds=20.0)
+    async def check_notify_deposit_gas(self):
+        await self.bot.wait_until_ready()
+        if not self.bot.leader.is_leader("deposits"):
+            return
+        async with self._credit_lock():
+            pending_gas = await self.utils.get_confirmed_gas_tx_to_notify()
+            if len(pending_gas) > 0:
+                await self.credit_gas_deposits(pending_gas)
 
-                    check_tx = await eth_get_tx_info(url, each['transaction_hash'], 8)
-                    status = "CONFIRMED"
-                    if check_tx and 'status' in check_tx and int(check_tx['status'], 16) == 0:
-                        status = "FAILED" # leave it there
-                        continue # skip failed tx
-                    else:
-                        msg = "You have deposited `{}` of `{}` with tx `{}` from address: `{}` at height `{}` " \
-                              "on network `{}`.".format(each['amount'], name, each['transaction_hash'],
-                                                        each['from_address'], each['block_number'], each['network']
-                                                        )
-                        if each['user_server'] == self.bot.server_bot and each['discord_id'].isdigit():
-                            found_user = self.bot.get_user(int(each['discord_id']))
-                            if found_user:
-                                try:
-                                    await found_user.send(msg)
-                                except Exception:
-                                    traceback.print_exc(file=sys.stdout)
-                                await self.utils.insert_nft_deposited_credits(
-                                    each['discord_id'], each['user_server'], 
-                                    eth_token, matic_token, crediting, each['nft_tx_id'])
-                except Exception:
-                    traceback.print_exc(file=sys.stdout)
+    @tasks.loop(seconds=20.0)
+    async def check_notify_deposit_nft(self):
+        await self.bot.wait_until_ready()
+        if not self.bot.leader.is_leader("deposits"):
+            return
+        async with self._credit_lock():
+            # ERC721
+            pending_nft = await self.utils.get_confirmed_nft_tx_to_notify()
+            if len(pending_nft) > 0:
+                await self.credit_nft_deposits(pending_nft)
+            # ERC1155
+            pending_nft = await self.utils.get_confirmed_nft1155_tx_to_notify()
+            if len(pending_nft) > 0:
+                await self.credit_nft_deposits(pending_nft)
 
     @tasks.loop(seconds=20.0)
     async def check_pending_withdraw_gas(self):
         await self.bot.wait_until_ready()
+        if not self.bot.leader.is_leader("deposits"):
+            return
         pending_tx = await self.utils.get_pending_withdraw_tx_list_all()
         if len(pending_tx) > 0:
+            receipts = await self.utils.get_tx_receipts([(each['network'], each['withdrew_tx']) for each in pending_tx])
+            rebroadcast = {}
+            settled = []
+            messages = {}
             for each in pending_tx:
                 try:
-                    url = self.bot.config['endpoint'][each['network'].lower()]
                     coin_decimal = self.bot.config['gas_decimal'][each['network'].lower()]
                     if each['network'] == "ETHEREUM":
                         coin = "ETH"
@@ -564,9 +606,16 @@ class Deposit(commands.Cog):
                         coin = "MATIC"
                     else:
                         continue
-                    check_tx = await eth_get_tx_info(url, each['withdrew_tx'], 8)
+                    check_tx = receipts.get((each['network'], each['withdrew_tx']))
                     status = "CONFIRMED"
                     if check_tx is None:
+                        # not mined yet, send it again in case a node dropped it (and left a nonce gap)
+                        if each['withdrew_raw_tx'] is not None and \
+                                int(time.time()) - each['withdrew_date'] > \
+                                self.bot.config['withdraw'].get('rebroadcast_after', 180):
+                            rebroadcast[each['withdrew_tx']] = (
+                                each['network'], SentTx(each['withdrew_tx'], each['withdrew_nonce'], each['withdrew_raw_tx'])
+                            )
                         continue
 
                     if check_tx and 'status' in check_tx and int(check_tx['status'], 16) == 0:
@@ -584,28 +633,87 @@ class Deposit(commands.Cog):
                     elif each['network'] == "POLYGON":
                         matic_gas = real_tx_fee
                         matic_nft_tx = 1
-                    await self.utils.update_withdraw_pending_tx(
+                    settled.append((
                         each['withdraw_id'], each['withdrew_tx'], status,
                         int(check_tx['effectiveGasPrice'], 16), int(check_tx['gasUsed'], 16), real_tx_fee,
                         eth_gas, matic_gas, each['user_id'], each['user_server'],
                         eth_nft_tx, matic_nft_tx
+                    ))
+                    messages[each['withdraw_id']] = (
+                        each, "Your withdraw of tx hash `{}` is *{}*. Fee {:,.6f} {}.".format(
+                            each['withdrew_tx'], status, real_tx_fee, coin
+                        )
                     )
-                    msg = "Your withdraw of tx hash `{}` is *{}*. Fee {:,.6f} {}.".format(
-                        each['withdrew_tx'], status, real_tx_fee, coin
-                    )
-                    if each['user_server'] == self.bot.server_bot and each['user_id'].isdigit():
-                        found_user = self.bot.get_user(int(each['user_id']))
-                        if found_user:
-                            try:
-                                await found_user.send(msg)
-                            except Exception:
-                                traceback.print_exc(file=sys.stdout)
                 except Exception:
                     traceback.print_exc(file=sys.stdout)
+            cancelled = set()
+            # only kept for withdrawals still PENDING
+            pending_hashes = set(each['withdrew_tx'] for each in pending_tx)
+            for txn in list(self.bot.withdraw.nonce_used.keys()):
+                if txn not in pending_hashes:
+                    del self.bot.withdraw.nonce_used[txn]
+            if len(rebroadcast) > 0:
+                statuses = await asyncio.gather(*[
+                    self.bot.withdraw.rebroadcast(network, sent_tx) for network, sent_tx in rebroadcast.values()
+                ])
+                # "nonce too low" is most often this very tx mined, with a node behind on its receipt. Only
+                # cancelled once another tx surely took the nonce, the NFT would be withdrawn twice otherwise.
+                nonce_used = [
+                    (network, sent_tx)
+                    for (network, sent_tx), status in zip(rebroadcast.values(), statuses) if status == NONCE_USED
+                ]
+                if len(nonce_used) > 0:
+                    receipts = await self.utils.get_tx_receipts([
+                        (network, sent_tx.tx_hash) for network, sent_tx in nonce_used
+                    ])
+                    for network, sent_tx in nonce_used:
+                        txn = sent_tx.tx_hash
+                        mined = receipts.get((network, txn)) is not None
+                        if not await self.bot.withdraw.nonce_taken(network, sent_tx, mined):
+                            # told once, when its nonce is first seen confirmed without the receipt
+                            if not mined and self.bot.withdraw.nonce_used.get(txn) == 1:
+                                await self.utils.log_to_channel(
+                                    self.bot.config['discord']['log_channel'],
+                                    f"[WITHDRAW] {network} tx `{txn}` nonce `{sent_tx.nonce}` is mined but the tx "
+                                    f"has no receipt, kept PENDING until it is sure another tx took it."
+                                )
+                            continue
+                        await self.utils.log_to_channel(
+                            self.bot.config['discord']['log_channel'],
+                            f"[WITHDRAW] {network} tx `{txn}` nonce `{sent_tx.nonce}` was taken by another tx, "
+                            f"cancelling it."
+                        )
+                        for each in await self.utils.cancel_withdraw(network, txn):
+                            cancelled.add(each['withdraw_id'])
+                            messages[each['withdraw_id']] = (
+                                each, "Your withdraw of tx hash `{}` was *REJECTED*, the NFT is credited back.".format(
+                                    txn
+                                )
+                            )
+            # nonces of what is still waiting, a gap below them holds them all in the node's queue
+            pending_nonces = {}
+            settled_ids = set(each[0] for each in settled)
+            for each in pending_tx:
+                if each['withdrew_nonce'] is not None and each['withdraw_id'] not in settled_ids \
+                        and each['withdraw_id'] not in cancelled:
+                    pending_nonces.setdefault(each['network'], set()).add(each['withdrew_nonce'])
+            await self.bot.withdraw.fill_nonce_gaps(pending_nonces)
+            # settled in one transaction per cycle, users are told once it is written
+            notify = list(cancelled)
+            if len(settled) > 0:
+                notify += await self.utils.update_withdraw_pending_txs(settled)
+            for withdraw_id in notify:
+                each, msg = messages[withdraw_id]
+                if each['user_server'] == self.bot.server_bot and each['user_id'].isdigit():
+                    found_user = self.bot.get_user(int(each['user_id']))
+                    if found_user:
+                        self.bot.notifier.dm(found_user.id, msg)
 
     @tasks.loop(seconds=20.0)
     async def check_pending_erc1155_tx(self):
         await self.bot.wait_until_ready()
+        if not self.bot.leader.is_leader("deposits"):
+            return
         pending_tx = await self.utils.get_nft_erc1155_unverified_tx()
         if len(pending_tx) > 0:
             # get list saved tx
@@ -661,6 +769,8 @@ class Deposit(commands.Cog):
 
     @commands.Cog.listener()
     async def on_ready(self):
+        if not self.credit_new_deposits.is_running():
+            self.credit_new_deposits.start()
         if not self.check_notify_deposit_gas.is_running():
             self.check_notify_deposit_gas.start()
         if not self.check_notify_deposit_nft.is_running():
@@ -672,6 +782,8 @@ class Deposit(commands.Cog):
             self.check_pending_erc1155_tx.start()
 
     async def cog_load(self) -> None:
+        if not self.credit_new_deposits.is_running():
+            self.credit_new_deposits.start()
         if not self.check_notify_deposit_gas.is_running():
             self.check_notify_deposit_gas.start()
         if not self.check_notify_deposit_nft.is_running():
@@ -683,6 +795,7 @@ class Deposit(commands.Cog):
             self.check_pending_erc1155_tx.start()
 
     async def cog_unload(self) -> None:
+        self.credit_new_deposits.cancel()
         self.check_notify_deposit_gas.cancel()
         self.check_notify_deposit_nft.cancel()
         self.check_pending_withdraw_gas.cancel()
@@ -12,28 +12,27 @@ class Events(commands.Cog):
     def __init__(self, bot: commands.Bot) -> None:
         self.bot: commands.Bot = bot
         self.utils = Utils(self.bot)
-        self.max_saving_message = 100
-        self.is_saving_message = False
-        self.message_id_list = []
+        self.flush_interval = self.bot.config.get('message', {}).get('flush_interval', 10.0)
+        self.backoff = 0
 
-    @tasks.loop(seconds=20.0)
+    @tasks.loop(seconds=0.0)
     async def process_saving_message(self):
-        time_lap = 10  # seconds
-        # Check if task recently run @bot_task_logs
-        await asyncio.sleep(time_lap)
-        if len(self.bot.message_list) > 0:
-            # saving_message
-            if self.is_saving_message is True:
+        # the only writer of `bot.message_buffer`
+        buffer = self.bot.message_buffer
+        await buffer.wait(self.flush_interval)
+        while True:
+            batch = buffer.take()
+            if len(batch) == 0:
                 return
-            else:
-                self.is_saving_message = True
-            try:
-                saving = await self.utils.insert_discord_message(list(set(self.bot.message_list)))
-                if saving > 0:
-                    self.bot.message_list = []
-            except Exception:
-                traceback.print_exc(file=sys.stdout)
-            self.is_saving_message = False
+            saving = await self.utils.insert_discord_message([row for _, row in batch])
+            if saving is None:
+                # MariaDB is slow or down: keep the rows and back off, the buffer drops the oldest past its size
+                buffer.put_back(batch)
+                self.backoff = min(self.backoff * 2 or 1, 60)
+                await asyncio.sleep(self.backoff)
+                return
+            self.backoff = 0
+            buffer.flushed(len(batch))
 
     @commands.Cog.listener()
     async def on_message(self, message):
@@ -46,28 +45,16 @@ class Events(commands.Cog):
 
         if hasattr(message, "channel") and \
             hasattr(message.channel, "id") and message.author.bot == False and message.author != self.bot.user:
-            if message.id not in self.message_id_list:
-                try:
-                    self.bot.message_list.append((str(message.guild.id), message.guild.name, str(message.channel.id),
-                                                  message.channel.name, str(message.author.id),
-                                                  "{}#{}".format(message.author.name, message.author.discriminator),
-                                                  str(message.id), int(time.time())))
-                    self.message_id_list.append(message.id)
-                except Exception:
-                    pass
-            if len(self.bot.message_list) >= self.max_saving_message:
-                # saving_message
-                if self.is_saving_message is True:
-                    return
-                else:
-                    self.is_saving_message = True
-                try:
-                    saving = await self.utils.insert_discord_message(list(set(self.bot.message_list)))
-                    if saving > 0:
-                        self.bot.message_list = []
-                except Exception:
-                    traceback.print_exc(file=sys.stdout)
-                self.is_saving_message = False
+            try:
+                self.bot.message_buffer.add(
+                    message.id,
+                    (str(message.guild.id), message.guild.name, str(message.channel.id),
+                     message.channel.name, str(message.author.id),
+                     "{}#{}".format(message.author.name, message.author.discriminator),
+                     str(message.id), int(time.time()))
+                )
+            except Exception:
+                pass
 
     @commands.Cog.listener()
     async def on_message_delete(self, message):
@@ -80,23 +67,14 @@ class Events(commands.Cog):
 
         if hasattr(message, "channel") and \
             hasattr(message.channel, "id") and message.author.bot == False and message.author != self.bot.user:
-            if message.id in self.message_id_list:
-                self.is_saving_message = True
-                # saving_message
-                try:
-                    saving = await self.utils.insert_discord_message(list(set(self.bot.message_list)))
-                    if saving > 0:
-                        self.bot.message_list = []
-                except Exception:
-                    traceback.print_exc(file=sys.stdout)
-                self.is_saving_message = False
+            # not written yet: just don't write it
+            if self.bot.message_buffer.discard(message.id):
+                return
             # Try delete from database
-            self.is_saving_message = True
             try:
                 await self.utils.delete_discord_message(str(message.id), str(message.author.id))
             except Exception:
                 traceback.print_exc(file=sys.stdout)
-            self.is_saving_message = False
 
     @commands.Cog.listener()
     async def on_guild_join(self, guild):
@@ -66,10 +66,9 @@ class Tip(commands.Cog):
             )
             return
 
-        get_user_info = await self.utils.get_user_info(str(interaction.user.id), self.bot.server_bot)
+        get_user_info = await self.utils.get_user_session(str(interaction.user.id), self.bot.server_bot, fresh=True)
         if get_user_info is None:
             await interaction.edit_original_response(content=self.bot.first_message)
-            await self.utils.insert_user_info(str(interaction.user.id), self.bot.server_bot, 1)
             return
         else:
             if get_user_info['is_frozen'] == 1:
@@ -77,7 +76,6 @@ class Tip(commands.Cog):
                     content=f"{interaction.user.mention}, please contact Bot's dev. Your account is currently locked."
                 )
                 return
-        await self.utils.insert_user_info(str(interaction.user.id), self.bot.server_bot, 1)
 
         if member.id == interaction.user.id:
             await interaction.edit_original_response(
@@ -94,7 +92,7 @@ class Tip(commands.Cog):
             return
         else:
             # check if receiver has record
-            get_receiver_info = await self.utils.get_user_info(str(member.id), self.bot.server_bot)
+            get_receiver_info = await self.utils.get_user_info(str(member.id), self.bot.server_bot, fresh=True)
             if get_receiver_info is None:
                 await interaction.edit_original_response(
                     content=f"{interaction.user.mention}, User {member.mention} is not in our database yet."
@@ -136,10 +134,9 @@ class Tip(commands.Cog):
         """ /nftip <member> <item id> <collection> """
         await interaction.response.send_message(f"{interaction.user.mention} loading tip...")
 
-        get_user_info = await self.utils.get_user_info(str(interaction.user.id), self.bot.server_bot)
+        get_user_info = await self.utils.get_user_session(str(interaction.user.id), self.bot.server_bot, fresh=True)
         if get_user_info is None:
             await interaction.edit_original_response(content=self.bot.first_message)
-            await self.utils.insert_user_info(str(interaction.user.id), self.bot.server_bot, 1)
             return
         else:
             if get_user_info['is_frozen'] == 1:
@@ -147,7 +144,6 @@ class Tip(commands.Cog):
                     content=f"{interaction.user.mention}, please contact Bot's dev. Your account is currently locked."
                 )
                 return
-        await self.utils.insert_user_info(str(interaction.user.id), self.bot.server_bot, 1)
 
         if member.id == interaction.user.id:
             await interaction.edit_original_response(
@@ -157,8 +153,10 @@ class Tip(commands.Cog):
 
         try:
             amount = 1 # can change later if tip more than 1
-            # check if he's still own it when tipping
-            list_user_assets = await self.utils.get_list_user_assets(str(interaction.user.id), self.bot.server_bot)
+            # check if he's still own it when tipping, from the database: another process may have moved it
+            list_user_assets = await self.utils.get_list_user_assets(
+                str(interaction.user.id), self.bot.server_bot, fresh=True
+            )
             if len(list_user_assets) == 0:
                 await interaction.edit_original_response(
                     content=f"{interaction.user.mention}, you don't own any NFT."
@@ -215,18 +213,17 @@ class Tip(commands.Cog):
         interaction: discord.Interaction,
         current: str
     ) -> List[app_commands.Choice[str]]:
-        # Do stuff with the "current" parameter, e.g. querying it search results...
+        # Only collections the user owns, ranked from the in-memory index
         list_user_assets = await self.utils.get_list_user_assets(str(interaction.user.id), self.bot.server_bot)
-        collectin_list = []
-        collectin_list_ids = []
         if len(list_user_assets) > 0:
+            collection_ids = set()
             for each in list_user_assets:
-                if str(each['contract_id']) not in collectin_list_ids:
-                    collectin_list.append(each['collection_name'])
-                    collectin_list_ids.append(str(each['contract_id']))
+                collection_ids.add(each['contract_id'])
+                if each['contract_id'] not in self.bot.search_index.collections:
+                    self.bot.search_index.collections.add(each['contract_id'], each['collection_name'])
             return [
-                app_commands.Choice(name=item, value=collectin_list_ids[collectin_list.index(item)])
-                for item in collectin_list if current.lower() in item.lower()
+                app_commands.Choice(name=name, value=str(contract_id))
+                for contract_id, name, _ in self.bot.search_index.collections.search(current, 25, allowed=collection_ids)
             ]
         else:
             collectin_list = ["N/A"]
@@ -242,23 +239,20 @@ class Tip(commands.Cog):
         current: str
     ) -> List[app_commands.Choice[str]]:
         # Do stuff with the "current" parameter, e.g. querying it search results...
-        list_user_assets = await self.utils.get_list_user_assets_search(
-            str(interaction.user.id), self.bot.server_bot, current, 10
+        list_user_assets = await self.utils.search_user_assets(
+            str(interaction.user.id), self.bot.server_bot, current, 25
         )
-        item_list = []
-        asset_ids = []
-        uniq_set = []
         if len(list_user_assets) > 0:
-            for each in list_user_assets:
-                if each['contract'].lower() + each['token_id_hex'] + each['network'] not in uniq_set:
-                    item_list.append(each['name'])
-                    asset_ids.append(str(each['nft_id']))
+            return [
+                app_commands.Choice(name=each['name'], value=str(each['nft_id']))
+                for each in list_user_assets
+            ]
         else:
             item_list = ["N/A"]
-        return [
-            app_commands.Choice(name=item, value=asset_ids[item_list.index(item)])
-            for item in item_list if current.lower() in item.lower()
-        ]
+            return [
+                app_commands.Choice(name=item, value=item)
+                for item in item_list if current.lower() in item.lower()
+            ]
 
     async def cog_load(self) -> None:
         pass
@@ -2,8 +2,6 @@ from discord.ext import commands, tasks
 import discord
 from discord.enums import ButtonStyle
 
-import aiomysql
-from aiomysql.cursors import DictCursor
 from typing import Dict, Callable, List, Optional
 import traceback, sys
 import aiohttp, asyncio
@@ -13,8 +11,12 @@ from decimal import Decimal
 import math
 
 from eth_utils import is_hex_address # Check hex only
-from web3 import Web3
-from web3.middleware import geth_poa_middleware
+
+from rpc import RPCClient, RPCError
+from gas_oracle import GasSample
+from metrics import instrument_methods
+from search_index import asset_key
+from settings import VERSION_NAME
 
 # https://stackoverflow.com/questions/287871/how-do-i-print-colored-text-to-the-terminal
 
@@ -42,159 +44,79 @@ def truncate(number, digits) -> float:
     stepper = Decimal(pow(10.0, digits))
     return math.trunc(stepper * Decimal(number)) / stepper
 
+def chunks(rows, size: int):
+    """ Split an iterable into lists of at most `size`, without building the whole list first. """
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
 def check_address(address: str):
     if is_hex_address(address):
         return address
     return False
 
-async def transfer_main_token(url: str, from_address: str, private_key, to_address: str, atomic_amount: int, chain_id: int):
-    try:
-        # HTTPProvider:
-        w3 = Web3(Web3.HTTPProvider(url))
-
-        # inject the poa compatibility middleware to the innermost layer
-        w3.middleware_onion.inject(geth_poa_middleware, layer=0)
-
-        nonce = w3.eth.getTransactionCount(w3.toChecksumAddress(from_address))
-        gasPrice = w3.eth.gasPrice
-        estimateGas = w3.eth.estimateGas(
-            {
-                'to': w3.toChecksumAddress(to_address),
-                'from': w3.toChecksumAddress(from_address),
-                'value':  atomic_amount
-            }
-        )
-        transaction = {
-                'from': w3.toChecksumAddress(from_address),
-                'to': w3.toChecksumAddress(to_address),
-                'value': atomic_amount,
-                'nonce': nonce,
-                'gasPrice': gasPrice,
-                'gas': estimateGas,
-                'chainId': chain_id
-        }
-        signed = w3.eth.account.sign_transaction(transaction, private_key=private_key)
-        sent_tx = w3.eth.sendRawTransaction(signed.rawTransaction)
-        if signed and sent_tx:
-            return sent_tx.hex()
-    except Exception as e:
-        traceback.print_exc(file=sys.stdout)
-    return None
-
-
-async def transfer_nft(
-        url: str, contract_type: str, contract: str, abi, from_address: str,
-        to_address: str, private_key, item_id, chain_id: int, amount: int=1
+async def eth_get_tx_info(
+        rpc: RPCClient, tx: str, timeout: int = 64
 ):
     try:
-        # HTTPProvider:
-        w3 = Web3(Web3.HTTPProvider(url))
-
-        # inject the poa compatibility middleware to the innermost layer
-        w3.middleware_onion.inject(geth_poa_middleware, layer=0)
-
-        unicorns = w3.eth.contract(address=w3.toChecksumAddress(contract), abi=abi)
-        nonce = w3.eth.getTransactionCount(w3.toChecksumAddress(from_address))
-
-        if contract_type == "ERC721":
-            estimateGas = unicorns.functions.transferFrom(w3.toChecksumAddress(from_address), w3.toChecksumAddress(to_address), item_id).estimateGas({'from': w3.toChecksumAddress(from_address)})
-            unicorn_txn = unicorns.functions.transferFrom(w3.toChecksumAddress(from_address), w3.toChecksumAddress(to_address), item_id).buildTransaction(
-                {
-                    'from': w3.toChecksumAddress(from_address),
-                    'gasPrice': w3.eth.gasPrice,
-                    'gas': estimateGas,
-                    'nonce': nonce,
-                    'chainId': chain_id
-                }
-            )
-        elif contract_type == "ERC1155":
-            estimateGas = unicorns.functions.safeTransferFrom(w3.toChecksumAddress(from_address), w3.toChecksumAddress(to_address), item_id, amount, "").estimateGas({'from': w3.toChecksumAddress(from_address)})
-            unicorn_txn = unicorns.functions.safeTransferFrom(w3.toChecksumAddress(from_address), w3.toChecksumAddress(to_address), item_id, amount, "").buildTransaction(
-                {
-                    'from': w3.toChecksumAddress(from_address),
-                    'gasPrice': w3.eth.gasPrice,
-                    'gas': estimateGas,
-                    'nonce': nonce,
-                    'chainId': chain_id
-                }
-            )
-        signed_txn = w3.eth.account.sign_transaction(unicorn_txn, private_key=private_key)
-        sent_tx = w3.eth.sendRawTransaction(signed_txn.rawTransaction)
-        if sent_tx is not None:
-            return sent_tx.hex() # hex
+        return await rpc.call("eth_getTransactionReceipt", [tx], timeout)
+    except RPCError as e:
+        print('RPC: {} get receipt of {} {}'.format(rpc.url, tx, e))
     except Exception as e:
         traceback.print_exc(file=sys.stdout)
     return None
 
-async def eth_get_tx_info(
-        url: str, tx: str, timeout: int = 64
+async def eth_get_tx_receipts(
+        rpc: RPCClient, txs: List[str], timeout: int = 64, chunk_size: int = 50, concurrency: int = 4
 ):
-    data = '{"jsonrpc":"2.0", "method": "eth_getTransactionReceipt", "params":["' + tx + '"], "id":1}'
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, headers={'Content-Type': 'application/json'}, json=json.loads(data),
-                                    timeout=timeout) as response:
-                if response.status == 200:
-                    res_data = await response.read()
-                    res_data = res_data.decode('utf-8')
-                    await session.close()
-                    decoded_data = json.loads(res_data)
-                    if decoded_data and 'result' in decoded_data:
-                        return decoded_data['result']
-    except asyncio.TimeoutError:
-        print('TIMEOUT: {} get block number {}s'.format(url, timeout))
-    except Exception as e:
-        traceback.print_exc(file=sys.stdout)
-    return None
+    """
+    Receipts of many txs, tx => receipt (None while pending or on error). Sent as JSON-RPC batches of
+    `chunk_size`, at most `concurrency` at once; a failed batch only loses its own receipts.
+    """
+    if len(txs) == 0:
+        return {}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(chunk):
+        async with semaphore:
+            try:
+                return dict(zip(chunk, await rpc.batch([("eth_getTransactionReceipt", [tx]) for tx in chunk], timeout)))
+            except RPCError as e:
+                print('RPC: {} get {} receipts {}'.format(rpc.url, len(chunk), e))
+            except Exception as e:
+                traceback.print_exc(file=sys.stdout)
+            return {}
+
+    receipts = {}
+    for each in await asyncio.gather(*[fetch(chunk) for chunk in chunks(txs, chunk_size)]):
+        receipts.update(each)
+    return receipts
 
 async def eth_wallet_getbalance(
-        url: str, address: str, contract: str=None, is_gas: bool=False
+        rpc: RPCClient, address: str, contract: str=None, is_gas: bool=False
 ) -> int:
     timeout = 16
-    if is_gas is True:
-        data = '{"jsonrpc":"2.0","method":"eth_getBalance","params":["'+address+'", "latest"],"id":1}'
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, headers={'Content-Type': 'application/json'}, json=json.loads(data), timeout=timeout) as response:
-                    if response.status == 200:
-                        res_data = await response.read()
-                        res_data = res_data.decode('utf-8')
-                        await session.close()
-                        decoded_data = json.loads(res_data)
-                        if decoded_data and 'result' in decoded_data:
-                            return int(decoded_data['result'], 16)
-        except asyncio.TimeoutError:
-            print('TIMEOUT: get balance {} timeout {}s'.format(address, timeout))
-        except Exception as e:
-            traceback.print_exc(file=sys.stdout)
-    else:
-        data = {
-            "jsonrpc": "2.0",
-            "method": "eth_call",
-            "params": [
-                {"to": "'+contract+'", "data": "0x70a08231000000000000000000000000'+address[2:]+'"}, "latest"
-            ],
-            "id": 1}
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                        url, headers={'Content-Type': 'application/json'}, json=data, timeout=timeout
-                ) as response:
-                    if response.status == 200:
-                        res_data = await response.read()
-                        res_data = res_data.decode('utf-8')
-                        await session.close()
-                        decoded_data = json.loads(res_data)
-                        if decoded_data and 'result' in decoded_data:
-                            if decoded_data['result'] == "0x":
-                                balance = 0
-                            else:
-                                balance = int(decoded_data['result'], 16)
-                            return balance
-        except asyncio.TimeoutError:
-            print('TIMEOUT: get balance {} timeout {}s'.format(address, timeout))
-        except Exception as e:
-            traceback.print_exc(file=sys.stdout)
+    try:
+        if is_gas is True:
+            return int(await rpc.call("eth_getBalance", [address, "latest"], timeout), 16)
+        else:
+            # balanceOf(address)
+            result = await rpc.call(
+                "eth_call", [{"to": contract, "data": "0x70a08231000000000000000000000000" + address[2:]}, "latest"],
+                timeout
+            )
+            if result == "0x":
+                return 0
+            return int(result, 16)
+    except RPCError as e:
+        print('RPC: get balance {} {}'.format(address, e))
+    except Exception as e:
+        traceback.print_exc(file=sys.stdout)
     return None
 
 
@@ -359,27 +281,16 @@ class Utils(commands.Cog):
         self.pool = None
 
     async def log_to_channel(self, channel_id: int, content: str) -> None:
+        # sent in the background by `bot.notifier`, falls back to the backup channel
         try:
-            channel = self.bot.get_channel(channel_id)
-            if channel:
-                try:
-                    await channel.send(content)
-                except Exception as e:
-                    channel = self.bot.get_channel(self.bot.config['discord']['log_channel_backup']) # Use channel backup
-                    if channel:
-                        await channel.send(content)
-            else:
-                print(f"Bot can't find channel {str(channel_id)} for logging. Check for the backup channel.")
-                channel = self.bot.get_channel(self.bot.config['discord']['log_channel_backup']) # Use channel backup
-                if channel:
-                    await channel.send(content)
-                else:
-                    print(f"Bot can't find channel {str(channel_id)} for logging and no backup channel!")
+            self.bot.notifier.channel(channel_id, content)
         except Exception as e:
             traceback.print_exc(file=sys.stdout)
 
     @tasks.loop(seconds=60.0)
     async def pull_eth_gas_price(self):
+        if not self.bot.leader.is_leader("gas_price"):
+            return
         url = 'https://api.etherscan.io/api?module=gastracker&action=gasoracle&apikey=' + self.bot.config['etherscan']['api_key']
         try:
             # print(f"pulling gas data {url}")
@@ -400,7 +311,7 @@ class Utils(commands.Cog):
                             if gas_data and int(gas_data['SafeGasPrice']) and int(gas_data['ProposeGasPrice']) and\
                                     int(gas_data['FastGasPrice']):
                                 gas_data['last_update'] = int(time.time())
-                                await self.update_eth_gas_tracker(json.dumps(gas_data))
+                                await self.update_eth_gas_tracker(gas_data)
         except asyncio.TimeoutError:
             print('TIMEOUT: pull_gas_price for {}s'.format(self.bot.config['etherscan']['gas_fetch_timeout']))
         except Exception as e:
@@ -408,6 +319,8 @@ class Utils(commands.Cog):
 
     @tasks.loop(seconds=60.0)
     async def pull_matic_gas_price(self):
+        if not self.bot.leader.is_leader("gas_price"):
+            return
         url = 'https://gasstation-mainnet.matic.network/'
         try:
             timeout=12
@@ -426,20 +339,18 @@ class Utils(commands.Cog):
                         if gas_data:
                             # OK, we have result
                             gas_data['last_update'] = int(time.time())
-                            await self.update_matic_gas_tracker(json.dumps(gas_data))
+                            await self.update_matic_gas_tracker(gas_data)
         except asyncio.TimeoutError:
             print('TIMEOUT: pull_matic_gas_price for {}s'.format(timeout))
         except Exception as e:
             traceback.print_exc(file=sys.stdout)
 
     async def openConnection(self):
+        # All cogs share the bot-wide pool created in Bot.py
         try:
             if self.pool is None:
-                self.pool = await aiomysql.create_pool(
-                    host=self.bot.config['mysql']['host'], port=3306, minsize=2, maxsize=4,
-                    user=self.bot.config['mysql']['user'], password=self.bot.config['mysql']['password'],
-                    db=self.bot.config['mysql']['db'], cursorclass=DictCursor, autocommit=True
-                )
+                await self.bot.db.open()
+                self.pool = self.bot.db
         except Exception:
             traceback.print_exc(file=sys.stdout)
 
@@ -475,6 +386,48 @@ class Utils(commands.Cog):
             traceback.print_exc(file=sys.stdout)
         return []
 
+    async def reserve_withdraw_nonce(self, network: str, chain_nonce: int):
+        """
+        Next hot wallet nonce of `network` for every process of the cluster: the stored one, or `chain_nonce`
+        (the node's pending count) when the wallet was used from elsewhere. Raises on DB errors.
+        """
+        await self.openConnection()
+        async with self.pool.acquire() as conn:
+            await conn.begin()
+            try:
+                async with conn.cursor() as cur:
+                    # a concurrent reserve waits here until this one commits
+                    sql = """ SELECT `next_nonce` FROM `nft_withdraw_nonce` WHERE `network`=%s FOR UPDATE """
+                    await cur.execute(sql, network)
+                    result = await cur.fetchone()
+                    nonce = chain_nonce if result is None else max(result['next_nonce'], chain_nonce)
+                    sql = """ INSERT INTO `nft_withdraw_nonce` (`network`, `next_nonce`, `updated_date`)
+                    VALUES (%s, %s, %s)
+                    ON DUPLICATE KEY UPDATE `next_nonce`=VALUES(`next_nonce`), `updated_date`=VALUES(`updated_date`)
+                    """
+                    await cur.execute(sql, (network, nonce + 1, int(time.time())))
+                await conn.commit()
+                return nonce
+            except Exception:
+                await conn.rollback()
+                raise
+
+    async def release_withdraw_nonce(self, network: str, nonce: int):
+        """ Give back a nonce never broadcast if no other was reserved after it. True if it was. """
+        try:
+            await self.openConnection()
+            async with self.pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    sql = """ UPDATE `nft_withdraw_nonce` SET `next_nonce`=%s, `updated_date`=%s
+                    WHERE `network`=%s AND `next_nonce`=%s
+                    """
+                    await cur.execute(sql, (nonce, int(time.time()), network, nonce + 1))
+                    await conn.commit()
+                    return cur.rowcount > 0
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+        return False
+
     async def get_pending_withdraw_tx_list_by_id_user(
             self, user_id: str, user_server: str, network: str
     ):
@@ -494,40 +447,106 @@ class Utils(commands.Cog):
             traceback.print_exc(file=sys.stdout)
         return []
 
-    async def update_withdraw_pending_tx(
-            self, withdraw_id: int, txn: str, status: str,
-            effective_gas: int, gas_used: int, real_tx_fee: float,
-            eth_gas: float, matic_gas: float,
-            user_id: str, user_server: str,
-            eth_nft_tx: int, matic_nft_tx: int
-    ):
+    async def cancel_withdraw(self, network: str, txn: str):
+        """
+        A PENDING withdrawal that will never be mined (rejected by the node, or its nonce went to another tx):
+        mark it REJECTED and credit the NFT back. Returns the rows cancelled.
+        """
+        cancelled = []
         try:
             await self.openConnection()
             async with self.pool.acquire() as conn:
-                async with conn.cursor() as cur:
-                    sql = """ UPDATE `nft_withdraw`, `tbl_users`
-                      SET `nft_withdraw`.`withdrew_status`=%s, `nft_withdraw`.`withdrew_gas_price`=%s, 
-                      `nft_withdraw`.`withdrew_gas_used`=%s, `nft_withdraw`.`withdrew_tx_real_fee`=%s,
-                      `tbl_users`.`eth_gas`=`tbl_users`.`eth_gas`-%s, 
-                      `tbl_users`.`matic_gas`=`tbl_users`.`matic_gas`-%s, 
-                      `tbl_users`.`eth_nft_withdrew`=`tbl_users`.`eth_nft_withdrew`+%s,
-                      `tbl_users`.`matic_nft_withdrew`=`tbl_users`.`matic_nft_withdrew`+%s
-                    WHERE `nft_withdraw`.`withdrew_tx`=%s AND `nft_withdraw`.`withdraw_id`=%s
-                      AND `tbl_users`.`user_id`=%s AND `tbl_users`.`user_server`=%s
-                    """
-                    await cur.execute(sql, (
-                        status, effective_gas, gas_used, real_tx_fee, 
-                        eth_gas, matic_gas, 
-                        eth_nft_tx, matic_nft_tx,
-                        txn, withdraw_id, user_id, user_server
-                    ))
+                await conn.begin()
+                try:
+                    async with conn.cursor() as cur:
+                        sql = """ SELECT * FROM `nft_withdraw`
+                        WHERE `network`=%s AND `withdrew_tx`=%s AND `withdrew_status`=%s FOR UPDATE
+                        """
+                        await cur.execute(sql, (network, txn, "PENDING"))
+                        for each in await cur.fetchall():
+                            sql = """ UPDATE `nft_withdraw` SET `withdrew_status`=%s WHERE `withdraw_id`=%s;
+
+                            UPDATE `nft_credit`
+                                SET `amount`=`amount`+%s
+                            WHERE `token_address`=%s AND `network`=%s AND `token_id_hex`=%s
+                                AND `credited_user_id`=%s AND `credited_user_server`=%s;
+                            """
+                            await cur.execute(sql, (
+                                "REJECTED", each['withdraw_id'],
+                                each['amount'], each['token_address'], each['network'], each['token_id_hex'],
+                                each['user_id'], each['user_server']
+                            ))
+                            cancelled.append(each)
                     await conn.commit()
-                    return True
+                except Exception:
+                    await conn.rollback()
+                    raise
         except Exception:
             traceback.print_exc(file=sys.stdout)
-        return False
+            cancelled = []
+        finally:
+            for each in cancelled:
+                self.bot.asset_cache.invalidate(each['user_id'], each['user_server'])
+        return cancelled
+
+    async def update_withdraw_pending_txs(self, settled):
+        """
+        Settle confirmed/failed withdrawals of one cycle in a transaction, each row behind a savepoint like
+        `update_confirmed_gas_tx_notify`. `settled` rows are (withdraw_id, txn, status, effective_gas, gas_used,
+        real_tx_fee, eth_gas, matic_gas, user_id, user_server, eth_nft_tx, matic_nft_tx). Returns the
+        withdraw_ids settled, rows already settled or without a `tbl_users` row are skipped.
+        """
+        done = []
+        try:
+            await self.openConnection()
+            async with self.pool.acquire() as conn:
+                await conn.begin()
+                try:
+                    async with conn.cursor() as cur:
+                        for (withdraw_id, txn, status, effective_gas, gas_used, real_tx_fee, eth_gas, matic_gas,
+                             user_id, user_server, eth_nft_tx, matic_nft_tx) in settled:
+                            await cur.execute("SAVEPOINT `settle_row`")
+                            try:
+                                sql = """ UPDATE `nft_withdraw`
+                                  SET `withdrew_status`=%s, `withdrew_gas_price`=%s, `withdrew_gas_used`=%s,
+                                  `withdrew_tx_real_fee`=%s
+                                WHERE `withdrew_tx`=%s AND `withdraw_id`=%s AND `withdrew_status`=%s
+                                """
+                                await cur.execute(sql, (
+                                    status, effective_gas, gas_used, real_tx_fee, txn, withdraw_id, "PENDING"
+                                ))
+                                if cur.rowcount == 0:
+                                    continue
+                                if not await self._lock_user_row(cur, user_id, user_server):
+                                    print("WITHDRAW: no tbl_users row for {}/{}, withdraw #{} left".format(user_id, user_server, withdraw_id))
+                                    await cur.execute("ROLLBACK TO SAVEPOINT `settle_row`")
+                                    continue
+                                sql = """ UPDATE `tbl_users`
+                                  SET `eth_gas`=`eth_gas`-%s, `matic_gas`=`matic_gas`-%s,
+                                  `eth_nft_withdrew`=`eth_nft_withdrew`+%s, `matic_nft_withdrew`=`matic_nft_withdrew`+%s
+                                WHERE `user_id`=%s AND `user_server`=%s
+                                """
+                                await cur.execute(sql, (
+                                    eth_gas, matic_gas, eth_nft_tx, matic_nft_tx, user_id, user_server
+                                ))
+                                done.append(withdraw_id)
+                            except Exception:
+                                traceback.print_exc(file=sys.stdout)
+                                await cur.execute("ROLLBACK TO SAVEPOINT `settle_row`")
+                    await conn.commit()
+                    return done
+                except Exception:
+                    await conn.rollback()
+                    raise
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+        finally:
+            for each in settled:
+                self.bot.user_cache.invalidate(each[8], each[9])
+        return []
 
     async def get_bot_setting(self):
+        """ Load all of `bot_settings` into `bot.settings`. """
         try:
             await self.openConnection()
             async with self.pool.acquire() as conn:
@@ -537,74 +556,108 @@ class Utils(commands.Cog):
                     await cur.execute(sql)
                     result = await cur.fetchall()
                     if result:
-                        res = {}
-                        for each in result:
-                            res[each['name']] = each['value']
-                        self.bot.setting = res
+                        self.bot.settings.load(result)
+                        return self.bot.settings
         except Exception:
             traceback.print_exc(file=sys.stdout)
         return None
 
-    async def update_eth_gas_tracker(self, gas_result):
+    async def insert_gas_samples(self, samples, keep: float):
+        """ Store (network, GasSample) of this process and drop the ones older than `keep` seconds. """
         try:
             await self.openConnection()
             async with self.pool.acquire() as conn:
                 async with conn.cursor() as cur:
-                    sql = """ UPDATE `bot_settings`
-                    SET `value`=%s WHERE `name`=%s
-                    LIMIT 1
-                    """
-                    await cur.execute(sql, (gas_result, "eth_gas_tracker"))
+                    if len(samples) > 0:
+                        sql = """ INSERT IGNORE INTO `nft_gas_samples` (`network`, `sampled_at`, `base_fee`,
+                        `priority_fee`, `gas_price`) VALUES (%s, %s, %s, %s, %s) """
+                        await cur.executemany(sql, [(network,) + tuple(sample) for network, sample in samples])
+                    sql = """ DELETE FROM `nft_gas_samples` WHERE `sampled_at`<%s """
+                    await cur.execute(sql, time.time() - keep)
                     await conn.commit()
-                    await self.get_bot_setting()
                     return True
         except Exception:
             traceback.print_exc(file=sys.stdout)
         return False
 
-    async def update_matic_gas_tracker(self, gas_result):
+    async def get_gas_samples(self, limit: int):
+        """ {network: [GasSample]} of the newest `limit` samples per network, oldest first. """
+        samples = {}
         try:
             await self.openConnection()
             async with self.pool.acquire() as conn:
                 async with conn.cursor() as cur:
-                    sql = """ UPDATE `bot_settings`
-                    SET `value`=%s WHERE `name`=%s
-                    LIMIT 1
-                    """
-                    await cur.execute(sql, (gas_result, "matic_gas_tracker"))
-                    await conn.commit()
-                    await self.get_bot_setting()
-                    return True
+                    sql = """ SELECT * FROM `nft_gas_samples` ORDER BY `sampled_at` ASC """
+                    await cur.execute(sql)
+                    for each in await cur.fetchall():
+                        samples.setdefault(each['network'], []).append(GasSample(
+                            each['sampled_at'], each['base_fee'], each['priority_fee'], each['gas_price']
+                        ))
         except Exception:
             traceback.print_exc(file=sys.stdout)
-        return False
+        return {network: rows[-limit:] for network, rows in samples.items()}
 
-    async def get_list_contract_assets(self):
+    async def get_settings_version(self):
         try:
             await self.openConnection()
             async with self.pool.acquire() as conn:
                 async with conn.cursor() as cur:
-                    sql = """ SELECT * FROM `nft_item_list`
-                    """
-                    await cur.execute(sql)
-                    result = await cur.fetchall()
-                    if result:
-                        return result
+                    sql = """ SELECT `value` FROM `bot_settings` WHERE `name`=%s LIMIT 1 """
+                    await cur.execute(sql, VERSION_NAME)
+                    result = await cur.fetchone()
+                    return int(result['value'] or 0) if result else 0
         except Exception:
             traceback.print_exc(file=sys.stdout)
-        return []
+        return None
 
-    async def get_list_contract_collection_search(
-            self, like: str, limit: int = 20
-    ):
+    async def update_bot_setting(self, name: str, value) -> bool:
+        """ Write the setting `name` and bump `settings_version` in one transaction, then set `bot.settings`. """
+        try:
+            await self.openConnection()
+            async with self.pool.acquire() as conn:
+                await conn.begin()
+                try:
+                    async with conn.cursor() as cur:
+                        sql = """ UPDATE `bot_settings`
+                        SET `value`=%s WHERE `name`=%s
+                        LIMIT 1
+                        """
+                        await cur.execute(sql, (json.dumps(value), name))
+                        sql = """ UPDATE `bot_settings`
+                        SET `value`=CAST(`value` AS UNSIGNED)+1 WHERE `name`=%s
+                        LIMIT 1
+                        """
+                        await cur.execute(sql, VERSION_NAME)
+                        if cur.rowcount == 0:
+                            sql = """ INSERT INTO `bot_settings` (`name`, `value`) VALUES (%s, %s) """
+                            await cur.execute(sql, (VERSION_NAME, "1"))
+                        sql = """ SELECT `value` FROM `bot_settings` WHERE `name`=%s LIMIT 1 """
+                        await cur.execute(sql, VERSION_NAME)
+                        version = int((await cur.fetchone())['value'])
+                    await conn.commit()
+                except Exception:
+                    await conn.rollback()
+                    raise
+                self.bot.settings.set(name, value, version)
+                return True
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+        return False
+
+    async def update_eth_gas_tracker(self, gas_data: dict):
+        return await self.update_bot_setting("eth_gas_tracker", gas_data)
+
+    async def update_matic_gas_tracker(self, gas_data: dict):
+        return await self.update_bot_setting("matic_gas_tracker", gas_data)
+
+    async def get_list_contract_assets(self):
         try:
             await self.openConnection()
             async with self.pool.acquire() as conn:
                 async with conn.cursor() as cur:
-                    sql = """ 
-                    SELECT * FROM `nft_info_contract` 
-                    WHERE `is_enable`=%s AND `collection_name` LIKE %s LIMIT """+str(limit)
-                    await cur.execute(sql, (1, "%" + like + "%"))
+                    sql = """ SELECT * FROM `nft_item_list`
+                    """
+                    await cur.execute(sql)
                     result = await cur.fetchall()
                     if result:
                         return result
@@ -665,8 +718,13 @@ class Utils(commands.Cog):
         return None
 
     async def get_list_user_assets(
-            self, user_id: str, user_server: str
+            self, user_id: str, user_server: str, fresh: bool=False
     ):
+        """ NFTs credited to a user. `fresh` skips the cache, for the checks before moving them. """
+        cached = None if fresh else self.bot.asset_cache.get(user_id, user_server)
+        if cached is not None:
+            return list(cached)
+        generation = self.bot.asset_cache.generation(user_id, user_server)
         try:
             await self.openConnection()
             async with self.pool.acquire() as conn:
@@ -703,50 +761,7 @@ class Utils(commands.Cog):
                     result_1155 = await cur.fetchall()
                     if result_1155:
                         result += result_1155
-        except Exception:
-            traceback.print_exc(file=sys.stdout)
-        return result
-
-    async def get_list_user_assets_search(
-            self, user_id: str, user_server: str, like: str, limit: int = 10
-    ):
-        try:
-            await self.openConnection()
-            async with self.pool.acquire() as conn:
-                async with conn.cursor() as cur:
-                    result = []
-                    sql = """ 
-                        SELECT `nft_credit`.`nft_id`, `nft_credit`.`token_id_int`, `nft_credit`.`token_id_hex`, 
-                            `nft_credit`.`credited_user_id`, `nft_credit`.`credited_user_server`, 
-                            `nft_info_contract`.*, `nft_item_list`.*
-                        FROM ((`nft_credit`
-                        INNER JOIN `nft_info_contract` ON `nft_credit`.`token_address` = `nft_info_contract`.`contract`)
-                        INNER JOIN `nft_item_list` ON `nft_credit`.`token_id_hex` = `nft_item_list`.`asset_id_hex` 
-                            AND  `nft_credit`.`token_address` = `nft_item_list`.`contract`)
-                        WHERE `nft_credit`.`credited_user_id`=%s AND `nft_credit`.`credited_user_server`=%s
-                        AND `nft_credit`.`is_frozen`=%s AND `nft_credit`.`amount`>0 
-                            AND `nft_info_contract`.`is_enable`=1
-                            AND `nft_item_list`.`name` LIKE %s LIMIT """+str(limit)
-                    await cur.execute(sql, (user_id, user_server, 0, "%" + like + "%"))
-                    result_721 = await cur.fetchall()
-                    if result_721:
-                        result += result_721
-                    sql = """ 
-                        SELECT `nft_credit`.`nft_id`, `nft_credit`.`token_id_int`, `nft_credit`.`token_id_hex`, 
-                        `nft_credit`.`credited_user_id`, `nft_credit`.`credited_user_server`, 
-                        `nft_info_contract`.*, `nft_erc1155_list`.*
-                        FROM ((`nft_credit`
-                        INNER JOIN `nft_info_contract` ON `nft_credit`.`token_address` = `nft_info_contract`.`contract`)
-                        INNER JOIN `nft_erc1155_list` ON `nft_credit`.`token_id_hex` = `nft_erc1155_list`.`token_id_hex`
-                            AND  `nft_credit`.`token_address` = `nft_erc1155_list`.`token_address`)
-                        WHERE `nft_credit`.`credited_user_id`=%s AND `nft_credit`.`credited_user_server`=%s
-                        AND `nft_credit`.`is_frozen`=%s AND `nft_credit`.`amount`>0 
-                            AND `nft_info_contract`.`is_enable`=1
-                        AND `nft_erc1155_list`.`name` LIKE %s LIMIT """+str(limit)
-                    await cur.execute(sql, (user_id, user_server, 0, "%" + like + "%"))
-                    result_1155 = await cur.fetchall()
-                    if result_1155:
-                        result += result_1155
+                    self.bot.asset_cache.put(user_id, user_server, list(result), generation)
         except Exception:
             traceback.print_exc(file=sys.stdout)
         return result
@@ -756,52 +771,71 @@ class Utils(commands.Cog):
             to_user_id: str, to_user_server: str, token_id_int: int, token_id_hex: str,
             contract_id: int, amount: int
     ):
+        """ Tip `amount` of an NFT. False when the sender doesn't have that many credited anymore. """
         try:
             if from_user_id == to_user_id:
                 return False
             await self.openConnection()
             async with self.pool.acquire() as conn:
-                async with conn.cursor() as cur:
-                    sql = """ 
-                    UPDATE `nft_credit` 
-                        SET `amount`=`amount`-%s 
-                    WHERE `network`=%s AND `token_address`=%s 
-                        AND `credited_user_id`=%s AND `credited_user_server`=%s AND `token_id_hex`=%s;
-
-                    INSERT INTO `nft_credit` (`network`, `token_address`, `token_id_int`, `token_id_hex`, 
-                    `credited_user_id`, `credited_user_server`, `amount`)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
-                    ON DUPLICATE KEY
-                    UPDATE
-                        `amount`=VALUES(`amount`)+`amount`;
-                    
-                    INSERT INTO `nft_tip_logs` (`from_user_id`, `from_user_server`, `to_user_id`, 
-                    `to_user_server`, `date`, `nft_info_contract_id`, `token_id_int`, `token_id_hex`, `amount`)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s);
-
-                    INSERT INTO `tbl_users` (`inserted_date`, `user_id`, `user_server`, `total_tipped`)
-                    VALUES (%s, %s, %s, %s)
-                    ON DUPLICATE KEY
-                    UPDATE
-                        `total_tipped`=VALUES(`total_tipped`)+`total_tipped`;
-
-                    INSERT INTO `tbl_users` (`inserted_date`, `user_id`, `user_server`, `total_received`)
-                    VALUES (%s, %s, %s, %s)
-                    ON DUPLICATE KEY
-                    UPDATE
-                        `total_received`=VALUES(`total_received`)+`total_received`;
-                    """
-                    await cur.execute(sql, (
-                        amount, network, contract, from_user_id, from_user_server, token_id_hex,
-                        network, contract, token_id_int, token_id_hex, to_user_id, to_user_server, amount,
-                        from_user_id, from_user_server, to_user_id, to_user_server, int(time.time()), contract_id, token_id_int, token_id_hex, amount,
-                        int(time.time()), from_user_id, from_user_server, amount,
-                        int(time.time()), to_user_id, to_user_server, amount
-                    ))
+                await conn.begin()
+                try:
+                    async with conn.cursor() as cur:
+                        sql = """ 
+                        UPDATE `nft_credit` 
+                            SET `amount`=`amount`-%s 
+                        WHERE `network`=%s AND `token_address`=%s 
+                            AND `credited_user_id`=%s AND `credited_user_server`=%s AND `token_id_hex`=%s
+                            AND `amount`>=%s
+                        """
+                        await cur.execute(sql, (
+                            amount, network, contract, from_user_id, from_user_server, token_id_hex, amount
+                        ))
+                        if cur.rowcount == 0:
+                            # tipped or withdrawn meanwhile
+                            await conn.rollback()
+                            return False
+                        sql = """
+                        INSERT INTO `nft_credit` (`network`, `token_address`, `token_id_int`, `token_id_hex`, 
+                        `credited_user_id`, `credited_user_server`, `amount`)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s)
+                        ON DUPLICATE KEY
+                        UPDATE
+                            `amount`=VALUES(`amount`)+`amount`;
+                        
+                        INSERT INTO `nft_tip_logs` (`from_user_id`, `from_user_server`, `to_user_id`, 
+                        `to_user_server`, `date`, `nft_info_contract_id`, `token_id_int`, `token_id_hex`, `amount`)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s);
+
+                        INSERT INTO `tbl_users` (`inserted_date`, `user_id`, `user_server`, `total_tipped`)
+                        VALUES (%s, %s, %s, %s)
+                        ON DUPLICATE KEY
+                        UPDATE
+                            `total_tipped`=VALUES(`total_tipped`)+`total_tipped`;
+
+                        INSERT INTO `tbl_users` (`inserted_date`, `user_id`, `user_server`, `total_received`)
+                        VALUES (%s, %s, %s, %s)
+                        ON DUPLICATE KEY
+                        UPDATE
+                            `total_received`=VALUES(`total_received`)+`total_received`;
+                        """
+                        await cur.execute(sql, (
+                            network, contract, token_id_int, token_id_hex, to_user_id, to_user_server, amount,
+                            from_user_id, from_user_server, to_user_id, to_user_server, int(time.time()), contract_id, token_id_int, token_id_hex, amount,
+                            int(time.time()), from_user_id, from_user_server, amount,
+                            int(time.time()), to_user_id, to_user_server, amount
+                        ))
                     await conn.commit()
                     return True
+                except Exception:
+                    await conn.rollback()
+                    raise
         except Exception:
             traceback.print_exc(file=sys.stdout)
+        finally:
+            self.bot.user_cache.invalidate(from_user_id, from_user_server)
+            self.bot.user_cache.invalidate(to_user_id, to_user_server)
+            self.bot.asset_cache.invalidate(from_user_id, from_user_server)
+            self.bot.asset_cache.invalidate(to_user_id, to_user_server)
         return False
 
     async def move_gas(
@@ -835,33 +869,52 @@ class Utils(commands.Cog):
                     return True
         except Exception:
             traceback.print_exc(file=sys.stdout)
+        finally:
+            self.bot.user_cache.invalidate(from_user_id, from_user_server)
+            self.bot.user_cache.invalidate(to_user_id, to_user_server)
         return False
 
     async def transferred_nft(
             self, network: str, token_address: str, token_id_hex: str,
-            user_id: str, txn: str, user_server: str, withdrew_to: str, amount: int
+            user_id: str, txn: str, user_server: str, withdrew_to: str, amount: int,
+            nonce: int=None, raw_tx: str=None
     ):
+        """ Debit a withdrawal and record it PENDING. False when the user doesn't have `amount` credited anymore. """
         try:
             await self.openConnection()
             async with self.pool.acquire() as conn:
-                async with conn.cursor() as cur:
-                    sql = """
-                    UPDATE `nft_credit`
-                        SET `amount`=`amount`-%s 
-                    WHERE `token_address`=%s AND `network`=%s AND `token_id_hex`=%s AND `credited_user_id`=%s
-                        AND `credited_user_server`=%s;
-
-                    INSERT INTO `nft_withdraw` (`network`, `token_address`, `token_id_hex`, 
-                    `amount`, `user_id`, `user_server`, `withdrew_to`, `withdrew_tx`, `withdrew_status`, `withdrew_date`)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
-                    """
-                    await cur.execute(sql, (amount, token_address, network, token_id_hex, user_id, user_server,
-                                            network, token_address, token_id_hex, amount, user_id, user_server, 
-                                            withdrew_to, txn, "PENDING", int(time.time())))
+                await conn.begin()
+                try:
+                    async with conn.cursor() as cur:
+                        sql = """
+                        UPDATE `nft_credit`
+                            SET `amount`=`amount`-%s 
+                        WHERE `token_address`=%s AND `network`=%s AND `token_id_hex`=%s AND `credited_user_id`=%s
+                            AND `credited_user_server`=%s AND `amount`>=%s
+                        """
+                        await cur.execute(sql, (
+                            amount, token_address, network, token_id_hex, user_id, user_server, amount
+                        ))
+                        if cur.rowcount == 0:
+                            await conn.rollback()
+                            return False
+                        sql = """
+                        INSERT INTO `nft_withdraw` (`network`, `token_address`, `token_id_hex`, 
+                        `amount`, `user_id`, `user_server`, `withdrew_to`, `withdrew_tx`, `withdrew_nonce`,
+                        `withdrew_raw_tx`, `withdrew_status`, `withdrew_date`)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                        """
+                        await cur.execute(sql, (network, token_address, token_id_hex, amount, user_id, user_server, 
+                                                withdrew_to, txn, nonce, raw_tx, "PENDING", int(time.time())))
                     await conn.commit()
                     return True
+                except Exception:
+                    await conn.rollback()
+                    raise
         except Exception:
             traceback.print_exc(file=sys.stdout)
+        finally:
+            self.bot.asset_cache.invalidate(user_id, user_server)
         return False
 
     async def verification_check(self, user_id: str, user_server: str):
@@ -914,9 +967,17 @@ class Utils(commands.Cog):
                     return cur.rowcount
         except Exception:
             traceback.print_exc(file=sys.stdout)
+        finally:
+            self.bot.user_cache.invalidate(user_id, user_server)
         return 0
 
-    async def get_user_info(self, user_id: str, user_server: str):
+    async def get_user_info(self, user_id: str, user_server: str, fresh: bool=False):
+        """ `fresh` skips the cache, for money-moving paths which must see the current frozen status and gas. """
+        if fresh is False:
+            cached = self.bot.user_cache.get(user_id, user_server)
+            if cached is not None:
+                return cached
+        generation = self.bot.user_cache.generation(user_id, user_server)
         try:
             await self.openConnection()
             async with self.pool.acquire() as conn:
@@ -927,147 +988,519 @@ class Utils(commands.Cog):
                     await cur.execute(sql, (user_id, user_server))
                     result = await cur.fetchone()
                     if result:
+                        self.bot.user_cache.put(user_id, user_server, result, generation)
                         return result
         except Exception:
             traceback.print_exc(file=sys.stdout)
         return None
 
-    async def get_confirmed_gas_tx_to_notify(self):
+    async def get_user_session(self, user_id: str, user_server: str, fresh: bool=False):
+        """
+        User lookup at the start of a command. Returns the `tbl_users` row and counts the command, to be written
+        by `flush_user_commands`. A first time user is inserted and None is returned so the caller can
+        show `bot.first_message`.
+        """
+        user_info = await self.get_user_info(user_id, user_server, fresh)
+        if user_info is None:
+            await self.insert_user_info(user_id, user_server, 1)
+            return None
+        self.bot.user_cache.count_command(user_id, user_server)
+        return user_info
+
+    async def flush_user_commands(self):
+        pending = self.bot.user_cache.take_pending()
+        if len(pending) == 0:
+            return 0
         try:
             await self.openConnection()
             async with self.pool.acquire() as conn:
                 async with conn.cursor() as cur:
-                    sql = """ 
-                    SELECT `metamask_v1`.*, `nft_main_wallet_tx`.*
-                    FROM ((`metamask_v1`
-                    INNER JOIN `nft_main_wallet_tx` ON `metamask_v1`.`address` = `nft_main_wallet_tx`.`from_address`)
-                    INNER JOIN `tbl_users` ON `metamask_v1`.`discord_id` = `tbl_users`.`user_id`)
-                    WHERE `tbl_users`.`is_frozen`=0 AND `metamask_v1`.`is_signed`=1 AND `nft_main_wallet_tx`.`is_credited`=0
+                    sql = """
+                    UPDATE `tbl_users` SET `command_called`=`command_called`+%s, `is_first_time`=0
+                    WHERE `user_id`=%s AND `user_server`=%s LIMIT 1
                     """
-                    await cur.execute(sql)
-                    result = await cur.fetchall()
-                    if result:
-                        return result
+                    await cur.executemany(sql, [
+                        (count, user_id, user_server) for (user_id, user_server), count in pending.items()
+                    ])
+                    await conn.commit()
+                    self.bot.user_cache.flushed += len(pending)
+                    return len(pending)
         except Exception:
             traceback.print_exc(file=sys.stdout)
-        return []
+            self.bot.user_cache.restore_pending(pending)
+        return 0
 
-    async def get_confirmed_nft_tx_to_notify(self):
+    async def get_tx_receipts(self, network_txs):
+        """ Receipts of (network, tx) pairs, one JSON-RPC batch per network. Returns (network, tx) => receipt. """
+        by_network = {}
+        for network, tx in network_txs:
+            if network.lower() in self.bot.config['endpoint']:
+                by_network.setdefault(network, {})[tx] = True
+        networks = list(by_network.keys())
+        rpc_config = self.bot.config.get('rpc', {})
+        found = await asyncio.gather(*[
+            eth_get_tx_receipts(
+                self.bot.rpc.network(network), list(by_network[network].keys()), 8,
+                rpc_config.get('receipt_chunk', 50), rpc_config.get('receipt_concurrency', 4)
+            )
+            for network in networks
+        ])
+        receipts = {}
+        for network, each in zip(networks, found):
+            for tx, receipt in each.items():
+                receipts[(network, tx)] = receipt
+        return receipts
+
+    async def reload_address_book(self):
         try:
             await self.openConnection()
             async with self.pool.acquire() as conn:
                 async with conn.cursor() as cur:
-                    sql = """ 
-                    SELECT `metamask_v1`.*, `nft_main_wallet_nft_tx`.*, `nft_item_list`.`name`, `nft_item_list`.`contract`, `nft_item_list`.`asset_id_hex`
-                        FROM ((`metamask_v1`
-                        INNER JOIN `nft_main_wallet_nft_tx` ON `metamask_v1`.`address` = `nft_main_wallet_nft_tx`.`from_address`)
-                        INNER JOIN `tbl_users` ON `metamask_v1`.`discord_id` = `tbl_users`.`user_id`
-                        INNER JOIN `nft_item_list` ON `nft_main_wallet_nft_tx`.`token_address` = `nft_item_list`.`contract` AND `nft_item_list`.`asset_id_hex`=`nft_main_wallet_nft_tx`.`token_id_hex`
-                        )
-                        WHERE `tbl_users`.`is_frozen`=0 AND `metamask_v1`.`is_signed`=1 AND `nft_main_wallet_nft_tx`.`inserted_credited`=0
+                    sql = """ SELECT `address`, `discord_id`, `user_server` FROM `metamask_v1`
+                    WHERE `is_signed`=1 AND `discord_id` IS NOT NULL
                     """
                     await cur.execute(sql)
                     result = await cur.fetchall()
-                    if result:
-                        return result
+                    self.bot.address_book.load(result)
+                    return True
         except Exception:
             traceback.print_exc(file=sys.stdout)
-        return []
+        return False
 
-    async def verification_update(
-            self, user_id: str, discord_name: str, user_server: str, secret_key: str
-    ):
+    async def get_verified_address_owner(self, address: str):
+        """ (discord_id, user_server) of a signed `metamask_v1` address, None if it isn't or on error. """
         try:
             await self.openConnection()
             async with self.pool.acquire() as conn:
                 async with conn.cursor() as cur:
-                    sql = """ 
-                    UPDATE `metamask_v1` SET `discord_id`=%s, `discord_name`=%s, `discord_verified_date`=%s, `user_server`=%s
-                    WHERE `secret_key`=%s LIMIT 1
+                    sql = """ SELECT `discord_id`, `user_server` FROM `metamask_v1`
+                    WHERE `address`=%s AND `is_signed`=1 AND `discord_id` IS NOT NULL LIMIT 1
                     """
-                    await cur.execute(sql, (user_id, discord_name, int(time.time()), user_server, secret_key))
-                    await conn.commit()
-                    return True
+                    await cur.execute(sql, address)
+                    result = await cur.fetchone()
+                    if result:
+                        return result['discord_id'], result['user_server']
         except Exception:
             traceback.print_exc(file=sys.stdout)
-        return False
+        return None
 
-    async def get_wallet_tx(self, limit: int):
+    async def insert_notify_retry(self, rows):
+        """ rows: (target_type, target_id, content, attempts, next_retry, inserted_date) """
         try:
             await self.openConnection()
             async with self.pool.acquire() as conn:
                 async with conn.cursor() as cur:
-                    sql = """ 
-                    SELECT * FROM `nft_main_wallet_tx` ORDER BY `block_number` DESC LIMIT """ + str(limit)
-                    await cur.execute(sql)
-                    result = await cur.fetchall()
-                    if result:
-                        return result
+                    sql = """ INSERT INTO `nft_notify_retry` 
+                    (`target_type`, `target_id`, `content`, `attempts`, `next_retry`, `inserted_date`)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                    """
+                    await cur.executemany(sql, rows)
+                    return True
         except Exception:
             traceback.print_exc(file=sys.stdout)
-        return []
+        return False
 
-    async def get_insert_wallet_txs(self, txs):
+    async def take_notify_retry(self, limit: int = 500):
+        """ Notifications due for another attempt, removed from `nft_notify_retry`. """
         try:
             await self.openConnection()
             async with self.pool.acquire() as conn:
-                async with conn.cursor() as cur:
-                    sql = """
-                    INSERT INTO `nft_main_wallet_tx` (`network`, `hash`, `nonce`, `transaction_index`, `from_address`, 
-                    `to_address`, `value`, `gas`, `gas_price`, `input`, `receipt_cumulative_gas_used`,
-                    `receipt_gas_used`, `receipt_status`, `block_timestamp`, `block_time`, `block_number`,
-                    `block_hash`)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    """
-                    await cur.executemany(sql, txs)
+                await conn.begin()
+                try:
+                    async with conn.cursor() as cur:
+                        sql = """ SELECT * FROM `nft_notify_retry` 
+                        WHERE `next_retry`<=%s ORDER BY `retry_id` ASC LIMIT %s FOR UPDATE
+                        """
+                        await cur.execute(sql, (int(time.time()), limit))
+                        result = await cur.fetchall()
+                        if result:
+                            sql = " DELETE FROM `nft_notify_retry` WHERE `retry_id` IN (" + \
+                                ", ".join(["%s"] * len(result)) + ")"
+                            await cur.execute(sql, tuple(each['retry_id'] for each in result))
                     await conn.commit()
-                    return cur.rowcount
+                    return result or []
+                except Exception:
+                    await conn.rollback()
+                    raise
         except Exception:
             traceback.print_exc(file=sys.stdout)
-        return 0
+        return []
 
-    async def update_confirmed_gas_tx_notify(
-            self, txn: str, user_id: str, user_server: str, eth_gas: float, matic_gas: float
-    ):
+    async def save_cluster_stats(self, stats: dict) -> bool:
         try:
             await self.openConnection()
             async with self.pool.acquire() as conn:
                 async with conn.cursor() as cur:
-                    sql = """ 
-                    UPDATE `nft_main_wallet_tx`, `tbl_users`
-                      SET `nft_main_wallet_tx`.`is_credited`=%s, `nft_main_wallet_tx`.`credited_user_id`=%s,
-                      `nft_main_wallet_tx`.`credited_user_server`=%s, `nft_main_wallet_tx`.`credited_time`=%s,
-                      `tbl_users`.`eth_gas`=`eth_gas`+%s, `tbl_users`.`matic_gas`=`matic_gas`+%s
-                    WHERE `nft_main_wallet_tx`.`hash`=%s AND `nft_main_wallet_tx`.`is_credited`=%s
-                      AND `tbl_users`.`user_id`=%s AND `tbl_users`.`user_server`=%s
+                    sql = """ INSERT INTO `nft_cluster_stats` 
+                    (`cluster_id`, `shard_ids`, `guilds`, `members`, `unique_users`, `bots`, `online`, `latency`, 
+                    `updated_date`)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) ON DUPLICATE KEY UPDATE 
+                    `shard_ids`=VALUES(`shard_ids`), `guilds`=VALUES(`guilds`), `members`=VALUES(`members`), 
+                    `unique_users`=VALUES(`unique_users`), `bots`=VALUES(`bots`), `online`=VALUES(`online`), 
+                    `latency`=VALUES(`latency`), `updated_date`=VALUES(`updated_date`)
                     """
                     await cur.execute(sql, (
-                        1, user_id, user_server, int(time.time()),
-                        eth_gas, matic_gas,
-                        txn, 0, user_id, user_server
+                        stats['cluster_id'], stats['shard_ids'], stats['guilds'], stats['members'],
+                        stats['unique_users'], stats['bots'], stats['online'], stats['latency'], int(time.time())
                     ))
-                    await conn.commit()
                     return True
         except Exception:
             traceback.print_exc(file=sys.stdout)
         return False
 
-    async def update_confirmed_nft_tx_notify(
-            self, txn: str, user_id: str, user_server: str, token_id_hex: str,
-            eth_nft_deposited: int, matic_nft_deposited: int
-    ):
+    async def get_cluster_stats(self, max_age: int = 180):
+        """ Latest stats of the cluster processes that reported in the last `max_age` seconds. """
         try:
             await self.openConnection()
             async with self.pool.acquire() as conn:
                 async with conn.cursor() as cur:
-                    sql = """ 
-                    UPDATE `nft_main_wallet_nft_tx`, `tbl_users`
-                      SET `nft_main_wallet_nft_tx`.`is_credited`=%s, `nft_main_wallet_nft_tx`.`credited_user_id`=%s,
-                      `nft_main_wallet_nft_tx`.`credited_user_server`=%s, `nft_main_wallet_nft_tx`.`credited_time`=%s,
-                      `nft_main_wallet_nft_tx`.`new_owner_user_id`=%s,
-                      `nft_main_wallet_nft_tx`.`new_owner_server`=%s, `nft_main_wallet_nft_tx`.`new_owner_date`=%s,
+                    sql = """ SELECT * FROM `nft_cluster_stats` WHERE `updated_date`>=%s ORDER BY `cluster_id` ASC """
+                    await cur.execute(sql, int(time.time()) - max_age)
+                    result = await cur.fetchall()
+                    if result:
+                        return result
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+        return []
 
-                      `tbl_users`.`eth_nft_deposited`=`eth_nft_deposited`+%s, `tbl_users`.`matic_nft_deposited`=`matic_nft_deposited`+%s
+    async def enqueue_job(self, job_type: str, payload: dict = None, dedup_key: str = None):
+        """
+        Queue a job for worker.py, its `job_id`. None if it failed or a job with the same `dedup_key` is still
+        queued or running.
+        """
+        try:
+            await self.openConnection()
+            async with self.pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    sql = """ INSERT IGNORE INTO `nft_jobs` 
+                    (`job_type`, `payload`, `dedup_key`, `status`, `created_date`)
+                    VALUES (%s, %s, %s, %s, %s)
+                    """
+                    await cur.execute(sql, (
+                        job_type, json.dumps(payload or {}), dedup_key, "QUEUED", int(time.time())
+                    ))
+                    if cur.rowcount == 1:
+                        return cur.lastrowid
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+        return None
+
+    async def claim_job(self, job_types, worker_id: str, lease: int):
+        """
+        Take the oldest queued job of `job_types`, or a running one whose lease expired (its worker died),
+        leased to `worker_id` for `lease` seconds. None when there is nothing to do.
+        """
+        try:
+            await self.openConnection()
+            async with self.pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    now = int(time.time())
+                    types = ", ".join(["%s"] * len(job_types))
+                    sql = """ SELECT `job_id` FROM `nft_jobs` 
+                    WHERE `job_type` IN (""" + types + """) 
+                    AND (`status`=%s OR (`status`=%s AND `lease_until`<%s))
+                    ORDER BY `job_id` ASC LIMIT 10
+                    """
+                    await cur.execute(sql, (*job_types, "QUEUED", "RUNNING", now))
+                    candidates = await cur.fetchall()
+                    for each in candidates:
+                        # whoever updates the row first gets it
+                        sql = """ UPDATE `nft_jobs` 
+                        SET `status`=%s, `claimed_by`=%s, `lease_until`=%s, `attempts`=`attempts`+1, `started_date`=%s
+                        WHERE `job_id`=%s AND (`status`=%s OR (`status`=%s AND `lease_until`<%s))
+                        """
+                        await cur.execute(sql, (
+                            "RUNNING", worker_id, now + lease, now, each['job_id'], "QUEUED", "RUNNING", now
+                        ))
+                        if cur.rowcount == 1:
+                            await cur.execute(""" SELECT * FROM `nft_jobs` WHERE `job_id`=%s """, each['job_id'])
+                            return await cur.fetchone()
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+        return None
+
+    async def extend_job(self, job_id: int, worker_id: str, lease: int, progress: str = None) -> bool:
+        """ Renew the lease of a job `worker_id` holds, with its progress. False if it lost the job. """
+        try:
+            await self.openConnection()
+            async with self.pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    sql = """ UPDATE `nft_jobs` 
+                    SET `lease_until`=%s, `progress`=COALESCE(%s, `progress`)
+                    WHERE `job_id`=%s AND `claimed_by`=%s AND `status`=%s
+                    """
+                    await cur.execute(sql, (int(time.time()) + lease, progress, job_id, worker_id, "RUNNING"))
+                    return cur.rowcount == 1
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+        return False
+
+    async def finish_job(self, job_id: int, worker_id: str, status: str, result: str = None) -> bool:
+        """ DONE, FAILED or QUEUED again for another attempt; only DONE and FAILED free the `dedup_key`. """
+        try:
+            await self.openConnection()
+            async with self.pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    sql = """ UPDATE `nft_jobs` 
+                    SET `status`=%s, `result`=%s, `finished_date`=%s, `lease_until`=NULL,
+                    `dedup_key`=IF(%s IN ('DONE', 'FAILED'), NULL, `dedup_key`)
+                    WHERE `job_id`=%s AND `claimed_by`=%s AND `status`=%s
+                    """
+                    await cur.execute(sql, (
+                        status, result, int(time.time()), status, job_id, worker_id, "RUNNING"
+                    ))
+                    return cur.rowcount == 1
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+        return False
+
+    async def purge_jobs(self, before: int) -> int:
+        """ Delete DONE/FAILED jobs finished before `before`. """
+        try:
+            await self.openConnection()
+            async with self.pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    sql = """ DELETE FROM `nft_jobs` WHERE `status` IN (%s, %s) AND `finished_date`<%s """
+                    await cur.execute(sql, ("DONE", "FAILED", before))
+                    return cur.rowcount
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+        return 0
+
+    async def get_job(self, job_id: int):
+        try:
+            await self.openConnection()
+            async with self.pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    sql = """ SELECT * FROM `nft_jobs` WHERE `job_id`=%s LIMIT 1 """
+                    await cur.execute(sql, job_id)
+                    result = await cur.fetchone()
+                    if result:
+                        return result
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+        return None
+
+    async def get_frozen_user_ids(self):
+        await self.openConnection()
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                sql = """ SELECT `user_id` FROM `tbl_users` WHERE `is_frozen`=1 """
+                await cur.execute(sql)
+                result = await cur.fetchall()
+                return {each['user_id'] for each in result}
+
+    async def attribute_deposits(self, rows):
+        """
+        Keep the deposit rows sent from a verified address of a user who isn't frozen, with its
+        `address`, `discord_id` and `user_server` set from `bot.address_book`.
+        """
+        if not self.bot.address_book.loaded and not await self.reload_address_book():
+            return []
+        if any(each['from_address'] not in self.bot.address_book for each in rows):
+            # the address may have been verified through another cluster process
+            reload_after = self.bot.config.get('deposit', {}).get('address_book_reload', 30.0)
+            if self.bot.address_book.reload_due(reload_after):
+                await self.reload_address_book()
+        frozen = await self.get_frozen_user_ids()
+        attributed = []
+        for each in rows:
+            owner = self.bot.address_book.get(each['from_address'])
+            if owner is None or owner[0] in frozen:
+                continue
+            each['address'] = each['from_address'].lower()
+            each['discord_id'], each['user_server'] = owner
+            attributed.append(each)
+        return attributed
+
+    async def get_confirmed_gas_tx_to_notify(self, hashes=None):
+        """
+        Deposits not credited yet from a verified address, with the owner's `discord_id`/`user_server`.
+        `hashes` narrows it to those txs, for the ones the indexer just stored.
+        """
+        if hashes is not None and len(hashes) == 0:
+            return []
+        try:
+            await self.openConnection()
+            async with self.pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    sql = """ 
+                    SELECT `nft_main_wallet_tx`.*
+                    FROM `nft_main_wallet_tx`
+                    WHERE `nft_main_wallet_tx`.`is_credited`=0
+                    """
+                    args = None
+                    if hashes is not None:
+                        sql += " AND `nft_main_wallet_tx`.`hash` IN (" + ", ".join(["%s"] * len(hashes)) + ")"
+                        args = tuple(hashes)
+                    await cur.execute(sql, args)
+                    result = await cur.fetchall()
+                    if result:
+                        return await self.attribute_deposits(result)
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+        return []
+
+    async def get_confirmed_nft_tx_to_notify(self, hashes=None):
+        """
+        Deposits not credited yet from a verified address, with the owner's `discord_id`/`user_server`.
+        `hashes` narrows it to those txs, for the ones the indexer just stored.
+        """
+        if hashes is not None and len(hashes) == 0:
+            return []
+        try:
+            await self.openConnection()
+            async with self.pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    sql = """ 
+                    SELECT `nft_main_wallet_nft_tx`.*, `nft_item_list`.`name`, `nft_item_list`.`contract`, `nft_item_list`.`asset_id_hex`
+                        FROM `nft_main_wallet_nft_tx`
+                        INNER JOIN `nft_item_list` ON `nft_main_wallet_nft_tx`.`token_address` = `nft_item_list`.`contract` AND `nft_item_list`.`asset_id_hex`=`nft_main_wallet_nft_tx`.`token_id_hex`
+                        WHERE `nft_main_wallet_nft_tx`.`inserted_credited`=0
+                    """
+                    args = None
+                    if hashes is not None:
+                        sql += " AND `nft_main_wallet_nft_tx`.`transaction_hash` IN (" + ", ".join(["%s"] * len(hashes)) + ")"
+                        args = tuple(hashes)
+                    await cur.execute(sql, args)
+                    result = await cur.fetchall()
+                    if result:
+                        return await self.attribute_deposits(result)
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+        return []
+
+    async def verification_update(
+            self, user_id: str, discord_name: str, user_server: str, secret_key: str
+    ):
+        try:
+            await self.openConnection()
+            async with self.pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    sql = """ 
+                    UPDATE `metamask_v1` SET `discord_id`=%s, `discord_name`=%s, `discord_verified_date`=%s, `user_server`=%s
+                    WHERE `secret_key`=%s LIMIT 1
+                    """
+                    await cur.execute(sql, (user_id, discord_name, int(time.time()), user_server, secret_key))
+                    await conn.commit()
+                    sql = """ SELECT `address`, `is_signed` FROM `metamask_v1` WHERE `secret_key`=%s LIMIT 1 """
+                    await cur.execute(sql, secret_key)
+                    result = await cur.fetchone()
+                    if result and result['is_signed'] == 1:
+                        self.bot.address_book.set(result['address'], user_id, user_server)
+                    return True
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+        return False
+
+    async def get_wallet_tx(self, limit: int):
+        try:
+            await self.openConnection()
+            async with self.pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    sql = """ 
+                    SELECT * FROM `nft_main_wallet_tx` ORDER BY `block_number` DESC LIMIT """ + str(limit)
+                    await cur.execute(sql)
+                    result = await cur.fetchall()
+                    if result:
+                        return result
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+        return []
+
+    async def get_insert_wallet_txs(self, txs):
+        try:
+            await self.openConnection()
+            async with self.pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    sql = """
+                    INSERT INTO `nft_main_wallet_tx` (`network`, `hash`, `nonce`, `transaction_index`, `from_address`, 
+                    `to_address`, `value`, `gas`, `gas_price`, `input`, `receipt_cumulative_gas_used`,
+                    `receipt_gas_used`, `receipt_status`, `block_timestamp`, `block_time`, `block_number`,
+                    `block_hash`)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    """
+                    await cur.executemany(sql, txs)
+                    await conn.commit()
+                    return cur.rowcount
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+        return 0
+
+    async def update_confirmed_gas_tx_notify(self, credits):
+        """
+        Credit the gas deposits of one cycle in a transaction, each row behind a savepoint so one that fails
+        doesn't hold back the others. `credits` rows are (txn, user_id, user_server, eth_gas, matic_gas).
+        Returns the txns credited, ones already credited or without a `tbl_users` row are skipped.
+        """
+        done = []
+        try:
+            await self.openConnection()
+            async with self.pool.acquire() as conn:
+                await conn.begin()
+                try:
+                    async with conn.cursor() as cur:
+                        for txn, user_id, user_server, eth_gas, matic_gas in credits:
+                            await cur.execute("SAVEPOINT `credit_row`")
+                            try:
+                                sql = """ 
+                                UPDATE `nft_main_wallet_tx`
+                                  SET `is_credited`=%s, `credited_user_id`=%s, `credited_user_server`=%s, `credited_time`=%s
+                                WHERE `hash`=%s AND `is_credited`=%s
+                                """
+                                await cur.execute(sql, (1, user_id, user_server, int(time.time()), txn, 0))
+                                if cur.rowcount == 0:
+                                    continue
+                                if not await self._lock_user_row(cur, user_id, user_server):
+                                    print("DEPOSIT: no tbl_users row for {}/{}, gas tx {} left".format(user_id, user_server, txn))
+                                    await cur.execute("ROLLBACK TO SAVEPOINT `credit_row`")
+                                    continue
+                                sql = """ 
+                                UPDATE `tbl_users` SET `eth_gas`=`eth_gas`+%s, `matic_gas`=`matic_gas`+%s
+                                WHERE `user_id`=%s AND `user_server`=%s
+                                """
+                                await cur.execute(sql, (eth_gas, matic_gas, user_id, user_server))
+                                done.append(txn)
+                            except Exception:
+                                traceback.print_exc(file=sys.stdout)
+                                await cur.execute("ROLLBACK TO SAVEPOINT `credit_row`")
+                    await conn.commit()
+                    return done
+                except Exception:
+                    await conn.rollback()
+                    raise
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+        finally:
+            for each in credits:
+                self.bot.user_cache.invalidate(each[1], each[2])
+        return []
+
+    @staticmethod
+    async def _lock_user_row(cur, user_id: str, user_server: str) -> bool:
+        """ Whether the `tbl_users` row exists, locked for the rest of the transaction. """
+        await cur.execute(
+            "SELECT `user_id` FROM `tbl_users` WHERE `user_id`=%s AND `user_server`=%s FOR UPDATE",
+            (user_id, user_server)
+        )
+        return await cur.fetchone() is not None
+
+    async def update_confirmed_nft_tx_notify(
+            self, txn: str, user_id: str, user_server: str, token_id_hex: str,
+            eth_nft_deposited: int, matic_nft_deposited: int
+    ):
+        try:
+            await self.openConnection()
+            async with self.pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    sql = """ 
+                    UPDATE `nft_main_wallet_nft_tx`, `tbl_users`
+                      SET `nft_main_wallet_nft_tx`.`is_credited`=%s, `nft_main_wallet_nft_tx`.`credited_user_id`=%s,
+                      `nft_main_wallet_nft_tx`.`credited_user_server`=%s, `nft_main_wallet_nft_tx`.`credited_time`=%s,
+                      `nft_main_wallet_nft_tx`.`new_owner_user_id`=%s,
+                      `nft_main_wallet_nft_tx`.`new_owner_server`=%s, `nft_main_wallet_nft_tx`.`new_owner_date`=%s,
+
+                      `tbl_users`.`eth_nft_deposited`=`eth_nft_deposited`+%s, `tbl_users`.`matic_nft_deposited`=`matic_nft_deposited`+%s
                     WHERE `nft_main_wallet_nft_tx`.`transaction_hash`=%s AND `nft_main_wallet_nft_tx`.`is_credited`=%s AND `nft_main_wallet_nft_tx`.`token_id_hex`=%s
                       AND `tbl_users`.`user_id`=%s AND `tbl_users`.`user_server`=%s
                     """
@@ -1081,6 +1514,8 @@ class Utils(commands.Cog):
                     return True
         except Exception:
             traceback.print_exc(file=sys.stdout)
+        finally:
+            self.bot.user_cache.invalidate(user_id, user_server)
         return False
 
     async def get_wallet_nft_tx(self, limit: int):
@@ -1117,42 +1552,158 @@ class Utils(commands.Cog):
             traceback.print_exc(file=sys.stdout)
         return 0
 
-    async def insert_nft_deposited_credits(
-            self, user_id: str, user_server: str, eth_nft_deposited: int,
-            matic_nft_deposited: int, crediting, nft_tx_id: int,
-    ):
+    async def get_indexer_cursor(self, network: str, address: str):
         try:
             await self.openConnection()
             async with self.pool.acquire() as conn:
                 async with conn.cursor() as cur:
-                    sql = """
-                    INSERT INTO `nft_credit` (`network`, `token_address`, 
-                    `token_id_int`, `token_id_hex`, `credited_user_id`, `credited_user_server`, `amount`)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
-                    ON DUPLICATE KEY
-                    UPDATE
-                        `amount`=VALUES(`amount`)+`amount`
-                    """
-                    await cur.execute(sql, crediting)
+                    sql = """ SELECT * FROM `nft_indexer_cursor` WHERE `network`=%s AND `address`=%s LIMIT 1 """
+                    await cur.execute(sql, (network, address))
+                    result = await cur.fetchone()
+                    if result:
+                        return result
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+        return None
+
+    async def save_indexed_range(
+        self, network: str, address: str, gas_txs, nft_txs, last_block: int, last_block_hash: str
+    ):
+        """
+        Insert the wallet txs found up to `last_block` and move the indexer cursor there, in one transaction.
+        Rows already stored are skipped, so a range can be indexed again safely. Returns (gas, nft) inserted or None.
+        """
+        try:
+            await self.openConnection()
+            async with self.pool.acquire() as conn:
+                await conn.begin()
+                try:
+                    async with conn.cursor() as cur:
+                        gas_inserted = 0
+                        nft_inserted = 0
+                        if len(gas_txs) > 0:
+                            sql = """
+                            INSERT IGNORE INTO `nft_main_wallet_tx` (`network`, `hash`, `nonce`, `transaction_index`,
+                            `from_address`, `to_address`, `value`, `gas`, `gas_price`, `input`,
+                            `receipt_cumulative_gas_used`, `receipt_gas_used`, `receipt_status`, `block_timestamp`,
+                            `block_time`, `block_number`, `block_hash`)
+                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                            """
+                            await cur.executemany(sql, gas_txs)
+                            gas_inserted = cur.rowcount
+                        if len(nft_txs) > 0:
+                            sql = """
+                            INSERT IGNORE INTO `nft_main_wallet_nft_tx` (`network`, `block_number`, `block_timestamp`,
+                            `block_time`, `block_hash`, `transaction_hash`, `transaction_index`, `log_index`, `value`,
+                            `contract_type`, `transaction_type`, `token_address`, `token_id_int`, `token_id_hex`,
+                            `from_address`, `to_address`, `amount`, `verified`)
+                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                            """
+                            await cur.executemany(sql, nft_txs)
+                            nft_inserted = cur.rowcount
+                        sql = """ INSERT INTO `nft_indexer_cursor` (`network`, `address`, `last_block`,
+                        `last_block_hash`, `updated_date`) VALUES (%s, %s, %s, %s, %s)
+                        ON DUPLICATE KEY UPDATE `last_block`=VALUES(`last_block`),
+                        `last_block_hash`=VALUES(`last_block_hash`), `updated_date`=VALUES(`updated_date`) """
+                        await cur.execute(sql, (network, address, last_block, last_block_hash, int(time.time())))
                     await conn.commit()
-                    insert = cur.rowcount
-                    if insert > 0:
-                        sql = """
-                        UPDATE `nft_main_wallet_nft_tx`, `tbl_users`
-                            SET `nft_main_wallet_nft_tx`.`inserted_credited`=1,
-                                `tbl_users`.`eth_nft_deposited`=`eth_nft_deposited`+%s,
-                                `tbl_users`.`matic_nft_deposited`=`matic_nft_deposited`+%s
-                        WHERE `nft_main_wallet_nft_tx`.`nft_tx_id`=%s
-                            AND `tbl_users`.`user_id`=%s AND `tbl_users`.`user_server`=%s
-                        """
-                        await cur.execute(sql, (
-                            eth_nft_deposited, matic_nft_deposited, nft_tx_id, user_id, user_server
-                        ))
-                        await conn.commit()
-                    return cur.rowcount
+                    return gas_inserted, nft_inserted
+                except Exception:
+                    await conn.rollback()
+                    raise
         except Exception:
             traceback.print_exc(file=sys.stdout)
-        return 0
+        return None
+
+    async def rewind_indexer(self, network: str, address: str, last_block: int):
+        """
+        A reorg went deeper than the confirmation depth: drop the not yet credited txs after `last_block`
+        and move the cursor back so the range is indexed again.
+        """
+        try:
+            await self.openConnection()
+            async with self.pool.acquire() as conn:
+                await conn.begin()
+                try:
+                    async with conn.cursor() as cur:
+                        sql = """ DELETE FROM `nft_main_wallet_tx` WHERE `network`=%s AND `to_address`=%s
+                        AND `block_number`>%s AND `is_credited`=0 """
+                        await cur.execute(sql, (network, address, last_block))
+                        sql = """ DELETE FROM `nft_main_wallet_nft_tx` WHERE `network`=%s AND `to_address`=%s
+                        AND `block_number`>%s AND `inserted_credited`=0 """
+                        await cur.execute(sql, (network, address, last_block))
+                        sql = """ UPDATE `nft_indexer_cursor` SET `last_block`=%s, `last_block_hash`=NULL,
+                        `updated_date`=%s WHERE `network`=%s AND `address`=%s """
+                        await cur.execute(sql, (last_block, int(time.time()), network, address))
+                    await conn.commit()
+                    return True
+                except Exception:
+                    await conn.rollback()
+                    raise
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+        return False
+
+    async def insert_nft_deposited_credits(self, credits):
+        """
+        Credit the NFT deposits of one cycle in a transaction, each row behind a savepoint like
+        `update_confirmed_gas_tx_notify`. `credits` rows are (user_id, user_server, eth_nft_deposited,
+        matic_nft_deposited, crediting, nft_tx_id) with `crediting` the `nft_credit` values.
+        Returns the nft_tx_ids credited, ones already credited or without a `tbl_users` row are skipped.
+        """
+        done = []
+        try:
+            await self.openConnection()
+            async with self.pool.acquire() as conn:
+                await conn.begin()
+                try:
+                    async with conn.cursor() as cur:
+                        for user_id, user_server, eth_nft_deposited, matic_nft_deposited, crediting, nft_tx_id in credits:
+                            await cur.execute("SAVEPOINT `credit_row`")
+                            try:
+                                sql = """
+                                UPDATE `nft_main_wallet_nft_tx` SET `inserted_credited`=1
+                                WHERE `nft_tx_id`=%s AND `inserted_credited`=0
+                                """
+                                await cur.execute(sql, nft_tx_id)
+                                if cur.rowcount == 0:
+                                    continue
+                                if not await self._lock_user_row(cur, user_id, user_server):
+                                    print("DEPOSIT: no tbl_users row for {}/{}, nft tx #{} left".format(user_id, user_server, nft_tx_id))
+                                    await cur.execute("ROLLBACK TO SAVEPOINT `credit_row`")
+                                    continue
+                                sql = """
+                                INSERT INTO `nft_credit` (`network`, `token_address`, 
+                                `token_id_int`, `token_id_hex`, `credited_user_id`, `credited_user_server`, `amount`)
+                                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                                ON DUPLICATE KEY
+                                UPDATE
+                                    `amount`=VALUES(`amount`)+`amount`
+                                """
+                                await cur.execute(sql, crediting)
+                                sql = """
+                                UPDATE `tbl_users`
+                                    SET `eth_nft_deposited`=`eth_nft_deposited`+%s,
+                                        `matic_nft_deposited`=`matic_nft_deposited`+%s
+                                WHERE `user_id`=%s AND `user_server`=%s
+                                """
+                                await cur.execute(sql, (eth_nft_deposited, matic_nft_deposited, user_id, user_server))
+                                done.append(nft_tx_id)
+                            except Exception:
+                                traceback.print_exc(file=sys.stdout)
+                                await cur.execute("ROLLBACK TO SAVEPOINT `credit_row`")
+                    await conn.commit()
+                    return done
+                except Exception:
+                    await conn.rollback()
+                    raise
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+        finally:
+            for each in credits:
+                self.bot.user_cache.invalidate(each[0], each[1])
+                self.bot.asset_cache.invalidate(each[0], each[1])
+        return []
 
     # ERC1155
     async def get_nft_erc1155_unverified_tx(self):
@@ -1231,24 +1782,31 @@ class Utils(commands.Cog):
             traceback.print_exc(file=sys.stdout)
         return None
 
-    async def get_confirmed_nft1155_tx_to_notify(self):
+    async def get_confirmed_nft1155_tx_to_notify(self, hashes=None):
+        """
+        Deposits not credited yet from a verified address, with the owner's `discord_id`/`user_server`.
+        `hashes` narrows it to those txs, for the ones the indexer just stored.
+        """
+        if hashes is not None and len(hashes) == 0:
+            return []
         try:
             await self.openConnection()
             async with self.pool.acquire() as conn:
                 async with conn.cursor() as cur:
                     sql = """ 
-                    SELECT `metamask_v1`.*, `nft_main_wallet_nft_tx`.*, `nft_erc1155_list`.`name`, `nft_erc1155_list`.`token_address`, `nft_erc1155_list`.`token_id_hex`
-                        FROM ((`metamask_v1`
-                        INNER JOIN `nft_main_wallet_nft_tx` ON `metamask_v1`.`address` = `nft_main_wallet_nft_tx`.`from_address`)
-                        INNER JOIN `tbl_users` ON `metamask_v1`.`discord_id` = `tbl_users`.`user_id`
+                    SELECT `nft_main_wallet_nft_tx`.*, `nft_erc1155_list`.`name`, `nft_erc1155_list`.`token_address`, `nft_erc1155_list`.`token_id_hex`
+                        FROM `nft_main_wallet_nft_tx`
                         INNER JOIN `nft_erc1155_list` ON `nft_main_wallet_nft_tx`.`token_address` = `nft_erc1155_list`.`token_address` AND `nft_erc1155_list`.`token_id_hex`=`nft_main_wallet_nft_tx`.`token_id_hex`
-                        )
-                        WHERE `tbl_users`.`is_frozen`=0 AND `metamask_v1`.`is_signed`=1 AND `nft_main_wallet_nft_tx`.`inserted_credited`=0 AND `nft_erc1155_list`.`is_verified`=1
+                        WHERE `nft_main_wallet_nft_tx`.`inserted_credited`=0 AND `nft_erc1155_list`.`is_verified`=1
                     """
-                    await cur.execute(sql)
+                    args = None
+                    if hashes is not None:
+                        sql += " AND `nft_main_wallet_nft_tx`.`transaction_hash` IN (" + ", ".join(["%s"] * len(hashes)) + ")"
+                        args = tuple(hashes)
+                    await cur.execute(sql, args)
                     result = await cur.fetchall()
                     if result:
-                        return result
+                        return await self.attribute_deposits(result)
         except Exception:
             traceback.print_exc(file=sys.stdout)
         return []
@@ -1260,7 +1818,7 @@ class Utils(commands.Cog):
             await self.openConnection()
             async with self.pool.acquire() as conn:
                 async with conn.cursor() as cur:
-                    sql = """ SELECT `contract`, `update_date` 
+                    sql = """ SELECT `contract`, `update_date`, `total_count`, `last_item_id`
                     FROM `nft_rarity` WHERE `nft_info_contract_id`=%s LIMIT 1
                     """
                     await cur.execute(sql, contract_id)
@@ -1271,64 +1829,198 @@ class Utils(commands.Cog):
             traceback.print_exc(file=sys.stdout)
         return None
     
-    async def update_nft_rarity(
-        self, nft_info_contract_id: int, contract: str, collection_name: str, rarity_json: str
-    ):
+    async def get_nft_items_by_contract(self, contract: str, from_item_id: int, limit: int):
+        """ Up to `limit` items after `from_item_id` with what rarity needs: `item_id`, `asset_id_hex` and `meta`. """
         try:
             await self.openConnection()
             async with self.pool.acquire() as conn:
                 async with conn.cursor() as cur:
-                    sql = """ INSERT INTO `nft_rarity` (`nft_info_contract_id`, `contract`, `collection_name`, `rarity_json`, `update_date`)
-                    VALUES (%s, %s, %s, %s, %s) ON DUPLICATE KEY UPDATE 
-                    `rarity_json` = VALUES(`rarity_json`), `update_date` = VALUES(`update_date`) """
-                    await cur.execute(sql, (nft_info_contract_id, contract, collection_name, rarity_json, int(time.time())))
-                    await conn.commit()
-                    return cur.rowcount
+                    sql = """ SELECT `item_id`, `asset_id_hex`, `meta`
+                    FROM `nft_item_list` WHERE `contract`=%s AND `item_id`>%s
+                    ORDER BY `item_id` ASC LIMIT %s
+                    """
+                    await cur.execute(sql, (contract, from_item_id, limit))
+                    result = await cur.fetchall()
+                    if result:
+                        return result
         except Exception:
             traceback.print_exc(file=sys.stdout)
-        return 0
+        return []
 
-    async def get_nft_items_by_contract(self, contract: str):
+    async def get_rarity_trait_counts(self, contract_id: int):
         try:
             await self.openConnection()
             async with self.pool.acquire() as conn:
                 async with conn.cursor() as cur:
-                    sql = """ SELECT *
-                    FROM `nft_item_list` WHERE `contract`=%s
+                    sql = """ SELECT `trait_type`, `trait_value`, `count`
+                    FROM `nft_rarity_trait_counts` WHERE `nft_info_contract_id`=%s
+                    ORDER BY `id` ASC
                     """
-                    await cur.execute(sql, contract)
+                    await cur.execute(sql, contract_id)
                     result = await cur.fetchall()
                     if result:
-                        return result
+                        return [
+                            (each['trait_type'].decode('utf-8'), each['trait_value'].decode('utf-8'), each['count'])
+                            for each in result
+                        ]
         except Exception:
             traceback.print_exc(file=sys.stdout)
         return []
-    
-    async def clear_rarity_items(self, contract_id: int):
+
+    async def get_rarity_items_stored(self, contract_id: int):
         try:
             await self.openConnection()
             async with self.pool.acquire() as conn:
                 async with conn.cursor() as cur:
-                    sql = """ DELETE FROM `nft_rarity_items` WHERE `nft_info_contract_id`=%s """
+                    sql = """ SELECT `rarity_item_id`, `nft_item_list_id`, `name`, `attributes_dump`,
+                    `missing_traits_dump`, `trait_count_dump`, `rank`
+                    FROM `nft_rarity_items` WHERE `nft_info_contract_id`=%s
+                    ORDER BY `nft_item_list_id` ASC
+                    """
                     await cur.execute(sql, contract_id)
+                    result = await cur.fetchall()
+                    if result:
+                        return [(
+                            each['rarity_item_id'], each['nft_item_list_id'], each['name'], each['attributes_dump'],
+                            each['missing_traits_dump'], each['trait_count_dump'], each['rank']
+                        ) for each in result]
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+        return []
+
+    async def load_rarity_staging(self, load_id: str, data_rows, chunk_size: int=1000):
+        """
+        Write `nft_rarity_items` values into `nft_rarity_items_staging` under `load_id`, `chunk_size` rows per
+        statement. `data_rows` can be a generator, it is only read one chunk at a time.
+        """
+        loaded = 0
+        try:
+            await self.openConnection()
+            sql = """ INSERT INTO `nft_rarity_items_staging` (`load_id`, `nft_info_contract_id`, `nft_item_list_id`, 
+            `name`, `attributes_dump`, `missing_traits_dump`, `trait_count_dump`, `trait_count`, 
+            `rarity_score`, `rank`, `updated_date`)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) """
+            for chunk in chunks(data_rows, chunk_size):
+                async with self.pool.acquire() as conn:
+                    async with conn.cursor() as cur:
+                        await cur.executemany(sql, [(load_id,) + each for each in chunk])
+                        await conn.commit()
+                        loaded += len(chunk)
+                await asyncio.sleep(0)
+            return loaded
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+            await self.clear_rarity_staging(load_id)
+        return None
+
+    async def clear_rarity_staging(self, load_id: str):
+        try:
+            await self.openConnection()
+            async with self.pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    sql = """ DELETE FROM `nft_rarity_items_staging` WHERE `load_id`=%s """
+                    await cur.execute(sql, load_id)
                     await conn.commit()
                     return True
         except Exception:
             traceback.print_exc(file=sys.stdout)
         return False
-    
-    async def insert_rarity_items(self, data_rows):
+
+    async def save_rarity_full(
+        self, nft_info_contract_id: int, contract: str, collection_name: str, rarity_json: str,
+        total_count: int, last_item_id: int, count_rows, load_id: str, chunk_size: int=1000
+    ):
+        """
+        Replace the rarity of a collection with the items loaded by `load_rarity_staging`. The swap is one
+        transaction, readers see either the old ranking or the new one.
+        `last_item_id` 0 means it can't be updated incrementally.
+        """
         try:
             await self.openConnection()
             async with self.pool.acquire() as conn:
-                async with conn.cursor() as cur:
-                    sql = """ INSERT INTO `nft_rarity_items` (`nft_info_contract_id`, `nft_item_list_id`, 
-                    `name`, `attributes_dump`, `missing_traits_dump`, `trait_count_dump`, `trait_count`, 
-                    `rarity_score`, `rank`, `updated_date`)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s) """
-                    await cur.executemany(sql, data_rows)
+                await conn.begin()
+                try:
+                    async with conn.cursor() as cur:
+                        sql = """ INSERT INTO `nft_rarity` (`nft_info_contract_id`, `contract`, `collection_name`,
+                        `rarity_json`, `total_count`, `last_item_id`, `update_date`)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s) ON DUPLICATE KEY UPDATE 
+                        `rarity_json` = VALUES(`rarity_json`), `total_count` = VALUES(`total_count`),
+                        `last_item_id` = VALUES(`last_item_id`), `update_date` = VALUES(`update_date`) """
+                        await cur.execute(sql, (
+                            nft_info_contract_id, contract, collection_name, rarity_json,
+                            total_count, last_item_id, int(time.time())
+                        ))
+                        sql = """ DELETE FROM `nft_rarity_trait_counts` WHERE `nft_info_contract_id`=%s """
+                        await cur.execute(sql, nft_info_contract_id)
+                        if len(count_rows) > 0:
+                            sql = """ INSERT INTO `nft_rarity_trait_counts` (`nft_info_contract_id`, `trait_type`,
+                            `trait_value`, `count`) VALUES (%s, %s, %s, %s) """
+                            for chunk in chunks(count_rows, chunk_size):
+                                await cur.executemany(sql, [(nft_info_contract_id,) + each for each in chunk])
+                        sql = """ DELETE FROM `nft_rarity_items` WHERE `nft_info_contract_id`=%s """
+                        await cur.execute(sql, nft_info_contract_id)
+                        sql = """ INSERT INTO `nft_rarity_items` (`nft_info_contract_id`, `nft_item_list_id`, 
+                        `name`, `attributes_dump`, `missing_traits_dump`, `trait_count_dump`, `trait_count`, 
+                        `rarity_score`, `rank`, `updated_date`)
+                        SELECT `nft_info_contract_id`, `nft_item_list_id`, 
+                        `name`, `attributes_dump`, `missing_traits_dump`, `trait_count_dump`, `trait_count`, 
+                        `rarity_score`, `rank`, `updated_date`
+                        FROM `nft_rarity_items_staging` WHERE `load_id`=%s AND `nft_info_contract_id`=%s
+                        ORDER BY `staging_id` """
+                        await cur.execute(sql, (load_id, nft_info_contract_id))
+                        records = cur.rowcount
                     await conn.commit()
-                    return cur.rowcount
+                    return records
+                except Exception:
+                    await conn.rollback()
+                    raise
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+        finally:
+            await self.clear_rarity_staging(load_id)
+        return 0
+
+    async def save_rarity_incremental(
+        self, nft_info_contract_id: int, rarity_json: str, total_count: int, last_item_id: int,
+        count_rows, updated_rows, inserted_rows, chunk_size: int=1000
+    ):
+        """ Save new items folded into a collection. Only changed counts and rarity items are written. """
+        try:
+            await self.openConnection()
+            async with self.pool.acquire() as conn:
+                await conn.begin()
+                try:
+                    async with conn.cursor() as cur:
+                        sql = """ UPDATE `nft_rarity` SET `rarity_json`=%s, `total_count`=%s, `last_item_id`=%s,
+                        `update_date`=%s WHERE `nft_info_contract_id`=%s """
+                        await cur.execute(sql, (
+                            rarity_json, total_count, last_item_id, int(time.time()), nft_info_contract_id
+                        ))
+                        if len(count_rows) > 0:
+                            # new pairs get higher ids than the existing ones, which keeps their first seen order
+                            sql = """ INSERT INTO `nft_rarity_trait_counts` (`nft_info_contract_id`, `trait_type`,
+                            `trait_value`, `count`) VALUES (%s, %s, %s, %s)
+                            ON DUPLICATE KEY UPDATE `count`=VALUES(`count`) """
+                            for chunk in chunks(count_rows, chunk_size):
+                                await cur.executemany(sql, [(nft_info_contract_id,) + each for each in chunk])
+                        if len(updated_rows) > 0:
+                            sql = """ UPDATE `nft_rarity_items` SET `attributes_dump`=%s, `missing_traits_dump`=%s,
+                            `trait_count_dump`=%s, `trait_count`=%s, `rarity_score`=%s, `rank`=%s, `updated_date`=%s
+                            WHERE `rarity_item_id`=%s """
+                            for chunk in chunks(updated_rows, chunk_size):
+                                await cur.executemany(sql, chunk)
+                        if len(inserted_rows) > 0:
+                            sql = """ INSERT INTO `nft_rarity_items` (`nft_info_contract_id`, `nft_item_list_id`, 
+                            `name`, `attributes_dump`, `missing_traits_dump`, `trait_count_dump`, `trait_count`, 
+                            `rarity_score`, `rank`, `updated_date`)
+                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s) """
+                            for chunk in chunks(inserted_rows, chunk_size):
+                                await cur.executemany(sql, chunk)
+                    await conn.commit()
+                    return len(updated_rows) + len(inserted_rows)
+                except Exception:
+                    await conn.rollback()
+                    raise
         except Exception:
             traceback.print_exc(file=sys.stdout)
         return 0
@@ -1392,25 +2084,192 @@ class Utils(commands.Cog):
             traceback.print_exc(file=sys.stdout)
         return None
 
-    async def get_rarity_by_item_name_search(self, like: int, limit):
+    # End of Meta Gen
+
+    # Autocomplete search index
+    async def get_search_collections(self):
+        try:
+            await self.openConnection()
+            async with self.pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    sql = """ SELECT `contract_id`, `collection_name`, `enable_rarity`
+                    FROM `nft_info_contract` WHERE `is_enable`=%s
+                    """
+                    await cur.execute(sql, 1)
+                    result = await cur.fetchall()
+                    if result:
+                        return result
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+        return []
+
+    async def get_search_items(self, cursor, limit: int):
+        """
+        `nft_item_list` rows added or changed after `cursor` (updated_date, item_id), in that order.
+        Rows of the last seconds wait for the next refresh, so a row changed later in the same second isn't missed.
+        """
+        try:
+            await self.openConnection()
+            async with self.pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    sql = """ SELECT `item_id`, `name`, `contract`, UNIX_TIMESTAMP(`updated_date`) AS `updated_ts`
+                    FROM `nft_item_list`
+                    WHERE (`updated_date`>FROM_UNIXTIME(%s) OR (`updated_date`=FROM_UNIXTIME(%s) AND `item_id`>%s))
+                        AND `updated_date`<NOW() - INTERVAL 2 SECOND
+                    ORDER BY `updated_date` ASC, `item_id` ASC LIMIT %s
+                    """
+                    await cur.execute(sql, (cursor[0], cursor[0], cursor[1], limit))
+                    result = await cur.fetchall()
+                    if result:
+                        return result
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+        return []
+
+    async def get_search_erc1155_items(self, cursor, limit: int):
+        """ `nft_erc1155_list` rows added or changed after `cursor` (updated_date, vtk_id), like `get_search_items`. """
+        try:
+            await self.openConnection()
+            async with self.pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    sql = """ SELECT `vtk_id`, `name`, `token_address`, UNIX_TIMESTAMP(`updated_date`) AS `updated_ts`
+                    FROM `nft_erc1155_list`
+                    WHERE (`updated_date`>FROM_UNIXTIME(%s) OR (`updated_date`=FROM_UNIXTIME(%s) AND `vtk_id`>%s))
+                        AND `updated_date`<NOW() - INTERVAL 2 SECOND
+                    ORDER BY `updated_date` ASC, `vtk_id` ASC LIMIT %s
+                    """
+                    await cur.execute(sql, (cursor[0], cursor[0], cursor[1], limit))
+                    result = await cur.fetchall()
+                    if result:
+                        return result
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+        return []
+
+    async def get_search_rarity_items(self, from_rarity_item_id: int, limit: int, contract_id: int=None):
         try:
             await self.openConnection()
             async with self.pool.acquire() as conn:
                 async with conn.cursor() as cur:
                     sql = """ 
-                    SELECT `nft_rarity_items`.*, `nft_info_contract`.*
-                    FROM ((`nft_rarity_items`
-                    INNER JOIN `nft_info_contract` ON `nft_rarity_items`.`nft_info_contract_id` = `nft_info_contract`.`contract_id`)
-                    INNER JOIN `nft_item_list` ON `nft_rarity_items`.`nft_item_list_id` = `nft_item_list`.`item_id`)
-                    WHERE `nft_info_contract`.`is_enable`=1 AND `nft_info_contract`.`enable_rarity`=1 AND `nft_item_list`.`name` LIKE %s LIMIT """+str(limit)
-                    await cur.execute(sql, "%" + like + "%")
+                    SELECT `nft_rarity_items`.`rarity_item_id`, `nft_rarity_items`.`nft_item_list_id`,
+                        `nft_rarity_items`.`name`, `nft_rarity_items`.`nft_info_contract_id`
+                    FROM `nft_rarity_items`
+                        INNER JOIN `nft_info_contract` ON `nft_rarity_items`.`nft_info_contract_id` = `nft_info_contract`.`contract_id`
+                    WHERE `nft_info_contract`.`is_enable`=1 AND `nft_info_contract`.`enable_rarity`=1
+                        AND `nft_rarity_items`.`rarity_item_id`>%s
+                    """
+                    params = [from_rarity_item_id]
+                    if contract_id is not None:
+                        sql += """ AND `nft_rarity_items`.`nft_info_contract_id`=%s """
+                        params.append(contract_id)
+                    sql += """ ORDER BY `nft_rarity_items`.`rarity_item_id` ASC LIMIT %s """
+                    params.append(limit)
+                    await cur.execute(sql, tuple(params))
                     result = await cur.fetchall()
                     if result:
                         return result
         except Exception:
             traceback.print_exc(file=sys.stdout)
         return []
-    # End of Meta Gen
+
+    async def get_search_rarity_dates(self):
+        """ {nft_info_contract_id: update_date} of every generated rarity. """
+        try:
+            await self.openConnection()
+            async with self.pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    sql = """ SELECT `nft_info_contract_id`, `update_date` FROM `nft_rarity` """
+                    await cur.execute(sql)
+                    result = await cur.fetchall()
+                    return {each['nft_info_contract_id']: each['update_date'] for each in result}
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+        return None
+
+    async def refresh_search_index(self, page: int=5000):
+        """ Load rows added or changed since the last refresh into `bot.search_index`. Collections are reloaded in full. """
+        index = self.bot.search_index
+        collections = await self.get_search_collections()
+        if len(collections) > 0:
+            enabled = set()
+            for each in collections:
+                enabled.add(each['contract_id'])
+                index.collections.add(each['contract_id'], each['collection_name'])
+                if each['enable_rarity'] != 1:
+                    index.rarity.remove_group(each['contract_id'])
+                    index.rarity_hidden.add(each['contract_id'])
+                elif each['contract_id'] in index.rarity_hidden:
+                    index.rarity_hidden.discard(each['contract_id'])
+                    await self.refresh_search_rarity_contract(each['contract_id'])
+            for contract_id in set(index.collections.docs.keys()) - enabled:
+                index.collections.remove(contract_id)
+                index.rarity.remove_group(contract_id)
+                index.rarity_hidden.add(contract_id)
+
+        # a renamed row is added again, `SearchIndex.add` replaces its old name
+        while True:
+            rows = await self.get_search_items(index.items_cursor, page)
+            for each in rows:
+                index.items.add(("ERC721", each['item_id']), each['name'], each['contract'].lower())
+                index.items_cursor = (each['updated_ts'], each['item_id'])
+            await asyncio.sleep(0)
+            if len(rows) < page:
+                break
+        while True:
+            rows = await self.get_search_erc1155_items(index.erc1155_cursor, page)
+            for each in rows:
+                index.items.add(("ERC1155", each['vtk_id']), each['name'], each['token_address'].lower())
+                index.erc1155_cursor = (each['updated_ts'], each['vtk_id'])
+            await asyncio.sleep(0)
+            if len(rows) < page:
+                break
+        while True:
+            rows = await self.get_search_rarity_items(index.last_rarity_item_id, page)
+            for each in rows:
+                index.rarity.add(each['nft_item_list_id'], each['name'], each['nft_info_contract_id'])
+                index.last_rarity_item_id = each['rarity_item_id']
+            await asyncio.sleep(0)
+            if len(rows) < page:
+                break
+        # regenerated by worker.py or another cluster process, its old rows may be gone
+        dates = await self.get_search_rarity_dates()
+        if dates is not None:
+            for contract_id, update_date in dates.items():
+                known = index.rarity_dates.get(contract_id)
+                index.rarity_dates[contract_id] = update_date
+                if known is not None and known != update_date and contract_id not in index.rarity_hidden:
+                    await self.refresh_search_rarity_contract(contract_id)
+
+    async def refresh_search_rarity_contract(self, contract_id: int, page: int=5000):
+        """
+        Replace rarity names of one collection after its rarity was regenerated. `last_rarity_item_id` is left
+        alone, other collections may have rows below this one's, the next refresh adds these again harmlessly.
+        """
+        index = self.bot.search_index
+        index.rarity.remove_group(contract_id)
+        last_id = 0
+        while True:
+            rows = await self.get_search_rarity_items(last_id, page, contract_id)
+            for each in rows:
+                index.rarity.add(each['nft_item_list_id'], each['name'], each['nft_info_contract_id'])
+                last_id = each['rarity_item_id']
+            await asyncio.sleep(0)
+            if len(rows) < page:
+                break
+
+    async def search_user_assets(self, user_id: str, user_server: str, like: str, limit: int=25):
+        """ Rank the user's own assets by name without another query than the (cached) asset list. """
+        list_user_assets = await self.get_list_user_assets(user_id, user_server)
+        assets = {}
+        for each in list_user_assets:
+            key = asset_key(each)
+            assets[key] = each
+            if key not in self.bot.search_index.items:
+                self.bot.search_index.items.add(key, each['name'], each['contract'].lower())
+        found = self.bot.search_index.items.search(like, limit, allowed=assets.keys())
+        return [assets[key] for key, _, _ in found]
+    # End of autocomplete search index
 
     # Store message but not content
     async def insert_discord_message(self, list_message):
@@ -1427,7 +2286,7 @@ class Utils(commands.Cog):
                     return cur.rowcount
         except Exception:
             traceback.print_exc(file=sys.stdout)
-        return 0
+        return None
 
     async def delete_discord_message(self, message_id, user_id):
         try:
@@ -1613,22 +2472,142 @@ class Utils(commands.Cog):
         return None
     # End of NFT Meta fetch
 
+    @tasks.loop(seconds=15.0)
+    async def flush_user_commands_loop(self):
+        await self.flush_user_commands()
+
+    @tasks.loop(seconds=600.0)
+    async def refresh_address_book(self):
+        # in case `metamask_v1` was changed outside of the bot
+        await self.reload_address_book()
+
+    @tasks.loop(seconds=60.0)
+    async def report_cluster_stats(self):
+        # the processes of a cluster each see their own shards, `/about` adds them up
+        if self.bot.cluster_count <= 1:
+            return
+        await self.bot.wait_until_ready()
+        members = bots = online = 0
+        for member in self.bot.get_all_members():
+            members += 1
+            if member.bot:
+                bots += 1
+            if member.status != discord.Status.offline:
+                online += 1
+        await self.save_cluster_stats({
+            "cluster_id": self.bot.cluster_id,
+            "shard_ids": ",".join(str(shard_id) for shard_id in self.bot.shard_ids or []),
+            "guilds": len(self.bot.guilds),
+            "members": members,
+            "unique_users": len(self.bot.users),
+            "bots": bots,
+            "online": online,
+            "latency": self.bot.latency
+        })
+
+    @tasks.loop(seconds=5.0)
+    async def elect_leader(self):
+        await self.bot.leader.run()
+
+    @tasks.loop(seconds=15.0)
+    async def sample_gas_fees(self):
+        history = self.bot.config.get('gas', {}).get('history', 40)
+        if not self.bot.leader.is_leader("gas_price"):
+            for network, samples in (await self.get_gas_samples(history)).items():
+                self.bot.gas_oracle.load(network, samples)
+            return
+        networks = [network.upper() for network in self.bot.config['endpoint'].keys()]
+        samples = await asyncio.gather(
+            *[self.bot.gas_oracle.sample(network) for network in networks], return_exceptions=True
+        )
+        if self.bot.leader.enabled:
+            # for the other processes of the cluster
+            await self.insert_gas_samples(
+                [(network, sample) for network, sample in zip(networks, samples) if isinstance(sample, GasSample)],
+                history * self.sample_gas_fees.seconds
+            )
+
+    @tasks.loop(seconds=30.0)
+    async def check_settings_version(self):
+        # another process (or an admin) changed `bot_settings`
+        if self.bot.settings.loaded and await self.get_settings_version() in (None, self.bot.settings.version):
+            return
+        await self.get_bot_setting()
+
+    @tasks.loop(seconds=60.0)
+    async def retry_notifications(self):
+        await self.bot.wait_until_ready()
+        self.bot.notifier.requeue_retries(await self.take_notify_retry())
+
+    @tasks.loop(seconds=60.0)
+    async def update_search_index(self):
+        try:
+            await self.refresh_search_index()
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+
     @commands.Cog.listener()
     async def on_ready(self):
+        # workers are tasks of the bot's own event loop, not the one loading the cogs
+        self.bot.notifier.start()
+        if not self.elect_leader.is_running():
+            self.elect_leader.start()
+        if not self.report_cluster_stats.is_running():
+            self.report_cluster_stats.start()
+        if not self.refresh_address_book.is_running():
+            self.refresh_address_book.start()
+        if not self.check_settings_version.is_running():
+            self.check_settings_version.start()
+        if not self.sample_gas_fees.is_running():
+            self.sample_gas_fees.start()
+        if not self.retry_notifications.is_running():
+            self.retry_notifications.start()
         if not self.pull_eth_gas_price.is_running():
             self.pull_eth_gas_price.start()
         if not self.pull_matic_gas_price.is_running():
             self.pull_matic_gas_price.start()
+        if not self.update_search_index.is_running():
+            self.update_search_index.start()
+        if not self.flush_user_commands_loop.is_running():
+            self.flush_user_commands_loop.start()
 
     async def cog_load(self) -> None:
+        if not self.elect_leader.is_running():
+            self.elect_leader.start()
+        if not self.report_cluster_stats.is_running():
+            self.report_cluster_stats.start()
+        if not self.refresh_address_book.is_running():
+            self.refresh_address_book.start()
+        if not self.check_settings_version.is_running():
+            self.check_settings_version.start()
+        if not self.sample_gas_fees.is_running():
+            self.sample_gas_fees.start()
+        if not self.retry_notifications.is_running():
+            self.retry_notifications.start()
         if not self.pull_eth_gas_price.is_running():
             self.pull_eth_gas_price.start()
         if not self.pull_matic_gas_price.is_running():
             self.pull_matic_gas_price.start()
+        if not self.update_search_index.is_running():
+            self.update_search_index.start()
+        if not self.flush_user_commands_loop.is_running():
+            self.flush_user_commands_loop.start()
 
     async def cog_unload(self) -> None:
+        self.elect_leader.cancel()
+        self.report_cluster_stats.cancel()
+        self.refresh_address_book.cancel()
+        self.check_settings_version.cancel()
+        self.sample_gas_fees.cancel()
+        self.retry_notifications.cancel()
         self.pull_eth_gas_price.cancel()
         self.pull_matic_gas_price.cancel()
+        self.update_search_index.cancel()
+        self.flush_user_commands_loop.cancel()
+
+
+# DB (and the few RPC) round trips per method, on /metrics
+instrument_methods(Utils, "nftbot_utils_seconds", "Utils method duration, mostly database queries")
 
 
 async def setup(bot: commands.Bot) -> None:
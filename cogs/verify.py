@@ -26,10 +26,9 @@ class Verification(commands.Cog):
         """ /nftverify [secret]"""
         await interaction.response.send_message(f"{interaction.user.mention} checking verification...", ephemeral=True)
 
-        get_user_info = await self.utils.get_user_info(str(interaction.user.id), self.bot.server_bot)
+        get_user_info = await self.utils.get_user_session(str(interaction.user.id), self.bot.server_bot)
         if get_user_info is None:
             await interaction.edit_original_response(content=self.bot.first_message)
-            await self.utils.insert_user_info(str(interaction.user.id), self.bot.server_bot, 1)
             return
         else:
             if get_user_info['is_frozen'] == 1:
@@ -37,7 +36,6 @@ class Verification(commands.Cog):
                     content=f"{interaction.user.mention}, please contact Bot's dev. Your account is currently locked."
                 )
                 return
-        await self.utils.insert_user_info(str(interaction.user.id), self.bot.server_bot, 1)
 
         try:
             verify = await self.utils.verification_check(str(interaction.user.id), self.bot.server_bot)
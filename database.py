@@ -0,0 +1,92 @@
+import asyncio
+import sys
+import time
+import traceback
+from contextlib import asynccontextmanager
+
+import aiomysql
+from aiomysql.cursors import DictCursor
+
+from metrics import Histogram
+
+
+class Database:
+    """
+    Bot-wide aiomysql pool. Created once in Bot.py as `bot.db`, shared by every cog through `Utils`
+    and closed when the bot shuts down.
+    """
+
+    def __init__(self, config: dict):
+        self.config = config
+        self.pool = None
+        self._lock = asyncio.Lock()
+        self.wait_time = Histogram()
+        self.acquired = 0
+        self.in_use = 0
+        self.max_in_use = 0
+
+    @property
+    def minsize(self) -> int:
+        return self.config['mysql'].get('pool_minsize', 2)
+
+    @property
+    def maxsize(self) -> int:
+        return self.config['mysql'].get('pool_maxsize', 16)
+
+    async def open(self):
+        if self.pool is not None:
+            return self.pool
+        async with self._lock:
+            if self.pool is None:
+                self.pool = await aiomysql.create_pool(
+                    host=self.config['mysql']['host'], port=self.config['mysql'].get('port', 3306),
+                    minsize=self.minsize, maxsize=self.maxsize,
+                    user=self.config['mysql']['user'], password=self.config['mysql']['password'],
+                    db=self.config['mysql']['db'], cursorclass=DictCursor, autocommit=True
+                )
+        return self.pool
+
+    async def close(self):
+        if self.pool is None:
+            return
+        try:
+            self.pool.close()
+            await self.pool.wait_closed()
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+        self.pool = None
+
+    @asynccontextmanager
+    async def acquire(self):
+        """ Same as `pool.acquire()` but records how long the caller waited for a free connection. """
+        pool = await self.open()
+        start = time.perf_counter()
+        conn = await pool.acquire()
+        self.wait_time.observe(time.perf_counter() - start)
+        self.acquired += 1
+        self.in_use += 1
+        if self.in_use > self.max_in_use:
+            self.max_in_use = self.in_use
+        try:
+            yield conn
+        finally:
+            self.in_use -= 1
+            await pool.release(conn)
+
+    def stats(self):
+        wait = self.wait_time.snapshot()
+        size = self.pool.size if self.pool else 0
+        free = self.pool.freesize if self.pool else 0
+        return {
+            "minsize": self.minsize,
+            "maxsize": self.maxsize,
+            "size": size,
+            "free": free,
+            "in_use": self.in_use,
+            "max_in_use": self.max_in_use,
+            "utilisation": self.in_use / self.maxsize if self.maxsize else 0.0,
+            "acquired": self.acquired,
+            "wait_avg": wait['avg'],
+            "wait_max": wait['max'],
+            "wait_buckets": wait['buckets']
+        }
@@ -14,7 +14,8 @@ CREATE TABLE `bot_settings` (
 INSERT INTO `bot_settings` (`name`, `value`) VALUES
 ('min_gas_move_nft',	'{\"ETH\": 0.005, \"MATIC\": 0.02}'),
 ('eth_gas_tracker',	'{\"LastBlock\": \"15679631\", \"SafeGasPrice\": \"7\", \"ProposeGasPrice\": \"8\", \"FastGasPrice\": \"10\", \"suggestBaseFee\": \"6.010468023\", \"gasUsedRatio\": \"0.0551893666666667,0.9562653,0.329520533333333,0.2400164,0.9397873\", \"last_update\": 1664945449}'),
-('matic_gas_tracker',	'{\"safeLow\": 32.5, \"standard\": 50, \"fast\": 50.5, \"fastest\": 50.5, \"blockTime\": 1, \"blockNumber\": 33948507, \"last_update\": 1664945449}');
+('matic_gas_tracker',	'{\"safeLow\": 32.5, \"standard\": 50, \"fast\": 50.5, \"fastest\": 50.5, \"blockTime\": 1, \"blockNumber\": 33948507, \"last_update\": 1664945449}'),
+('settings_version',	'0');
 
 DROP TABLE IF EXISTS `metamask_v1`;
 CREATE TABLE `metamask_v1` (
@@ -36,6 +37,21 @@ CREATE TABLE `metamask_v1` (
 ) ENGINE=MyISAM DEFAULT CHARSET=latin1;
 
 
+DROP TABLE IF EXISTS `nft_cluster_stats`;
+CREATE TABLE `nft_cluster_stats` (
+  `cluster_id` int(11) NOT NULL,
+  `shard_ids` varchar(256) NOT NULL,
+  `guilds` int(11) NOT NULL,
+  `members` int(11) NOT NULL,
+  `unique_users` int(11) NOT NULL,
+  `bots` int(11) NOT NULL,
+  `online` int(11) NOT NULL,
+  `latency` float DEFAULT NULL,
+  `updated_date` int(11) NOT NULL,
+  PRIMARY KEY (`cluster_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=ascii;
+
+
 DROP TABLE IF EXISTS `nft_credit`;
 CREATE TABLE `nft_credit` (
   `nft_id` int(11) NOT NULL AUTO_INCREMENT,
@@ -69,11 +85,35 @@ CREATE TABLE `nft_erc1155_list` (
   `check_later_date` int(11) NOT NULL,
   `verified_date` int(11) DEFAULT NULL,
   `verified_by_uid` int(11) DEFAULT NULL,
+  `updated_date` timestamp NOT NULL DEFAULT current_timestamp() ON UPDATE current_timestamp(),
   PRIMARY KEY (`vtk_id`),
-  UNIQUE KEY `token_address_token_id_hex` (`token_address`,`token_id_hex`)
+  UNIQUE KEY `token_address_token_id_hex` (`token_address`,`token_id_hex`),
+  KEY `updated_date` (`updated_date`,`vtk_id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
 
 
+DROP TABLE IF EXISTS `nft_gas_samples`;
+CREATE TABLE `nft_gas_samples` (
+  `network` varchar(32) NOT NULL,
+  `sampled_at` double NOT NULL,
+  `base_fee` bigint(20) DEFAULT NULL,
+  `priority_fee` bigint(20) DEFAULT NULL,
+  `gas_price` bigint(20) NOT NULL,
+  PRIMARY KEY (`network`,`sampled_at`)
+) ENGINE=InnoDB DEFAULT CHARSET=ascii;
+
+
+DROP TABLE IF EXISTS `nft_indexer_cursor`;
+CREATE TABLE `nft_indexer_cursor` (
+  `network` varchar(32) NOT NULL,
+  `address` varchar(42) NOT NULL,
+  `last_block` int(11) NOT NULL,
+  `last_block_hash` varchar(70) DEFAULT NULL,
+  `updated_date` int(11) NOT NULL,
+  PRIMARY KEY (`network`,`address`)
+) ENGINE=InnoDB DEFAULT CHARSET=ascii;
+
+
 DROP TABLE IF EXISTS `nft_info_contract`;
 CREATE TABLE `nft_info_contract` (
   `contract_id` int(11) NOT NULL AUTO_INCREMENT,
@@ -108,7 +148,30 @@ CREATE TABLE `nft_item_list` (
   `meta` text DEFAULT NULL,
   `meta_url` varchar(512) DEFAULT NULL,
   `thumb_url` varchar(512) NOT NULL,
-  PRIMARY KEY (`item_id`)
+  `updated_date` timestamp NOT NULL DEFAULT current_timestamp() ON UPDATE current_timestamp(),
+  PRIMARY KEY (`item_id`),
+  KEY `updated_date` (`updated_date`,`item_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+
+DROP TABLE IF EXISTS `nft_jobs`;
+CREATE TABLE `nft_jobs` (
+  `job_id` int(11) NOT NULL AUTO_INCREMENT,
+  `job_type` varchar(32) NOT NULL,
+  `payload` text DEFAULT NULL,
+  `dedup_key` varchar(128) DEFAULT NULL,
+  `status` enum('QUEUED','RUNNING','DONE','FAILED') NOT NULL DEFAULT 'QUEUED',
+  `attempts` int(11) NOT NULL DEFAULT 0,
+  `claimed_by` varchar(64) DEFAULT NULL,
+  `lease_until` int(11) DEFAULT NULL,
+  `progress` varchar(256) DEFAULT NULL,
+  `result` text DEFAULT NULL,
+  `created_date` int(11) NOT NULL,
+  `started_date` int(11) DEFAULT NULL,
+  `finished_date` int(11) DEFAULT NULL,
+  PRIMARY KEY (`job_id`),
+  UNIQUE KEY `dedup_key` (`dedup_key`),
+  KEY `status_type` (`status`,`job_type`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
 
 
@@ -135,7 +198,7 @@ CREATE TABLE `nft_main_wallet_nft_tx` (
   `verified` tinyint(4) DEFAULT NULL,
   `inserted_credited` tinyint(4) NOT NULL DEFAULT 0,
   PRIMARY KEY (`nft_tx_id`),
-  UNIQUE KEY `transaction_hash_log_index` (`transaction_hash`,`log_index`),
+  UNIQUE KEY `transaction_hash_log_index` (`transaction_hash`,`log_index`,`token_id_hex`),
   KEY `token_address` (`token_address`),
   KEY `from_address` (`from_address`),
   KEY `to_address` (`to_address`)
@@ -174,6 +237,20 @@ CREATE TABLE `nft_main_wallet_tx` (
 ) ENGINE=InnoDB DEFAULT CHARSET=ascii;
 
 
+DROP TABLE IF EXISTS `nft_notify_retry`;
+CREATE TABLE `nft_notify_retry` (
+  `retry_id` int(11) NOT NULL AUTO_INCREMENT,
+  `target_type` enum('DM','CHANNEL') NOT NULL,
+  `target_id` varchar(32) NOT NULL,
+  `content` text NOT NULL,
+  `attempts` int(11) NOT NULL DEFAULT 0,
+  `next_retry` int(11) NOT NULL,
+  `inserted_date` int(11) NOT NULL,
+  PRIMARY KEY (`retry_id`),
+  KEY `next_retry` (`next_retry`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+
 DROP TABLE IF EXISTS `nft_rarity`;
 CREATE TABLE `nft_rarity` (
   `id` int(11) NOT NULL AUTO_INCREMENT,
@@ -181,6 +258,8 @@ CREATE TABLE `nft_rarity` (
   `contract` varchar(42) NOT NULL,
   `collection_name` varchar(128) NOT NULL,
   `rarity_json` longtext NOT NULL,
+  `total_count` int(11) NOT NULL DEFAULT 0,
+  `last_item_id` int(11) NOT NULL DEFAULT 0,
   `update_date` int(11) NOT NULL,
   PRIMARY KEY (`id`),
   UNIQUE KEY `contract` (`contract`),
@@ -207,6 +286,37 @@ CREATE TABLE `nft_rarity_items` (
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
 
 
+DROP TABLE IF EXISTS `nft_rarity_items_staging`;
+CREATE TABLE `nft_rarity_items_staging` (
+  `staging_id` bigint(20) NOT NULL AUTO_INCREMENT,
+  `load_id` varchar(36) CHARACTER SET ascii NOT NULL,
+  `nft_info_contract_id` int(11) NOT NULL,
+  `nft_item_list_id` int(11) NOT NULL,
+  `name` varchar(512) DEFAULT NULL,
+  `attributes_dump` text NOT NULL,
+  `missing_traits_dump` text NOT NULL,
+  `trait_count_dump` text NOT NULL,
+  `trait_count` int(11) NOT NULL,
+  `rarity_score` float NOT NULL,
+  `rank` int(11) NOT NULL,
+  `updated_date` int(11) NOT NULL,
+  PRIMARY KEY (`staging_id`),
+  KEY `load_id` (`load_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+
+DROP TABLE IF EXISTS `nft_rarity_trait_counts`;
+CREATE TABLE `nft_rarity_trait_counts` (
+  `id` bigint(20) NOT NULL AUTO_INCREMENT,
+  `nft_info_contract_id` int(11) NOT NULL,
+  `trait_type` varbinary(1024) NOT NULL,
+  `trait_value` varbinary(1024) NOT NULL,
+  `count` int(11) NOT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `contract_trait_value` (`nft_info_contract_id`,`trait_type`,`trait_value`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+
 DROP TABLE IF EXISTS `nft_tip_logs`;
 CREATE TABLE `nft_tip_logs` (
   `tip_id` bigint(20) NOT NULL AUTO_INCREMENT,
@@ -236,7 +346,9 @@ CREATE TABLE `nft_withdraw` (
   `user_server` varchar(32) NOT NULL,
   `withdrew_to` varchar(42) NOT NULL,
   `withdrew_tx` varchar(70) NOT NULL,
-  `withdrew_status` enum('PENDING','CONFIRMED','FAILED') DEFAULT NULL,
+  `withdrew_nonce` int(11) DEFAULT NULL,
+  `withdrew_raw_tx` text DEFAULT NULL,
+  `withdrew_status` enum('PENDING','CONFIRMED','FAILED','REJECTED') DEFAULT NULL,
   `withdrew_gas_price` bigint(20) DEFAULT NULL,
   `withdrew_gas_used` bigint(20) DEFAULT NULL,
   `withdrew_tx_real_fee` float DEFAULT NULL,
@@ -244,10 +356,24 @@ CREATE TABLE `nft_withdraw` (
   PRIMARY KEY (`withdraw_id`),
   KEY `user_id` (`user_id`),
   KEY `user_server` (`user_server`),
-  KEY `withdrew_status` (`withdrew_status`)
+  KEY `withdrew_status` (`withdrew_status`),
+  KEY `network_nonce` (`network`,`withdrew_nonce`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
 
 
+DROP TABLE IF EXISTS `nft_withdraw_nonce`;
+CREATE TABLE `nft_withdraw_nonce` (
+  `network` varchar(32) NOT NULL,
+  `next_nonce` int(11) NOT NULL DEFAULT 0,
+  `updated_date` int(11) NOT NULL DEFAULT 0,
+  PRIMARY KEY (`network`)
+) ENGINE=InnoDB DEFAULT CHARSET=ascii;
+
+INSERT INTO `nft_withdraw_nonce` (`network`, `next_nonce`, `updated_date`) VALUES
+('ETHEREUM',	0,	0),
+('POLYGON',	0,	0);
+
+
 DROP TABLE IF EXISTS `tbl_users`;
 CREATE TABLE `tbl_users` (
   `inserted_date` int(11) NOT NULL,
@@ -0,0 +1,141 @@
+-- Brings a database created from an older database.sql up to date, run after pulling.
+-- Every statement can run again, on an up to date database it changes nothing.
+SET NAMES utf8mb4;
+SET time_zone = '+00:00';
+
+-- autocomplete index: rows changed since the last refresh
+ALTER TABLE `nft_item_list`
+  ADD COLUMN IF NOT EXISTS `updated_date` timestamp NOT NULL DEFAULT current_timestamp() ON UPDATE current_timestamp(),
+  ADD KEY IF NOT EXISTS `updated_date` (`updated_date`,`item_id`);
+
+ALTER TABLE `nft_erc1155_list`
+  ADD COLUMN IF NOT EXISTS `updated_date` timestamp NOT NULL DEFAULT current_timestamp() ON UPDATE current_timestamp(),
+  ADD KEY IF NOT EXISTS `updated_date` (`updated_date`,`vtk_id`);
+
+-- /metagen folding new items into an existing ranking, last_item_id 0 makes the next run a full one
+CREATE TABLE IF NOT EXISTS `nft_rarity_trait_counts` (
+  `id` bigint(20) NOT NULL AUTO_INCREMENT,
+  `nft_info_contract_id` int(11) NOT NULL,
+  `trait_type` varbinary(1024) NOT NULL,
+  `trait_value` varbinary(1024) NOT NULL,
+  `count` int(11) NOT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `contract_trait_value` (`nft_info_contract_id`,`trait_type`,`trait_value`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+ALTER TABLE `nft_rarity`
+  ADD COLUMN IF NOT EXISTS `total_count` int(11) NOT NULL DEFAULT 0 AFTER `rarity_json`,
+  ADD COLUMN IF NOT EXISTS `last_item_id` int(11) NOT NULL DEFAULT 0 AFTER `total_count`;
+
+-- /metagen writes rarity items into staging, then swaps them in
+CREATE TABLE IF NOT EXISTS `nft_rarity_items_staging` (
+  `staging_id` bigint(20) NOT NULL AUTO_INCREMENT,
+  `load_id` varchar(36) CHARACTER SET ascii NOT NULL,
+  `nft_info_contract_id` int(11) NOT NULL,
+  `nft_item_list_id` int(11) NOT NULL,
+  `name` varchar(512) DEFAULT NULL,
+  `attributes_dump` text NOT NULL,
+  `missing_traits_dump` text NOT NULL,
+  `trait_count_dump` text NOT NULL,
+  `trait_count` int(11) NOT NULL,
+  `rarity_score` float NOT NULL,
+  `rank` int(11) NOT NULL,
+  `updated_date` int(11) NOT NULL,
+  PRIMARY KEY (`staging_id`),
+  KEY `load_id` (`load_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- withdrawals keep their nonce and signed tx for rebroadcasts, REJECTED ones are credited back
+ALTER TABLE `nft_withdraw`
+  ADD COLUMN IF NOT EXISTS `withdrew_nonce` int(11) DEFAULT NULL AFTER `withdrew_tx`,
+  ADD COLUMN IF NOT EXISTS `withdrew_raw_tx` text DEFAULT NULL AFTER `withdrew_nonce`,
+  MODIFY COLUMN `withdrew_status` enum('PENDING','CONFIRMED','FAILED','REJECTED') DEFAULT NULL,
+  ADD KEY IF NOT EXISTS `network_nonce` (`network`,`withdrew_nonce`);
+
+-- hot wallet deposit indexer
+CREATE TABLE IF NOT EXISTS `nft_indexer_cursor` (
+  `network` varchar(32) NOT NULL,
+  `address` varchar(42) NOT NULL,
+  `last_block` int(11) NOT NULL,
+  `last_block_hash` varchar(70) DEFAULT NULL,
+  `updated_date` int(11) NOT NULL,
+  PRIMARY KEY (`network`,`address`)
+) ENGINE=InnoDB DEFAULT CHARSET=ascii;
+
+-- one ERC1155 TransferBatch log carries several tokens
+ALTER TABLE `nft_main_wallet_nft_tx`
+  DROP INDEX IF EXISTS `transaction_hash_log_index`,
+  ADD UNIQUE KEY `transaction_hash_log_index` (`transaction_hash`,`log_index`,`token_id_hex`);
+
+-- notifier messages kept for a later retry
+CREATE TABLE IF NOT EXISTS `nft_notify_retry` (
+  `retry_id` int(11) NOT NULL AUTO_INCREMENT,
+  `target_type` enum('DM','CHANNEL') NOT NULL,
+  `target_id` varchar(32) NOT NULL,
+  `content` text NOT NULL,
+  `attempts` int(11) NOT NULL DEFAULT 0,
+  `next_retry` int(11) NOT NULL,
+  `inserted_date` int(11) NOT NULL,
+  PRIMARY KEY (`retry_id`),
+  KEY `next_retry` (`next_retry`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- bot_settings version stamp, bumped on every change
+INSERT INTO `bot_settings` (`name`, `value`)
+SELECT 'settings_version', '0' FROM DUAL
+WHERE NOT EXISTS (SELECT 1 FROM `bot_settings` WHERE `name`='settings_version');
+
+-- cluster processes: per process stats and the hot wallet nonces they share
+CREATE TABLE IF NOT EXISTS `nft_cluster_stats` (
+  `cluster_id` int(11) NOT NULL,
+  `shard_ids` varchar(256) NOT NULL,
+  `guilds` int(11) NOT NULL,
+  `members` int(11) NOT NULL,
+  `unique_users` int(11) NOT NULL,
+  `bots` int(11) NOT NULL,
+  `online` int(11) NOT NULL,
+  `latency` float DEFAULT NULL,
+  `updated_date` int(11) NOT NULL,
+  PRIMARY KEY (`cluster_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=ascii;
+
+CREATE TABLE IF NOT EXISTS `nft_withdraw_nonce` (
+  `network` varchar(32) NOT NULL,
+  `next_nonce` int(11) NOT NULL DEFAULT 0,
+  `updated_date` int(11) NOT NULL DEFAULT 0,
+  PRIMARY KEY (`network`)
+) ENGINE=InnoDB DEFAULT CHARSET=ascii;
+
+INSERT IGNORE INTO `nft_withdraw_nonce` (`network`, `next_nonce`, `updated_date`) VALUES
+('ETHEREUM',	0,	0),
+('POLYGON',	0,	0);
+
+-- jobs run by worker.py
+CREATE TABLE IF NOT EXISTS `nft_jobs` (
+  `job_id` int(11) NOT NULL AUTO_INCREMENT,
+  `job_type` varchar(32) NOT NULL,
+  `payload` text DEFAULT NULL,
+  `dedup_key` varchar(128) DEFAULT NULL,
+  `status` enum('QUEUED','RUNNING','DONE','FAILED') NOT NULL DEFAULT 'QUEUED',
+  `attempts` int(11) NOT NULL DEFAULT 0,
+  `claimed_by` varchar(64) DEFAULT NULL,
+  `lease_until` int(11) DEFAULT NULL,
+  `progress` varchar(256) DEFAULT NULL,
+  `result` text DEFAULT NULL,
+  `created_date` int(11) NOT NULL,
+  `started_date` int(11) DEFAULT NULL,
+  `finished_date` int(11) DEFAULT NULL,
+  PRIMARY KEY (`job_id`),
+  UNIQUE KEY `dedup_key` (`dedup_key`),
+  KEY `status_type` (`status`,`job_type`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- gas samples of the gas_price leader, read by the other cluster processes
+CREATE TABLE IF NOT EXISTS `nft_gas_samples` (
+  `network` varchar(32) NOT NULL,
+  `sampled_at` double NOT NULL,
+  `base_fee` bigint(20) DEFAULT NULL,
+  `priority_fee` bigint(20) DEFAULT NULL,
+  `gas_price` bigint(20) NOT NULL,
+  PRIMARY KEY (`network`,`sampled_at`)
+) ENGINE=InnoDB DEFAULT CHARSET=ascii;
@@ -0,0 +1,77 @@
+import asyncio
+
+
+class DepositQueue:
+    """
+    Deposits the indexer just stored, waiting for the Deposit cog to credit them, shared as `bot.deposit_queue`.
+    Holds (network, tx hash) pairs rather than rows: the crediting query is the same JOIN as the
+    reconciliation sweep, only narrowed to these hashes.
+    """
+
+    def __init__(self):
+        self.gas = set()  # (network, hash) of nft_main_wallet_tx
+        self.nft = set()  # (network, transaction_hash) of nft_main_wallet_nft_tx
+        # created on first use, the bot runs on a different event loop than the one loading the cogs
+        self.event = None
+        self.attempts = {}  # pair => times given back in a row
+        self.pushed = 0
+        self.taken = 0
+        self.retried = 0
+
+    def _event(self):
+        if self.event is None:
+            self.event = asyncio.Event()
+        return self.event
+
+    def push(self, gas, nft) -> None:
+        gas = set(gas)
+        nft = set(nft)
+        if not gas and not nft:
+            return
+        self.gas |= gas
+        self.nft |= nft
+        self.pushed += len(gas) + len(nft)
+        self._event().set()
+
+    async def wait(self, timeout: float) -> bool:
+        """ Wait until something was pushed, at most `timeout` seconds. """
+        try:
+            await asyncio.wait_for(self._event().wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def take(self):
+        """ Everything pushed so far as (gas, nft); what couldn't be credited goes through `give_back`. """
+        gas, nft = self.gas, self.nft
+        self.gas, self.nft = set(), set()
+        self._event().clear()
+        self.taken += len(gas) + len(nft)
+        return gas, nft
+
+    def give_back(self, gas, nft, left_gas, left_nft, max_attempts: int):
+        """
+        Of the (gas, nft) pairs taken, the ones to push again: their hash is in `left_gas` / `left_nft`, not
+        credited yet, and they were given back fewer than `max_attempts` times. The others are forgotten,
+        the reconciliation sweep credits them.
+        """
+        kept = []
+        for pairs, left in ((gas, left_gas), (nft, left_nft)):
+            keep = set()
+            for pair in pairs:
+                attempts = self.attempts.pop(pair, 0) + 1
+                if pair[1] not in left or attempts > max_attempts:
+                    continue
+                self.attempts[pair] = attempts
+                keep.add(pair)
+            kept.append(keep)
+        self.retried += len(kept[0]) + len(kept[1])
+        return kept[0], kept[1]
+
+    def stats(self):
+        return {
+            "waiting": len(self.gas) + len(self.nft),
+            "pushed": self.pushed,
+            "taken": self.taken,
+            "retried": self.retried
+        }
@@ -0,0 +1,113 @@
+import time
+from collections import deque, namedtuple
+
+from rpc import RPCError
+
+# base_fee is None when the network answered eth_gasPrice only, then gas_price is the legacy price
+GasSample = namedtuple("GasSample", ["timestamp", "base_fee", "priority_fee", "gas_price"])
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2] if values else 0
+
+
+class GasOracle:
+    """
+    Recent fee samples per network in a ring buffer, shared as `bot.gas_oracle`. `Utils.sample_gas_fees`
+    adds one per network from eth_feeHistory (eth_gasPrice where that's not supported) and withdrawals take
+    their fees from `fees` instead of an eth_gasPrice call each, the `/nftdeposit` embed shows `trend`.
+    In a cluster only the `gas_price` leader samples, the other processes `load` its samples from `nft_gas_samples`.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.samples = {}  # network => deque of GasSample, newest last
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    @property
+    def config(self):
+        return self.bot.config.get('gas', {})
+
+    def _buffer(self, network: str):
+        buffer = self.samples.get(network)
+        if buffer is None:
+            buffer = self.samples[network] = deque(maxlen=self.config.get('history', 40))
+        return buffer
+
+    async def sample(self, network: str):
+        rpc = self.bot.rpc.network(network)
+        try:
+            history = await rpc.call(
+                "eth_feeHistory",
+                [hex(self.config.get('fee_history_blocks', 10)), "latest", [self.config.get('priority_percentile', 50)]]
+            )
+            # the last base fee is the one of the next block
+            base_fee = int(history['baseFeePerGas'][-1], 16)
+            priority_fee = _median([int(reward[0], 16) for reward in history.get('reward') or []])
+            sample = GasSample(time.time(), base_fee, priority_fee, base_fee + priority_fee)
+        except (RPCError, KeyError, IndexError, TypeError):
+            # pre EIP-1559 network or endpoint without eth_feeHistory
+            try:
+                sample = GasSample(time.time(), None, None, int(await rpc.call("eth_gasPrice"), 16))
+            except RPCError as e:
+                self.errors += 1
+                print('GAS: {} sampling failed: {}'.format(network, e))
+                return None
+        self._buffer(network).append(sample)
+        return sample
+
+    def load(self, network: str, samples) -> None:
+        """ Replace the samples of `network` with those of another process, oldest first. """
+        buffer = self._buffer(network)
+        buffer.clear()
+        buffer.extend(samples)
+
+    def latest(self, network: str):
+        """ Newest sample if it isn't older than `gas.max_age` seconds. """
+        buffer = self.samples.get(network)
+        if not buffer or time.time() - buffer[-1].timestamp > self.config.get('max_age', 60):
+            return None
+        return buffer[-1]
+
+    def fees(self, network: str):
+        """
+        Fee fields of a transaction on `network`: maxFeePerGas/maxPriorityFeePerGas when it has a base fee
+        and is listed in `gas.eip1559`, gasPrice otherwise. None without a recent sample.
+        """
+        sample = self.latest(network)
+        if sample is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if sample.base_fee is not None and network in self.config.get('eip1559', ["ETHEREUM", "POLYGON"]):
+            # tip smoothed over the recent samples, room for the base fee to double before it's mined
+            tip = _median([each.priority_fee for each in self.samples[network] if each.priority_fee is not None])
+            return {'maxFeePerGas': 2 * sample.base_fee + tip, 'maxPriorityFeePerGas': tip}
+        return {'gasPrice': sample.gas_price}
+
+    def trend(self, network: str):
+        """ (current gwei, change since the oldest sample as a ratio, seconds covered), None without samples. """
+        buffer = self.samples.get(network)
+        if not buffer:
+            return None
+        last = buffer[-1]
+        # base fee and gas price differ by the tip, only compare samples of the same kind as the newest
+        if last.base_fee is not None:
+            first = next(each for each in buffer if each.base_fee is not None)
+            current, oldest = last.base_fee, first.base_fee
+        else:
+            first = next(each for each in buffer if each.base_fee is None)
+            current, oldest = last.gas_price, first.gas_price
+        change = (current - oldest) / oldest if oldest else 0.0
+        return current / 10**9, change, last.timestamp - first.timestamp
+
+    def stats(self):
+        return {
+            "samples": {network: len(buffer) for network, buffer in self.samples.items()},
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors
+        }
@@ -0,0 +1,98 @@
+"""
+Runs the bot as `cluster.processes` processes of Bot.py on this machine, each with a contiguous range of the
+shards, and starts again the ones that exit. Run it instead of Bot.py: `python3 launcher.py`.
+"""
+import asyncio
+import os
+import signal
+import sys
+import time
+import traceback
+
+import aiohttp
+
+from config import load_config
+
+
+async def recommended_shards(token: str) -> int:
+    """ Shard count Discord recommends for the bot. """
+    async with aiohttp.ClientSession() as session:
+        async with session.get(
+            "https://discord.com/api/v10/gateway/bot",
+            headers={'Authorization': 'Bot ' + token},
+            timeout=32
+        ) as response:
+            response.raise_for_status()
+            return (await response.json())['shards']
+
+
+def shard_ranges(shard_count: int, processes: int):
+    """ `shard_count` shards in `processes` contiguous ranges, the first ones get one more if it doesn't divide. """
+    size, extra = divmod(shard_count, processes)
+    ranges = []
+    start = 0
+    for cluster_id in range(processes):
+        end = start + size + (1 if cluster_id < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+class Launcher:
+    def __init__(self, config: dict):
+        self.config = config
+        self.processes = {}  # cluster_id => asyncio.subprocess.Process
+        self.stopping = False
+
+    async def run_worker(self, cluster_id: int, cluster_count: int, shard_ids, shard_count: int):
+        cluster_config = self.config.get('cluster', {})
+        env = dict(
+            os.environ,
+            NFTBOT_CLUSTER_ID=str(cluster_id),
+            NFTBOT_CLUSTER_COUNT=str(cluster_count),
+            NFTBOT_SHARD_IDS=",".join(str(shard_id) for shard_id in shard_ids),
+            NFTBOT_SHARD_COUNT=str(shard_count)
+        )
+        delay = cluster_config.get('restart_delay', 5)
+        while not self.stopping:
+            started = time.monotonic()
+            print("LAUNCHER: starting cluster {} with shards {}".format(cluster_id, shard_ids))
+            process = await asyncio.create_subprocess_exec(sys.executable, "Bot.py", env=env)
+            self.processes[cluster_id] = process
+            code = await process.wait()
+            self.processes.pop(cluster_id, None)
+            if self.stopping:
+                return
+            # crash loops back off, a worker that ran a while restarts right away
+            if time.monotonic() - started > 300:
+                delay = cluster_config.get('restart_delay', 5)
+            print("LAUNCHER: cluster {} exited with {}, restarting in {}s".format(cluster_id, code, delay))
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, cluster_config.get('max_restart_delay', 300))
+
+    def stop(self) -> None:
+        self.stopping = True
+        for process in self.processes.values():
+            # SIGINT lets Bot.py run its shutdown: pending notifications, command counts, leader locks
+            if process.returncode is None:
+                process.send_signal(signal.SIGINT)
+
+    async def main(self):
+        cluster_config = self.config.get('cluster', {})
+        shard_count = cluster_config.get('shard_count', 0) or await recommended_shards(self.config['discord']['token'])
+        processes = max(1, min(cluster_config.get('processes', 1), shard_count))
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self.stop)
+        print("LAUNCHER: {} shards in {} processes".format(shard_count, processes))
+        await asyncio.gather(*[
+            self.run_worker(cluster_id, processes, shard_ids, shard_count)
+            for cluster_id, shard_ids in enumerate(shard_ranges(shard_count, processes))
+        ])
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(Launcher(load_config()).main())
+    except Exception:
+        traceback.print_exc(file=sys.stdout)
@@ -0,0 +1,96 @@
+import sys
+import traceback
+
+import aiomysql
+from aiomysql.cursors import DictCursor
+
+# background jobs owned by one process of the cluster, the loops of a job must run in the same process
+# (the indexer feeds `bot.deposit_queue` in memory)
+JOBS = ("deposits", "alchemy", "gas_price")
+
+
+class LeaderElection:
+    """
+    Which background jobs this process owns when several processes share the shards, shared as `bot.leader`.
+    Each job is a MariaDB `GET_LOCK` held on a dedicated connection, `Utils.elect_leader` tries to take the
+    free ones and checks the held ones every few seconds. Locks go with the connection, so when the leader
+    dies another process takes over on its next try. Single process without `leader.enable`, every job runs here.
+    """
+
+    def __init__(self, config: dict, required: bool = False):
+        self.config = config
+        # several processes of launcher.py: on whatever `leader.enable` says
+        self.required = required
+        self.conn = None
+        self.held = set()
+        self.elected = 0
+        self.lost = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.required or self.config.get('leader', {}).get('enable', 0) == 1
+
+    def is_leader(self, job: str) -> bool:
+        return not self.enabled or job in self.held
+
+    def _lock_name(self, job: str) -> str:
+        return "{}:{}".format(self.config.get('leader', {}).get('prefix', "nftbot"), job)
+
+    async def _connect(self):
+        mysql = self.config['mysql']
+        conn = await aiomysql.connect(
+            host=mysql['host'], port=mysql.get('port', 3306), user=mysql['user'], password=mysql['password'],
+            db=mysql['db'], cursorclass=DictCursor, autocommit=True
+        )
+        async with conn.cursor() as cur:
+            # a leader cut off from MariaDB loses its locks after this, not after the default 8 hours
+            await cur.execute("SET SESSION wait_timeout=%s", self.config.get('leader', {}).get('lock_timeout', 30))
+        return conn
+
+    def _drop(self) -> None:
+        if self.held:
+            print("LEADER: lost {}".format(", ".join(sorted(self.held))))
+            self.lost += len(self.held)
+        self.held.clear()
+        if self.conn is not None:
+            self.conn.close()
+        self.conn = None
+
+    async def run(self) -> None:
+        if not self.enabled:
+            return
+        try:
+            if self.conn is None or self.conn.closed:
+                self._drop()
+                self.conn = await self._connect()
+            async with self.conn.cursor() as cur:
+                for job in JOBS:
+                    name = self._lock_name(job)
+                    if job in self.held:
+                        # also keeps the connection alive
+                        await cur.execute("SELECT IS_USED_LOCK(%s)=CONNECTION_ID() AS `held`", name)
+                        if (await cur.fetchone())['held'] != 1:
+                            self.held.discard(job)
+                            self.lost += 1
+                            print("LEADER: lost {}".format(job))
+                    else:
+                        await cur.execute("SELECT GET_LOCK(%s, 0) AS `got`", name)
+                        if (await cur.fetchone())['got'] == 1:
+                            self.held.add(job)
+                            self.elected += 1
+                            print("LEADER: now running {}".format(job))
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+            # can't tell whether the locks are still ours, stop and let the next run reconnect
+            self._drop()
+
+    async def close(self) -> None:
+        self._drop()
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "held": sorted(self.held),
+            "elected": self.elected,
+            "lost": self.lost
+        }
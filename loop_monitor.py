@@ -0,0 +1,109 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+
+from metrics import Histogram
+
+# lag is mostly milliseconds, a stall seconds
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+class LoopMonitor:
+    """
+    Watches the bot's event loop, shared as `bot.loop_monitor`. A task sleeps `monitor.lag_interval` at a time
+    and records by how much it wakes up late in `nftbot_loop_lag_seconds`. A watchdog thread takes the loop
+    thread's stack when the task hasn't woken for `monitor.stall_threshold` seconds, i.e. the code blocking
+    the loop right then. Stalls are counted by the bot's function they were in and sent to the log channel.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.lag = Histogram(LAG_BUCKETS)
+        self.beat = None  # time.monotonic() the sampler last woke up
+        self.loop_thread_id = None
+        self.captured = None  # (beat, stack, where) taken by the watchdog for the current stall
+        self.task = None
+        self.thread = None
+        self.stopping = threading.Event()
+        self.stalls = 0
+        self.last_report = 0.0
+
+    @property
+    def config(self):
+        return self.bot.config.get('monitor', {})
+
+    def start(self) -> None:
+        if self.task is not None:
+            return
+        self.loop_thread_id = threading.get_ident()
+        self.beat = time.monotonic()
+        self.task = asyncio.create_task(self._sample())
+        self.thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopping.set()
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    @staticmethod
+    def _where(frame) -> str:
+        # innermost frame of the bot's own code, what to move off the loop
+        where = None
+        for each in traceback.extract_stack(frame):
+            if each.filename.startswith(ROOT) and "site-packages" not in each.filename:
+                where = "{}:{}".format(os.path.relpath(each.filename, ROOT), each.name)
+        return where or "other"
+
+    def _watch(self) -> None:
+        while not self.stopping.is_set():
+            threshold = self.config.get('stall_threshold', 0.5)
+            time.sleep(threshold / 2)
+            beat = self.beat
+            if beat is None or time.monotonic() - beat < threshold:
+                continue
+            if self.captured is not None and self.captured[0] == beat:
+                continue
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            stack = "".join(traceback.format_stack(frame)[-self.config.get('stack_limit', 12):])
+            self.captured = (beat, stack, self._where(frame))
+
+    async def _sample(self):
+        while True:
+            interval = self.config.get('lag_interval', 0.5)
+            before = time.monotonic()
+            await asyncio.sleep(interval)
+            self.beat = now = time.monotonic()
+            lag = max(0.0, now - before - interval)
+            self.lag.observe(lag)
+            captured, self.captured = self.captured, None
+            if captured is not None and lag >= self.config.get('stall_threshold', 0.5):
+                self._stalled(lag, captured[1], captured[2])
+
+    def _stalled(self, lag: float, stack: str, where: str) -> None:
+        self.stalls += 1
+        self.bot.metrics.counter(
+            "nftbot_loop_stalls_total", "Event loop blocked past monitor.stall_threshold", where=where
+        ).inc()
+        print("LOOP: blocked {:.2f}s in {}\n{}".format(lag, where, stack))
+        # one report per `report_interval`, a stalling loop would otherwise flood the channel
+        if time.monotonic() - self.last_report < self.config.get('report_interval', 300):
+            return
+        self.last_report = time.monotonic()
+        self.bot.notifier.channel(
+            self.bot.config['discord']['log_channel'],
+            "Event loop blocked `{:.2f}s` in `{}`:\n```\n{}```".format(lag, where, stack[-1500:])
+        )
+
+    def stats(self):
+        return {
+            "lag": self.lag.snapshot(),
+            "stalls": self.stalls
+        }
@@ -0,0 +1,108 @@
+import asyncio
+import time
+from collections import deque
+
+
+class MessageBuffer:
+    """
+    Guild messages waiting to be written to `discord_messages`, shared as `bot.message_buffer`.
+    Bounded twice: at most `maxsize` rows wait (the oldest are dropped past that while MariaDB is slow) and
+    the last `seen_size` message ids are remembered so a message is buffered once. The Events cog's
+    `process_saving_message` loop is the only writer, it takes a batch once `batch_size` rows are waiting
+    or `flush_interval` seconds went by.
+    """
+
+    def __init__(self, maxsize: int = 20000, seen_size: int = 50000, batch_size: int = 500):
+        self.rows = deque()  # (message_id, row), oldest first
+        self.pending = set()  # message ids in `rows`, removed when the message is deleted before writing
+        self.seen = set()
+        self.seen_order = deque()
+        self.maxsize = maxsize
+        self.seen_size = seen_size
+        self.batch_size = batch_size
+        # created on first use, the bot runs on a different event loop than the one loading the cogs
+        self.event = None
+        self.buffered = 0
+        self.written = 0
+        self.dropped = 0
+        self.failures = 0
+        self.last_flush = time.monotonic()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def _event(self):
+        if self.event is None:
+            self.event = asyncio.Event()
+        return self.event
+
+    def _remember(self, message_id: int) -> None:
+        if len(self.seen_order) >= self.seen_size:
+            self.seen.discard(self.seen_order.popleft())
+        self.seen.add(message_id)
+        self.seen_order.append(message_id)
+
+    def add(self, message_id: int, row) -> None:
+        if message_id in self.seen:
+            return
+        self._remember(message_id)
+        while len(self.rows) >= self.maxsize:
+            dropped_id, _ = self.rows.popleft()
+            if dropped_id in self.pending:
+                self.pending.discard(dropped_id)
+                self.dropped += 1
+        self.rows.append((message_id, row))
+        self.pending.add(message_id)
+        self.buffered += 1
+        if len(self.pending) >= self.batch_size:
+            self._event().set()
+
+    def discard(self, message_id: int) -> bool:
+        """ Forget a message deleted before it was written, True if it was waiting. """
+        if message_id not in self.pending:
+            return False
+        self.pending.discard(message_id)
+        return True
+
+    async def wait(self, timeout: float) -> None:
+        """ Until a full batch is waiting, at most `timeout` seconds. """
+        try:
+            await asyncio.wait_for(self._event().wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def take(self):
+        """ Up to `batch_size` rows as (message_id, row), hand them back with `put_back` if writing fails. """
+        batch = []
+        while self.rows and len(batch) < self.batch_size:
+            message_id, row = self.rows.popleft()
+            if message_id in self.pending:
+                self.pending.discard(message_id)
+                batch.append((message_id, row))
+        if len(self.pending) < self.batch_size:
+            self._event().clear()
+        return batch
+
+    def put_back(self, batch) -> None:
+        self.failures += 1
+        for message_id, row in reversed(batch):
+            if len(self.rows) >= self.maxsize:
+                self.dropped += 1
+                continue
+            self.rows.appendleft((message_id, row))
+            self.pending.add(message_id)
+
+    def flushed(self, count: int) -> None:
+        self.written += count
+        self.last_flush = time.monotonic()
+
+    def stats(self):
+        return {
+            "waiting": len(self.pending),
+            "maxsize": self.maxsize,
+            "buffered": self.buffered,
+            "written": self.written,
+            "dropped": self.dropped,
+            "failures": self.failures,
+            "last_flush": time.monotonic() - self.last_flush
+        }
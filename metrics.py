@@ -0,0 +1,194 @@
+import bisect
+import functools
+import inspect
+import sys
+import time
+import traceback
+
+from discord.ext import tasks
+
+
+# Latency buckets in seconds, close to the Prometheus client defaults.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# background loops may wait for work or walk a whole table
+LOOP_BUCKETS = (0.01, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0)
+
+
+class Histogram:
+    """ Cumulative bucket histogram. Cheap enough to call on every DB/RPC call. """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def time(self):
+        return _Timer(self)
+
+    def snapshot(self):
+        cumulative = []
+        running = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            running += count
+            cumulative.append((bound, running))
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "avg": self.sum / self.count if self.count else 0.0,
+            "max": self.max,
+            "buckets": cumulative
+        }
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+
+def _labels(labels: dict, **extra) -> str:
+    labels = {**labels, **extra}
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels.items()) + "}"
+
+
+class Registry:
+    """
+    Histograms and counters by name and labels, shared as `bot.metrics`, plus collectors reading the
+    stats the pools and queues already keep. `render` gives the Prometheus text format served on `/metrics`.
+    """
+
+    def __init__(self):
+        self.metrics = {}  # name => (type, help, {labels tuple: Histogram/Counter})
+        self.collectors = []
+
+    def _get(self, kind: str, factory, name: str, help: str, labels: dict):
+        family = self.metrics.get(name)
+        if family is None:
+            family = self.metrics[name] = (kind, help, {})
+        key = tuple(sorted(labels.items()))
+        metric = family[2].get(key)
+        if metric is None:
+            metric = family[2][key] = factory()
+        return metric
+
+    def histogram(self, name: str, help: str = "", buckets=DEFAULT_BUCKETS, **labels) -> Histogram:
+        return self._get("histogram", lambda: Histogram(buckets), name, help, labels)
+
+    def counter(self, name: str, help: str = "", **labels) -> Counter:
+        return self._get("counter", Counter, name, help, labels)
+
+    def collector(self, collect) -> None:
+        """
+        `collect()` returns [(name, type, help, [(labels, value)])] at render time, value being a number or a
+        `Histogram.snapshot()` for type "histogram".
+        """
+        self.collectors.append(collect)
+
+    @staticmethod
+    def _render_family(lines, name: str, kind: str, help: str, samples) -> None:
+        if help:
+            lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            if kind != "histogram":
+                lines.append(f"{name}{_labels(labels)} {value}")
+                continue
+            for bound, count in value['buckets']:
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{name}_bucket{_labels(labels, le=le)} {count}")
+            lines.append(f"{name}_sum{_labels(labels)} {value['sum']}")
+            lines.append(f"{name}_count{_labels(labels)} {value['count']}")
+
+    def render(self) -> str:
+        lines = []
+        for name, (kind, help, metrics) in self.metrics.items():
+            samples = [
+                (dict(key), metric.snapshot() if kind == "histogram" else metric.value)
+                for key, metric in list(metrics.items())
+            ]
+            self._render_family(lines, name, kind, help, samples)
+        for collect in self.collectors:
+            try:
+                for name, kind, help, samples in collect():
+                    self._render_family(lines, name, kind, help, samples)
+            except Exception:
+                traceback.print_exc(file=sys.stdout)
+        return "\n".join(lines) + "\n"
+
+
+def instrument_methods(cls, name: str, help: str = "", methods=None, errors: str = None) -> None:
+    """
+    Time the coroutine methods of a cog class (all public ones but listeners when `methods` is None) into
+    the `name` histogram labelled by method, the instance's `bot.metrics` holds it. With `errors`, a call
+    raising or returning None increments that counter.
+    """
+    for method_name, func in list(vars(cls).items()):
+        if methods is not None and method_name not in methods:
+            continue
+        if method_name.startswith(("_", "on_", "cog_")) or not inspect.iscoroutinefunction(func):
+            continue
+        setattr(cls, method_name, _timed(func, name, help, errors))
+
+
+def _timed(func, name: str, help: str, errors: str = None):
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        result = None
+        try:
+            with self.bot.metrics.histogram(name, help, method=func.__name__).time():
+                result = await func(self, *args, **kwargs)
+            return result
+        finally:
+            if errors is not None and result is None:
+                self.bot.metrics.counter(errors, "Calls that failed", method=func.__name__).inc()
+    return wrapper
+
+
+def instrument_loops(bot, name: str = "nftbot_loop_seconds") -> None:
+    """ Time every iteration of the `tasks.loop`s of the loaded cogs, labelled by cog and loop. """
+    for cog_name, cog in bot.cogs.items():
+        for attr, value in vars(type(cog)).items():
+            if not isinstance(value, tasks.Loop):
+                continue
+            loop = getattr(cog, attr)
+            if getattr(loop.coro, "__timed__", False):
+                continue
+            loop.coro = _timed_loop(bot, loop.coro, name, cog_name, attr)
+
+
+def _timed_loop(bot, coro, name: str, cog_name: str, loop_name: str):
+    @functools.wraps(coro)
+    async def wrapper(*args, **kwargs):
+        with bot.metrics.histogram(
+            name, "Background loop iteration duration", LOOP_BUCKETS, cog=cog_name, loop=loop_name
+        ).time():
+            return await coro(*args, **kwargs)
+    wrapper.__timed__ = True
+    return wrapper
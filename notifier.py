@@ -0,0 +1,204 @@
+import asyncio
+import sys
+import time
+import traceback
+from collections import OrderedDict
+
+import discord
+
+# Discord refuses longer messages
+MAX_MESSAGE = 2000
+
+
+class Notifier:
+    """
+    Sends DMs and log channel messages in the background, shared as `bot.notifier`, so crediting loops and
+    commands never wait on Discord. Messages queued for the same user or channel are coalesced into one
+    message, a target answering 429 is paused for its `retry_after` and failed messages are persisted in
+    `nft_notify_retry` and queued again later by `Utils.retry_notifications`.
+    """
+
+    def __init__(self, bot, workers: int = 4, maxsize: int = 10000, max_attempts: int = 5):
+        self.bot = bot
+        self.workers = workers
+        self.maxsize = maxsize
+        self.max_attempts = max_attempts
+        self.pending = OrderedDict()  # ("DM", user_id) or ("CHANNEL", channel_id) => [(content, attempts)]
+        self.queued = 0
+        self.busy = set()  # targets a worker is sending to, keeps their messages in order
+        self.paused = {}  # target => time.monotonic() it may be sent to again
+        self.tasks = []
+        self.persist_tasks = set()
+        # created on first use, the bot runs on a different event loop than the one loading the cogs
+        self.event = None
+        self.sent = 0
+        self.coalesced = 0
+        self.failed = 0
+        self.dropped = 0
+        self.persisted = 0
+
+    def _event(self):
+        if self.event is None:
+            self.event = asyncio.Event()
+        return self.event
+
+    def start(self) -> None:
+        if self.tasks:
+            return
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def _put(self, key, content: str, attempts: int = 0) -> None:
+        if self.queued >= self.maxsize:
+            # full: straight to the retry table rather than growing without bound
+            task = asyncio.create_task(self._persist([(key, content, attempts)]))
+            self.persist_tasks.add(task)
+            task.add_done_callback(self.persist_tasks.discard)
+            return
+        self.pending.setdefault(key, []).append((content, attempts))
+        self.queued += 1
+        self._event().set()
+
+    def dm(self, user_id, content: str, attempts: int = 0) -> None:
+        self._put(("DM", str(user_id)), content, attempts)
+
+    def channel(self, channel_id, content: str, attempts: int = 0) -> None:
+        self._put(("CHANNEL", str(channel_id)), content, attempts)
+
+    def _take(self):
+        """ Next target with messages that no worker is sending to and isn't paused, and its messages. """
+        now = time.monotonic()
+        for key in self.pending:
+            if key in self.busy or self.paused.get(key, 0) > now:
+                continue
+            messages = self.pending.pop(key)
+            self.queued -= len(messages)
+            self.paused.pop(key, None)
+            return key, messages
+        return None, None
+
+    async def _worker(self):
+        while True:
+            key, messages = self._take()
+            if key is None:
+                self._event().clear()
+                try:
+                    # paused targets are looked at again after a second even without new messages
+                    await asyncio.wait_for(self._event().wait(), 1.0)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self.busy.add(key)
+            try:
+                await self._deliver(key, messages)
+            except asyncio.CancelledError:
+                self._requeue(key, messages)
+                raise
+            except Exception:
+                traceback.print_exc(file=sys.stdout)
+            finally:
+                self.busy.discard(key)
+
+    def _requeue(self, key, messages) -> None:
+        # back in front of anything queued meanwhile
+        self.pending[key] = messages + self.pending.get(key, [])
+        self.pending.move_to_end(key, last=False)
+        self.queued += len(messages)
+
+    async def _target(self, key):
+        target_type, target_id = key
+        if target_type == "DM":
+            return self.bot.get_user(int(target_id)) or await self.bot.fetch_user(int(target_id))
+        channel = self.bot.get_channel(int(target_id))
+        if channel is None:
+            print(f"Bot can't find channel {target_id} for logging. Check for the backup channel.")
+            channel = self.bot.get_channel(self.bot.config['discord']['log_channel_backup'])
+        return channel
+
+    async def _deliver(self, key, messages):
+        # coalesced into as few messages as Discord allows, a failure keeps the unsent ones
+        batches = []
+        for content, attempts in messages:
+            if batches and len(batches[-1][0]) + 1 + len(content) <= MAX_MESSAGE:
+                batches[-1][0] += "\n" + content
+                batches[-1][1].append((content, attempts))
+                self.coalesced += 1
+            else:
+                batches.append([content[:MAX_MESSAGE], [(content, attempts)]])
+        try:
+            target = await self._target(key)
+        except (discord.NotFound, ValueError):
+            target = None
+        except discord.HTTPException as e:
+            # fetch_user failed (429, 5xx...), the user may well exist
+            await self._failed(key, e, messages)
+            return
+        if target is None:
+            self.dropped += len(messages)
+            return
+        for i, (content, originals) in enumerate(batches):
+            try:
+                await target.send(content)
+                self.sent += 1
+            except discord.Forbidden:
+                # DMs closed or no permission, retrying won't help
+                self.dropped += len(originals)
+            except discord.HTTPException as e:
+                await self._failed(key, e, [each for batch in batches[i:] for each in batch[1]])
+                return
+
+    async def _failed(self, key, e: discord.HTTPException, unsent) -> None:
+        # 429: paused for its retry_after and queued again, anything else goes to the retry table
+        if e.status == 429:
+            retry_after = float(e.response.headers.get('Retry-After', 5)) if e.response is not None else 5.0
+            self.paused[key] = time.monotonic() + retry_after
+            self._requeue(key, unsent)
+            self._event().set()
+        else:
+            self.failed += 1
+            await self._persist([(key, content, attempts + 1) for content, attempts in unsent])
+
+    async def _persist(self, items):
+        rows = []
+        now = int(time.time())
+        for (target_type, target_id), content, attempts in items:
+            if attempts >= self.max_attempts:
+                self.dropped += 1
+                continue
+            rows.append((target_type, target_id, content, attempts, now + 60 * 2 ** attempts, now))
+        if len(rows) == 0:
+            return
+        utils = self.bot.get_cog('Utils')
+        if utils is not None and await utils.insert_notify_retry(rows):
+            self.persisted += len(rows)
+        else:
+            self.dropped += len(rows)
+
+    def requeue_retries(self, rows) -> None:
+        """ Rows taken from `nft_notify_retry` back into the queue. """
+        for each in rows:
+            self._put((each['target_type'], each['target_id']), each['content'], each['attempts'])
+
+    async def close(self):
+        """ Stop the workers and keep whatever wasn't sent in `nft_notify_retry`. """
+        for task in self.tasks:
+            task.cancel()
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        items = [(key, content, attempts) for key, messages in self.pending.items() for content, attempts in messages]
+        self.pending.clear()
+        self.queued = 0
+        if items:
+            await self._persist(items)
+
+    def stats(self):
+        return {
+            "queued": self.queued,
+            "targets": len(self.pending),
+            "paused": sum(1 for until in self.paused.values() if until > time.monotonic()),
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "persisted": self.persisted
+        }
@@ -0,0 +1,77 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def _label(code) -> str:
+    filename = code.co_filename
+    if filename.startswith(ROOT):
+        filename = os.path.relpath(filename, ROOT)
+    else:
+        filename = os.path.basename(filename)
+    return "{}:{}".format(filename, code.co_name)
+
+
+class SamplingProfiler:
+    """
+    Samples the event loop thread's stack from another thread every `interval` seconds for the owner
+    `profile` command, shared as `bot.profiler`. Costs one stack walk per sample and nothing when not
+    running. The result is in the collapsed stack format (`root;...;leaf count`) flamegraph tools read.
+    """
+
+    def __init__(self):
+        self.running = False
+        self.profiles = 0
+
+    def _sample(self, thread_id: int, interval: float, until: float, filename: str, stacks: Counter, totals: list):
+        while time.monotonic() < until:
+            time.sleep(interval)
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                continue
+            totals[0] += 1
+            codes = []
+            while frame is not None:
+                codes.append(frame.f_code)
+                frame = frame.f_back
+            if filename is not None and not any(code.co_filename == filename for code in codes):
+                continue
+            stacks[";".join(_label(code) for code in reversed(codes))] += 1
+
+    async def run(self, seconds: float, interval: float = 0.005, filename: str = None):
+        """
+        Sample for `seconds`, only the stacks going through `filename` (a cog's module) when given.
+        Returns (collapsed stacks, samples taken, samples kept). Raises RuntimeError if one already runs.
+        """
+        if self.running:
+            raise RuntimeError("a profile is already running")
+        self.running = True
+        try:
+            stacks = Counter()
+            totals = [0]
+            thread = threading.Thread(
+                target=self._sample, name="profiler", daemon=True,
+                args=(threading.get_ident(), interval, time.monotonic() + seconds, filename, stacks, totals)
+            )
+            thread.start()
+            while thread.is_alive():
+                await asyncio.sleep(0.5)
+            self.profiles += 1
+            collapsed = "\n".join("{} {}".format(stack, count) for stack, count in stacks.most_common())
+            return collapsed, totals[0], sum(stacks.values())
+        finally:
+            self.running = False
+
+    @staticmethod
+    def top(collapsed: str, limit: int = 5):
+        """ [(leaf frame, samples)] of the most sampled leaves, where the time went. """
+        leaves = Counter()
+        for line in collapsed.splitlines():
+            stack, count = line.rsplit(" ", 1)
+            leaves[stack.rsplit(";", 1)[-1]] += int(count)
+        return leaves.most_common(limit)
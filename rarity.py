@@ -0,0 +1,444 @@
+import json
+import re
+from decimal import Decimal
+
+import numpy as np
+
+
+# Port of the rarity-analyzer compute script (https://github.com/middlerange/rarity-analyzer) for /metagen.
+# It has to give the same scores and ranks as the JS script, so it follows its quirks: object keys are
+# JS strings (integer-like keys come first), scores are rounded with Math.round and summed in the same order.
+
+# longest trait type / value (in bytes) `nft_rarity_trait_counts` can hold
+MAX_TRAIT_BYTES = 1024
+
+_ARRAY_INDEX = re.compile(r"^(0|[1-9][0-9]*)$")
+
+
+def _is_array_index(key: str) -> bool:
+    return key[:1].isdigit() and _ARRAY_INDEX.match(key) is not None and int(key) < 2 ** 32 - 1
+
+
+def _js_key_order(keys):
+    """ Order of Object.keys(): array indexes ascending, then the other keys in insertion order. """
+    indexes = sorted((k for k in keys if _is_array_index(k)), key=int)
+    if not indexes:
+        return list(keys)
+    return indexes + [k for k in keys if not _is_array_index(k)]
+
+
+def _js_number_str(value: float) -> str:
+    if value != value:
+        return "NaN"
+    if value in (float("inf"), float("-inf")):
+        return "Infinity" if value > 0 else "-Infinity"
+    if value == 0:
+        return "0"
+    sign, digits, exponent = Decimal(repr(float(value))).normalize().as_tuple()
+    digits = "".join(map(str, digits))
+    k = len(digits)
+    n = k + exponent
+    if k <= n <= 21:
+        text = digits + "0" * (n - k)
+    elif 0 < n <= 21:
+        text = digits[:n] + "." + digits[n:]
+    elif -6 < n <= 0:
+        text = "0." + "0" * (-n) + digits
+    else:
+        e = n - 1
+        text = digits[0] + ("." + digits[1:] if k > 1 else "") + "e" + ("+" if e >= 0 else "-") + str(abs(e))
+    return ("-" if sign else "") + text
+
+
+def _js_str(value) -> str:
+    """ String(value) for a value coming out of JSON.parse, which is what a JS property key becomes. """
+    if isinstance(value, str):
+        return value
+    if value is True:
+        return "true"
+    if value is False:
+        return "false"
+    if value is None:
+        return "null"
+    if isinstance(value, int) and abs(value) <= 2 ** 53:
+        return str(value)
+    if isinstance(value, (int, float)):
+        return _js_number_str(float(value))
+    if isinstance(value, list):
+        return ",".join("" if each is None else _js_str(each) for each in value)
+    return "[object Object]"
+
+
+def _js_truthy(value) -> bool:
+    if type(value) is str:
+        return value != ""
+    if isinstance(value, (list, dict)):
+        return True
+    if isinstance(value, float) and value != value:
+        return False
+    return bool(value)
+
+
+def _js_number(value: float):
+    """ A float as JSON.stringify then json.loads would give it back: integral values as int, Infinity as None. """
+    value = float(value)
+    if value != value or value in (float("inf"), float("-inf")):
+        return None
+    if value == int(value) and abs(value) < 2 ** 53:
+        return int(value)
+    return value
+
+
+def _js_value(value):
+    """ A JSON value as it comes back after going through JS: numbers are doubles. """
+    if type(value) is str or isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, (int, float)):
+        return _js_number(value)
+    if isinstance(value, list):
+        return [_js_value(each) for each in value]
+    if isinstance(value, dict):
+        return {k: _js_value(v) for k, v in _js_object(value).items()}
+    return value
+
+
+def _js_object(obj: dict) -> dict:
+    keys = list(obj.keys())
+    if not any(k[:1].isdigit() for k in keys):
+        return obj
+    ordered = _js_key_order(keys)
+    if ordered == keys:
+        return obj
+    return {k: obj[k] for k in ordered}
+
+
+def rarity_scores(count, total: int):
+    """ getRarityScore(): Math.round((1 / (count / total)) * 1e4) / 1e4, vectorised. """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x = (1.0 / (np.asarray(count, dtype=np.float64) / float(total))) * 1e4
+        floor = np.floor(x)
+        rounded = np.where(x - floor >= 0.5, floor + 1.0, floor)
+    return rounded / 1e4
+
+
+class RarityCounts:
+    """
+    Trait frequencies of a collection, persisted in `nft_rarity_trait_counts` so new items can be folded in
+    without reading the whole collection's metadata again. Pairs are kept in first seen order, which is
+    also the order of Object.keys() in the JS script.
+    """
+
+    def __init__(self):
+        self.total = 0  # items, with or without attributes
+        self.pair_codes = {}  # (trait key, value key) => code
+        self.pair_keys = []
+        self.pair_count = []
+        self.type_codes = {}  # trait key => code, in first seen order
+        self.value_order = {}  # trait key => value keys in first seen order
+
+    @classmethod
+    def load(cls, total: int, rows):
+        """ `rows` are (trait_type, trait_value, count) in their saved order. """
+        counts = cls()
+        counts.total = total
+        for trait_key, value_key, count in rows:
+            code = counts.code(trait_key, value_key)
+            counts.pair_count[code] = count
+        return counts
+
+    def code(self, trait_key: str, value_key: str) -> int:
+        pair = (trait_key, value_key)
+        code = self.pair_codes.get(pair)
+        if code is None:
+            if trait_key not in self.type_codes:
+                self.type_codes[trait_key] = len(self.type_codes)
+                self.value_order[trait_key] = []
+            code = self.pair_codes[pair] = len(self.pair_keys)
+            self.pair_keys.append(pair)
+            self.pair_count.append(0)
+            self.value_order[trait_key].append(value_key)
+        return code
+
+    def rows(self, codes=None):
+        """ (trait_type, trait_value, count) to save, all of them or the given codes in order. """
+        if codes is None:
+            codes = range(len(self.pair_keys))
+        return [self.pair_keys[c] + (self.pair_count[c],) for c in sorted(codes)]
+
+
+def _parse_items(items):
+    collection = []
+    for item_id, asset_id_hex, meta in items:
+        if meta is None:
+            continue
+        data_json = json.loads(meta)
+        if "nft_item_list_id" not in data_json:
+            data_json["nft_item_list_id"] = item_id
+        if "token_id" not in data_json:
+            data_json["token_id"] = int(asset_id_hex, 16)
+        collection.append(data_json)
+    return collection
+
+
+def _token_traits(counts: RarityCounts, attributes, fold: bool):
+    """ Codes of the traits of one item and the trait types it has, counting them when `fold`. """
+    codes = []
+    present = set()
+    for attribute in attributes:
+        trait_type = attribute.get("trait_type")
+        if not _js_truthy(trait_type):
+            continue
+        # a missing value is `undefined` in JS, an explicit JSON null "null"
+        value = _js_str(attribute["value"]) if "value" in attribute else "undefined"
+        code = counts.code(_js_str(trait_type), value)
+        if fold:
+            counts.pair_count[code] += 1
+        codes.append(code)
+        if isinstance(trait_type, str):
+            present.add(trait_type)
+    return codes, present
+
+
+def _rank(counts: RarityCounts, tokens):
+    """
+    Score and rank `tokens`, (key, nft_item_list_id, name, attributes, codes, present) in collection order,
+    and return the summary and the `nft_rarity_items` values.
+    """
+    total = counts.total
+    pair_keys = counts.pair_keys
+    type_codes = counts.type_codes
+    pair_count = np.array(counts.pair_count, dtype=np.int64)
+    type_of_pair = np.array([type_codes[t] for t, _ in pair_keys], dtype=np.int64)
+    type_count = np.bincount(type_of_pair, weights=pair_count, minlength=len(type_codes)).astype(np.int64) \
+        if len(pair_keys) else np.zeros(len(type_codes), dtype=np.int64)
+    pair_score = rarity_scores(pair_count, total)
+    type_score = rarity_scores(type_count, total)
+    missing_score = rarity_scores(total - type_count, total)
+
+    trait_count_of = {}  # number of traits => tokens
+    for _, _, _, _, codes, _ in tokens:
+        trait_count_of[len(codes)] = trait_count_of.get(len(codes), 0) + 1
+
+    # attribute scores summed left to right like Array.reduce, one column per attribute position
+    n_tokens = len(tokens)
+    flat_codes = np.fromiter((c for _, _, _, _, codes, _ in tokens for c in codes), dtype=np.int64)
+    n_traits = np.fromiter((len(codes) for _, _, _, _, codes, _ in tokens), dtype=np.int64, count=n_tokens)
+    width = int(n_traits.max()) if n_tokens else 0
+    starts = np.cumsum(n_traits) - n_traits
+    token_rows = np.repeat(np.arange(n_tokens), n_traits)
+    attr_matrix = np.zeros((n_tokens, width), dtype=np.float64)
+    attr_matrix[token_rows, np.arange(len(flat_codes)) - starts[token_rows]] = pair_score[flat_codes]
+    attr_sum = np.zeros(n_tokens, dtype=np.float64)
+    for col in range(width):
+        attr_sum = attr_sum + attr_matrix[:, col]
+
+    # missing traits in Object.keys(traits) order
+    trait_keys = _js_key_order(list(type_codes.keys()))
+    key_column = {k: i for i, k in enumerate(trait_keys)}
+    present_rows = []
+    present_cols = []
+    for row, (_, _, _, _, _, present) in enumerate(tokens):
+        for trait_type in present:
+            col = key_column.get(trait_type)
+            if col is not None:
+                present_rows.append(row)
+                present_cols.append(col)
+    missing_mask = np.ones((n_tokens, len(trait_keys)), dtype=bool)
+    missing_mask[present_rows, present_cols] = False
+    missing_sum = np.zeros(n_tokens, dtype=np.float64)
+    for col, trait_key in enumerate(trait_keys):
+        missing_sum = missing_sum + np.where(missing_mask[:, col], missing_score[type_codes[trait_key]], 0.0)
+
+    trait_count_keys = sorted(trait_count_of.keys())
+    trait_count_score = rarity_scores([trait_count_of[k] for k in trait_count_keys], total)
+    trait_count_score_of = dict(zip(trait_count_keys, trait_count_score.tolist()))
+    count_score = np.array([trait_count_score_of[n] for n in n_traits.tolist()], dtype=np.float64)
+    scores = (attr_sum + missing_sum) + count_score
+
+    # rarity[token.id]: a later token with the same id replaces the earlier one but keeps its key position
+    entry_of = {}
+    for row, token in enumerate(tokens):
+        entry_of[token[0]] = row
+    ranked = _js_key_order(list(entry_of.keys()))
+    ranked_rows = np.array([entry_of[k] for k in ranked], dtype=np.int64)
+    order = np.argsort(-scores[ranked_rows], kind="stable")
+    rank_of = {}
+    for position, i in enumerate(order):
+        rank_of[ranked[i]] = position + 1
+
+    # values shared by many items are converted and serialised once
+    pair_percentile_js = [_js_number(c / total) for c in pair_count.tolist()]
+    pair_score_js = [_js_number(x) for x in pair_score.tolist()]
+    missing_json = [
+        json.dumps({
+            "trait_type": k,
+            "count": int(type_count[type_codes[k]]),
+            "rarity_score": _js_number(missing_score[type_codes[k]]),
+            "percentile": _js_number(type_count[type_codes[k]] / total)
+        }) for k in trait_keys
+    ]
+    trait_count_json = {
+        n: json.dumps({
+            "count": n,
+            "rarity_score": _js_number(trait_count_score_of[n]),
+            "percentile": _js_number(trait_count_of[n] / total)
+        }) for n in trait_count_keys
+    }
+    missing_rows = missing_mask.tolist()
+    n_traits_list = n_traits.tolist()
+    scores_list = scores.tolist()
+
+    rows = []
+    for key in ranked:
+        if not _is_array_index(key):
+            # not an array index, JSON.stringify(rarity) leaves it out
+            continue
+        row = entry_of[key]
+        _, nft_item_list_id, name, attributes, codes, _ = tokens[row]
+        attributes_with_rarity = []
+        i = 0
+        for attribute in attributes:
+            if not _js_truthy(attribute.get("trait_type")):
+                continue
+            code = codes[i]
+            i += 1
+            each = {k: _js_value(v) for k, v in attribute.items()}
+            each["percentile"] = pair_percentile_js[code]
+            each["rarity_score"] = pair_score_js[code]
+            attributes_with_rarity.append(_js_object(each))
+        missing_traits = "[" + ", ".join(
+            missing_json[col] for col, missing in enumerate(missing_rows[row]) if missing
+        ) + "]"
+        n = n_traits_list[row]
+        rows.append((
+            nft_item_list_id, name,
+            json.dumps(attributes_with_rarity), missing_traits, trait_count_json[n],
+            n, _js_number(scores_list[row]), rank_of[key]
+        ))
+
+    traits = {}
+    for trait_key in trait_keys:
+        traits[trait_key] = {}
+        for value_key in _js_key_order(counts.value_order[trait_key]):
+            code = counts.pair_codes[(trait_key, value_key)]
+            traits[trait_key][value_key] = {
+                "count": int(pair_count[code]),
+                "rarity_score": pair_score_js[code],
+                "percentile": pair_percentile_js[code]
+            }
+    summary = {
+        "traits": traits,
+        "traitTypes": {
+            k: {
+                "count": int(type_count[type_codes[k]]),
+                "rarity_score": _js_number(type_score[type_codes[k]]),
+                "percentile": _js_number(type_count[type_codes[k]] / total)
+            } for k in trait_keys
+        },
+        "traitCount": {str(k): trait_count_of[k] for k in trait_count_keys},
+        "meta": {"totalCount": total}
+    }
+    return json.dumps(summary), rows
+
+
+def compute_rarity(items):
+    """
+    Rarity of a whole collection. `items` are (item_id, asset_id_hex, meta) of `nft_item_list` rows in
+    `item_id` order. Runs in a worker process. Returns the summary stored in `nft_rarity`, the
+    `nft_rarity_items` values as (nft_item_list_id, name, attributes_dump, missing_traits_dump,
+    trait_count_dump, trait_count, rarity_score, rank), the `RarityCounts` and whether later runs
+    can fold new items into it.
+    """
+    collection = _parse_items(items)
+    counts = RarityCounts()
+    counts.total = len(collection)
+    tokens = []
+    incremental = True
+    for index, token in enumerate(collection):
+        if _js_truthy(token.get("id")):
+            incremental = False
+        else:
+            token["id"] = index
+        attributes = token.get("attributes")
+        if not _js_truthy(attributes) or not isinstance(attributes, list):
+            continue
+        codes, present = _token_traits(counts, attributes, True)
+        tokens.append((
+            _js_str(token["id"]), token.get("nft_item_list_id"), token.get("name"), attributes, codes, present
+        ))
+    item_ids = [item_id for item_id, _, meta in items if meta is not None]
+    if any(token["nft_item_list_id"] != item_id for token, item_id in zip(collection, item_ids)):
+        incremental = False
+    if any(len(t.encode()) > MAX_TRAIT_BYTES or len(v.encode()) > MAX_TRAIT_BYTES for t, v in counts.pair_keys):
+        incremental = False
+    summary, rows = _rank(counts, tokens)
+    return summary, rows, counts, incremental
+
+
+def rarity_cursor(items, last_item_id: int = 0) -> int:
+    """
+    `nft_rarity`.`last_item_id` after ranking `items` (in `item_id` order) from `last_item_id`: the last item
+    before the first one without meta, which is skipped until its meta is filled in and must be fetched again.
+    """
+    for item_id, _, meta in items:
+        if meta is None:
+            break
+        last_item_id = item_id
+    return last_item_id
+
+
+def update_rarity(total: int, count_rows, stored_rows, new_items):
+    """
+    Fold `new_items` into a collection computed before. `count_rows` are its saved `nft_rarity_trait_counts`
+    and `stored_rows` its `nft_rarity_items` as (rarity_item_id, nft_item_list_id, name, attributes_dump,
+    missing_traits_dump, trait_count_dump, rank) in `nft_item_list_id` order. Runs in a worker process.
+    Items already stored (fetched again behind one without meta) are skipped. Returns None if the new items
+    need a full recompute (one below a stored item got its meta), else the summary, the new item total, the
+    changed count rows, the `nft_rarity_items` to update (with `rarity_item_id` last) and the new ones to insert.
+    """
+    counts = RarityCounts.load(total, count_rows)
+    tokens = []
+    for rarity_item_id, nft_item_list_id, name, attributes_dump, _, _, _ in stored_rows:
+        # the dump keeps every attribute with a trait type in its original order, that's all the scoring needs
+        attributes = json.loads(attributes_dump)
+        codes, present = _token_traits(counts, attributes, False)
+        tokens.append((str(len(tokens)), nft_item_list_id, name, attributes, codes, present))
+
+    changed = set()
+    new_ids = set()
+    collection = _parse_items(new_items)
+    item_ids = [item_id for item_id, _, meta in new_items if meta is not None]
+    stored_ids = set(each[1] for each in stored_rows)
+    last_stored_id = max(stored_ids) if stored_ids else 0
+    for token, item_id in zip(collection, item_ids):
+        if item_id in stored_ids:
+            continue
+        # ranked in item order, one that goes before stored items needs a full recompute
+        if _js_truthy(token.get("id")) or token["nft_item_list_id"] != item_id or item_id < last_stored_id:
+            return None
+        counts.total += 1
+        attributes = token.get("attributes")
+        if not _js_truthy(attributes) or not isinstance(attributes, list):
+            continue
+        codes, present = _token_traits(counts, attributes, True)
+        for code in codes:
+            t, v = counts.pair_keys[code]
+            if len(t.encode()) > MAX_TRAIT_BYTES or len(v.encode()) > MAX_TRAIT_BYTES:
+                return None
+        changed.update(codes)
+        new_ids.add(item_id)
+        tokens.append((str(len(tokens)), item_id, token.get("name"), attributes, codes, present))
+
+    summary, rows = _rank(counts, tokens)
+    stored = {each[1]: each for each in stored_rows}
+    updates = []
+    inserts = []
+    for row in rows:
+        nft_item_list_id = row[0]
+        if nft_item_list_id in new_ids:
+            inserts.append(row)
+            continue
+        old = stored[nft_item_list_id]
+        if (old[3], old[4], old[5], old[6]) != (row[2], row[3], row[4], row[7]):
+            updates.append(row[2:] + (old[0],))
+    return summary, counts.total, counts.rows(changed), updates, inserts
@@ -0,0 +1,188 @@
+import asyncio
+import itertools
+import json
+import random
+import sys
+import traceback
+from collections import defaultdict
+
+import aiohttp
+
+from metrics import Histogram
+
+
+class RPCError(Exception):
+    """ The endpoint answered with a JSON-RPC error, or couldn't be reached after all retries. """
+
+    def __init__(self, message: str, code: int = None):
+        super().__init__(message)
+        self.code = code
+
+
+# worth another try, anything else is returned to the caller
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+def _http_error(label: str, status: int, body: str) -> RPCError:
+    """ RPCError of a non-retried HTTP error, with the JSON-RPC error in its body when there is one. """
+    try:
+        error = json.loads(body).get('error')
+    except (ValueError, AttributeError):
+        error = None
+    if isinstance(error, dict):
+        return RPCError(error.get('message', ''), error.get('code'))
+    return RPCError(f"{label} HTTP {status}: {body[:200]}")
+
+
+class RPCClient:
+    """
+    JSON-RPC client for one endpoint. Keeps one keep-alive aiohttp session, limits how many requests are
+    in flight, retries transport errors with exponential backoff and records latency per method.
+    """
+
+    def __init__(
+        self, url: str, max_concurrency: int = 8, retries: int = 3, backoff: float = 0.5,
+        timeout: float = 16.0, max_batch: int = 100
+    ):
+        self.url = url
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.max_batch = max_batch
+        self.session = None
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.ids = itertools.count(1)
+        self.latency = defaultdict(Histogram)  # method, "batch" for batches => Histogram
+        self.in_flight = 0
+        self.requests = 0
+        self.retried = 0
+        self.errors = 0
+
+    def _session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(
+                connector=connector, headers={'Content-Type': 'application/json'}
+            )
+        return self.session
+
+    async def _post(self, payload, label: str, timeout: float = None, retries: int = None):
+        timeout = timeout or self.timeout
+        retries = self.retries if retries is None else retries
+        attempt = 0
+        while True:
+            try:
+                async with self.semaphore:
+                    self.requests += 1
+                    self.in_flight += 1
+                    try:
+                        with self.latency[label].time():
+                            async with self._session().post(self.url, json=payload, timeout=timeout) as response:
+                                if response.status in RETRY_STATUS:
+                                    raise aiohttp.ClientResponseError(
+                                        response.request_info, response.history, status=response.status
+                                    )
+                                if response.status >= 400:
+                                    self.errors += 1
+                                    raise _http_error(label, response.status, await response.text())
+                                return await response.json(content_type=None)
+                    finally:
+                        self.in_flight -= 1
+            # ValueError: an HTML or empty body from a proxy in front of the node
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                attempt += 1
+                if attempt > retries:
+                    self.errors += 1
+                    raise RPCError(f"{label} failed after {retries} retries: {type(e).__name__} {e}")
+                self.retried += 1
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1) * (0.5 + random.random()))
+
+    async def call(self, method: str, params=None, timeout: float = None, retries: int = None):
+        """
+        Result of one call, raises RPCError on a JSON-RPC error. `retries` 0 for calls that must not be
+        sent twice, a failed request then raises RPCError without a code.
+        """
+        payload = {"jsonrpc": "2.0", "method": method, "params": params or [], "id": next(self.ids)}
+        decoded_data = await self._post(payload, method, timeout, retries)
+        if 'error' in decoded_data:
+            self.errors += 1
+            raise RPCError(decoded_data['error'].get('message', ''), decoded_data['error'].get('code'))
+        return decoded_data.get('result')
+
+    async def batch(self, calls, timeout: float = None):
+        """
+        Results of [(method, params), ...] in the same order, sent as JSON-RPC batches of `max_batch`.
+        A call answered with an error gives None, a failed request raises RPCError.
+        """
+        results = []
+        for i in range(0, len(calls), self.max_batch):
+            payload = [
+                {"jsonrpc": "2.0", "method": method, "params": params or [], "id": next(self.ids)}
+                for method, params in calls[i:i + self.max_batch]
+            ]
+            decoded_data = await self._post(payload, "batch", timeout)
+            if not isinstance(decoded_data, list):
+                # some endpoints answer a whole batch with one error object
+                self.errors += 1
+                raise RPCError(str(decoded_data.get('error') if isinstance(decoded_data, dict) else decoded_data))
+            by_id = {each.get('id'): each for each in decoded_data}
+            for each in payload:
+                answer = by_id.get(each['id'])
+                if answer is None or 'error' in answer:
+                    self.errors += 1
+                    results.append(None)
+                else:
+                    results.append(answer.get('result'))
+        return results
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    def stats(self):
+        return {
+            "url": self.url,
+            "requests": self.requests,
+            "retried": self.retried,
+            "errors": self.errors,
+            "in_flight": self.in_flight,
+            "methods": {method: histogram.snapshot() for method, histogram in self.latency.items()}
+        }
+
+
+class RPCPool:
+    """ One `RPCClient` per endpoint URL, shared by every cog as `bot.rpc` and closed on shutdown. """
+
+    def __init__(self, config: dict):
+        self.config = config
+        self.clients = {}
+
+    def get(self, url: str) -> RPCClient:
+        client = self.clients.get(url)
+        if client is None:
+            rpc_config = self.config.get('rpc', {})
+            client = self.clients[url] = RPCClient(
+                url,
+                max_concurrency=rpc_config.get('max_concurrency', 8),
+                retries=rpc_config.get('retries', 3),
+                backoff=rpc_config.get('backoff', 0.5),
+                timeout=rpc_config.get('timeout', 16.0),
+                max_batch=rpc_config.get('max_batch', 100)
+            )
+        return client
+
+    def network(self, network: str) -> RPCClient:
+        """ Client of the `[endpoint]` configured for ETHEREUM, POLYGON... """
+        return self.get(self.config['endpoint'][network.lower()])
+
+    async def close(self):
+        for client in self.clients.values():
+            try:
+                await client.close()
+            except Exception:
+                traceback.print_exc(file=sys.stdout)
+
+    def stats(self):
+        return [client.stats() for client in self.clients.values()]
@@ -0,0 +1,192 @@
+import bisect
+from collections import defaultdict
+
+
+def _trigrams(text: str):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class _SortedKeys:
+    """
+    Sorted (text, key) pairs searched by prefix. Additions are sorted in lazily and removed keys are
+    left behind until there are more stale entries than live ones; callers check hits against the docs.
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.pending = []
+        self.stale = 0
+
+    def add(self, text: str, key) -> None:
+        self.pending.append((text, key))
+
+    def discard(self) -> None:
+        self.stale += 1
+
+    def prefixed(self, prefix: str, rebuild):
+        if self.stale > len(self.entries) // 2 + 64:
+            self.entries = sorted(rebuild())
+            self.pending = []
+            self.stale = 0
+        elif self.pending:
+            self.entries.extend(self.pending)
+            self.entries.sort()
+            self.pending = []
+        i = bisect.bisect_left(self.entries, (prefix,))
+        while i < len(self.entries) and self.entries[i][0].startswith(prefix):
+            yield self.entries[i]
+            i += 1
+
+
+class SearchIndex:
+    """
+    In-memory name index for slash-command autocomplete.
+    Names are matched case-insensitively and ranked: prefix, word prefix, then substring.
+    Prefixes come from sorted lists and substrings from a trigram index, and each tier stops as soon
+    as `limit` names are found, so a keystroke never scans every name.
+    """
+
+    def __init__(self):
+        self.docs = {}  # key => (name, lowered name, group, payload)
+        self.groups = defaultdict(set)  # group => keys
+        self.grams = defaultdict(set)  # trigram => keys
+        self.names = _SortedKeys()
+        self.words = _SortedKeys()
+
+    def __len__(self):
+        return len(self.docs)
+
+    def __contains__(self, key):
+        return key in self.docs
+
+    def add(self, key, name: str, group=None, payload=None) -> None:
+        if name is None:
+            return
+        lowered = name.lower()
+        existing = self.docs.get(key)
+        if existing is not None:
+            if existing[1] == lowered and existing[2] == group:
+                self.docs[key] = (name, lowered, group, payload)
+                return
+            self.remove(key)
+        self.docs[key] = (name, lowered, group, payload)
+        self.groups[group].add(key)
+        for gram in _trigrams(lowered):
+            self.grams[gram].add(key)
+        self.names.add(lowered, key)
+        for word in set(lowered.split()[1:]):
+            self.words.add(word, key)
+
+    def remove(self, key) -> None:
+        existing = self.docs.pop(key, None)
+        if existing is None:
+            return
+        _, lowered, group, _ = existing
+        self.groups[group].discard(key)
+        if not self.groups[group]:
+            del self.groups[group]
+        for gram in _trigrams(lowered):
+            keys = self.grams.get(gram)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.grams[gram]
+        self.names.discard()
+        for _ in set(lowered.split()[1:]):
+            self.words.discard()
+
+    def remove_group(self, group) -> None:
+        for key in list(self.groups.get(group, ())):
+            self.remove(key)
+
+    def _rebuild_names(self):
+        return [(doc[1], key) for key, doc in self.docs.items()]
+
+    def _rebuild_words(self):
+        return [(word, key) for key, doc in self.docs.items() for word in set(doc[1].split()[1:])]
+
+    def _name_prefix(self, query: str):
+        for lowered, key in self.names.prefixed(query, self._rebuild_names):
+            doc = self.docs.get(key)
+            if doc is not None and doc[1] == lowered:
+                yield key
+
+    def _word_prefix(self, query: str):
+        for _, key in self.words.prefixed(query, self._rebuild_words):
+            doc = self.docs.get(key)
+            if doc is not None and (" " + query) in doc[1]:
+                yield key
+
+    def _substring(self, query: str):
+        postings = [self.grams.get(gram) for gram in _trigrams(query)]
+        if not postings or not all(postings):
+            return
+        for key in min(postings, key=len):
+            if query in self.docs[key][1]:
+                yield key
+
+    def search(self, query: str, limit: int = 25, allowed=None):
+        """
+        Return up to `limit` (key, name, payload) best matching `query`.
+        `allowed` restricts the result to those keys, for example the caller's own assets.
+        """
+        query = (query or "").lower().strip()
+        if allowed is not None and len(allowed) < 256:
+            # small owned lists are cheaper to rank directly
+            ranked = []
+            for key in allowed:
+                doc = self.docs.get(key)
+                if doc is None:
+                    continue
+                lowered = doc[1]
+                if lowered.startswith(query):
+                    rank = 0
+                elif (" " + query) in lowered:
+                    rank = 1
+                elif query in lowered:
+                    rank = 2
+                else:
+                    continue
+                ranked.append((rank, len(lowered), lowered, key))
+            ranked.sort(key=lambda x: x[:3])
+            return [(key, self.docs[key][0], self.docs[key][3]) for _, _, _, key in ranked[:limit]]
+
+        found = {}
+        tiers = [self._name_prefix(query), self._word_prefix(query)]
+        if len(query) >= 3:
+            tiers.append(self._substring(query))
+        for tier in tiers:
+            for key in tier:
+                if key in found or (allowed is not None and key not in allowed):
+                    continue
+                found[key] = True
+                if len(found) >= limit:
+                    break
+            if len(found) >= limit:
+                break
+        return [(key, self.docs[key][0], self.docs[key][3]) for key in found]
+
+
+class AutocompleteIndex:
+    """ Collections, deposited item names and rarity item names, kept in memory as `bot.search_index`. """
+
+    def __init__(self):
+        self.collections = SearchIndex()  # key: contract_id
+        self.items = SearchIndex()  # key: ("ERC721", item_id) or ("ERC1155", vtk_id)
+        self.rarity = SearchIndex()  # key: nft_item_list_id, group: contract_id
+        # (updated_date, primary key) of the last row loaded, to only fetch new and changed rows
+        self.items_cursor = (0, 0)
+        self.erc1155_cursor = (0, 0)
+        # highest primary key already loaded, rarity rows are replaced, never changed
+        self.last_rarity_item_id = 0
+        # collections whose rarity names were dropped because they got disabled
+        self.rarity_hidden = set()
+        # contract_id => `nft_rarity`.`update_date` loaded, a newer one means it was regenerated somewhere else
+        self.rarity_dates = {}
+
+
+def asset_key(asset: dict):
+    """ Key of a `get_list_user_assets` row in `AutocompleteIndex.items`. """
+    if asset.get('vtk_id') is not None:
+        return ("ERC1155", asset['vtk_id'])
+    return ("ERC721", asset['item_id'])
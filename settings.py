@@ -0,0 +1,55 @@
+import json
+
+# bumped with every write to `bot_settings` so other processes know to reload
+VERSION_NAME = "settings_version"
+
+
+class BotSettings:
+    """
+    Decoded `bot_settings`, shared as `bot.settings`, so commands read the gas trackers and `min_gas_move_nft`
+    without any query or `json.loads`. `Utils.get_bot_setting` loads it all, the gas price loops set their
+    tracker after writing it and `Utils.check_settings_version` reloads when another process bumped
+    `settings_version`.
+    """
+
+    def __init__(self):
+        self.min_gas_move_nft: dict = {}  # coin => minimum gas to withdraw an NFT
+        self.eth_gas_tracker: dict = None
+        self.matic_gas_tracker: dict = None
+        self.version: int = 0
+        self.loaded = False
+        self.reloads = 0
+
+    @staticmethod
+    def _decode(value):
+        if not value:
+            return None
+        try:
+            return json.loads(value)
+        except ValueError:
+            return None
+
+    def load(self, rows) -> None:
+        """ Replace everything with `bot_settings` rows (name, value). """
+        values = {each['name']: each['value'] for each in rows}
+        self.min_gas_move_nft = self._decode(values.get('min_gas_move_nft')) or {}
+        self.eth_gas_tracker = self._decode(values.get('eth_gas_tracker'))
+        self.matic_gas_tracker = self._decode(values.get('matic_gas_tracker'))
+        self.version = int(values.get(VERSION_NAME) or 0)
+        self.loaded = True
+        self.reloads += 1
+
+    def set(self, name: str, value, version: int) -> None:
+        """ `value` already decoded, after writing it with `version`. """
+        setattr(self, name, value)
+        self.version = version
+
+    def min_gas(self, coin: str, default: float) -> float:
+        return self.min_gas_move_nft.get(coin, default)
+
+    def stats(self):
+        return {
+            "version": self.version,
+            "loaded": self.loaded,
+            "reloads": self.reloads
+        }
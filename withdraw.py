@@ -0,0 +1,309 @@
+import asyncio
+import sys
+import time
+import traceback
+from collections import namedtuple
+from functools import partial
+
+from eth_account import Account
+from web3 import Web3
+
+from metrics import Histogram
+from rpc import RPCError
+
+
+# what `nft_withdraw` keeps of a signed transaction, raw_tx is rebroadcast if it gets dropped
+SentTx = namedtuple("SentTx", ["tx_hash", "nonce", "raw_tx"])
+
+# what became of an eth_sendRawTransaction
+SENT = "SENT"  # accepted, or the node already had it
+UNKNOWN = "UNKNOWN"  # no answer or a provider error, it may have gone through
+NONCE_USED = "NONCE_USED"  # "nonce too low": mined already, or another tx took the nonce
+REJECTED = "REJECTED"  # refused as invalid (`REJECTIONS`), it will never be mined
+
+CHAIN_IDS = {"ETHEREUM": 1, "POLYGON": 137}
+
+# node errors that mean the transaction itself is invalid, anything else (provider internal error, rate limit,
+# relayed timeout...) may come after it was already propagated
+REJECTIONS = ("underpriced", "insufficient funds", "intrinsic gas too low", "fee cap", "exceeds block gas limit")
+
+
+class NonceManager:
+    """
+    Hands out the hot wallet nonces from `nft_withdraw_nonce`, so every process of the cluster can broadcast
+    withdrawals at once without two of them signing the same nonce. The network's row is locked while the
+    next nonce is taken, which is the node's pending count instead when that is higher.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.next_nonce = {}  # network => next nonce after the last one reserved here
+        self.reserved = 0
+        self.released = 0
+
+    async def reserve(self, network: str, address: str) -> int:
+        chain_nonce = int(await self.bot.rpc.network(network).call("eth_getTransactionCount", [address, "pending"]), 16)
+        nonce = await self.bot.get_cog('Utils').reserve_withdraw_nonce(network, chain_nonce)
+        self.next_nonce[network] = nonce + 1
+        self.reserved += 1
+        return nonce
+
+    async def release(self, network: str, nonce: int) -> None:
+        """ The transaction with `nonce` was rejected by the node, hand the nonce out again if it was the last one. """
+        if await self.bot.get_cog('Utils').release_withdraw_nonce(network, nonce):
+            self.released += 1
+
+    def stats(self):
+        return {
+            "next_nonce": dict(self.next_nonce),
+            "reserved": self.reserved,
+            "released": self.released
+        }
+
+
+class WithdrawEngine:
+    """
+    Builds, signs and broadcasts hot wallet transactions without blocking the event loop, shared as `bot.withdraw`.
+    Calldata is encoded locally from contract objects cached per (contract_type, address), every RPC goes
+    through the pooled `bot.rpc` clients and signing runs in the default thread pool.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        # no provider: only used to encode calldata
+        self.w3 = Web3()
+        self.contracts = {}  # (contract_type, lowered address) => Contract
+        self.nonces = NonceManager(bot)
+        self.sign_latency = Histogram()
+        self.gaps = {}  # network => {nonce: time.time() it was first seen missing}
+        self.nonce_used = {}  # tx_hash => checks it was "nonce too low" with its nonce confirmed and no receipt
+        self.sent = 0
+        self.failed = 0
+        self.rebroadcasted = 0
+        self.gaps_filled = 0
+
+    def contract(self, contract_type: str, address: str):
+        key = (contract_type, address.lower())
+        contract = self.contracts.get(key)
+        if contract is None:
+            abi = self.bot.ERC721_ABI if contract_type == "ERC721" else self.bot.ERC1155_ABI
+            contract = self.contracts[key] = self.w3.eth.contract(address=Web3.toChecksumAddress(address), abi=abi)
+        return contract
+
+    def encode_transfer(
+        self, contract_type: str, contract: str, from_address: str, to_address: str, item_id: int, amount: int = 1
+    ) -> str:
+        from_address = Web3.toChecksumAddress(from_address)
+        to_address = Web3.toChecksumAddress(to_address)
+        if contract_type == "ERC721":
+            return self.contract(contract_type, contract).encodeABI(
+                fn_name="transferFrom", args=[from_address, to_address, item_id]
+            )
+        return self.contract(contract_type, contract).encodeABI(
+            fn_name="safeTransferFrom", args=[from_address, to_address, item_id, amount, b""]
+        )
+
+    async def _sign(self, transaction: dict):
+        with self.sign_latency.time():
+            return await asyncio.get_running_loop().run_in_executor(
+                None, partial(Account.sign_transaction, transaction, self.bot.config['wallet']['eth_key'])
+            )
+
+    async def sign(
+        self, network: str, to_address: str, data: str = None, value: int = 0, chain_id: int = None,
+        nonce: int = None
+    ):
+        """
+        Sign a transaction from the hot wallet with the next nonce, or `nonce`, and return its `SentTx`
+        to be recorded before it is broadcast. Raises RPCError.
+        """
+        rpc = self.bot.rpc.network(network)
+        from_address = Web3.toChecksumAddress(self.bot.config['wallet']['eth_address'])
+        to_address = Web3.toChecksumAddress(to_address)
+        call = {"from": from_address, "to": to_address, "value": hex(value)}
+        if data is not None:
+            call['data'] = data
+        # fees from the oracle's recent samples, eth_gasPrice only when it has none
+        fees = self.bot.gas_oracle.fees(network)
+        if fees is None:
+            gas_price, gas = await asyncio.gather(
+                rpc.call("eth_gasPrice"),
+                rpc.call("eth_estimateGas", [call])
+            )
+            fees = {'gasPrice': int(gas_price, 16)}
+        else:
+            gas = await rpc.call("eth_estimateGas", [call])
+        reserved = nonce is None
+        if reserved:
+            # only reserved once the transaction is known to be valid, so failed estimates don't leave gaps
+            nonce = await self.nonces.reserve(network, from_address)
+        transaction = {
+            'from': from_address,
+            'to': to_address,
+            'value': value,
+            'nonce': nonce,
+            'gas': int(gas, 16),
+            'chainId': chain_id,
+            **fees
+        }
+        if data is not None:
+            transaction['data'] = data
+        try:
+            signed = await self._sign(transaction)
+        except Exception:
+            if reserved:
+                await self.nonces.release(network, nonce)
+            raise
+        return SentTx(signed.hash.hex(), nonce, signed.rawTransaction.hex())
+
+    async def _send_raw(self, network: str, sent_tx: SentTx) -> str:
+        # sent once, never retried: a retry of one that got through only comes back as an error
+        try:
+            await self.bot.rpc.network(network).call("eth_sendRawTransaction", [sent_tx.raw_tx], retries=0)
+            return SENT
+        except RPCError as e:
+            message = str(e).lower()
+            if "already known" in message or "known transaction" in message:
+                return SENT
+            if "nonce too low" in message:
+                return NONCE_USED
+            if e.code is not None and any(rejection in message for rejection in REJECTIONS):
+                print('WITHDRAW: {} {} rejected: {}'.format(network, sent_tx.tx_hash, e))
+                return REJECTED
+            # the receipt and rebroadcast loop settles it
+            print('WITHDRAW: {} {} no clear answer: {}'.format(network, sent_tx.tx_hash, e))
+            return UNKNOWN
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+            return UNKNOWN
+
+    async def broadcast(self, network: str, sent_tx: SentTx) -> str:
+        """
+        Send a transaction from `sign`, already recorded. Returns SENT, UNKNOWN, NONCE_USED or REJECTED;
+        only a REJECTED one will never be mined, its nonce is given back.
+        """
+        status = await self._send_raw(network, sent_tx)
+        if status == REJECTED:
+            self.failed += 1
+            await self.nonces.release(network, sent_tx.nonce)
+        else:
+            self.sent += 1
+        return status
+
+    async def rebroadcast(self, network: str, sent_tx: SentTx) -> str:
+        """ Send a stored transaction again, for one dropped from the mempool. """
+        status = await self._send_raw(network, sent_tx)
+        if status == SENT:
+            self.rebroadcasted += 1
+        return status
+
+    async def sign_transfer_nft(
+        self, network: str, contract_type: str, contract: str, to_address: str, item_id: int, chain_id: int,
+        amount: int = 1
+    ):
+        """ Signed withdraw of an NFT, None if it can't be made (estimate failed: not owned, RPC down...). """
+        try:
+            data = self.encode_transfer(
+                contract_type, contract, self.bot.config['wallet']['eth_address'], to_address, item_id, amount
+            )
+            return await self.sign(network, contract, data=data, chain_id=chain_id)
+        except RPCError as e:
+            print('WITHDRAW: {} {} #{} to {} failed: {}'.format(network, contract, item_id, to_address, e))
+        except Exception as e:
+            traceback.print_exc(file=sys.stdout)
+        self.failed += 1
+        return None
+
+    async def transfer_main_token(self, network: str, to_address: str, atomic_amount: int, chain_id: int):
+        try:
+            sent_tx = await self.sign(network, to_address, value=atomic_amount, chain_id=chain_id)
+            if await self.broadcast(network, sent_tx) != REJECTED:
+                return sent_tx
+            return None
+        except RPCError as e:
+            print('WITHDRAW: {} {} to {} failed: {}'.format(network, atomic_amount, to_address, e))
+        except Exception as e:
+            traceback.print_exc(file=sys.stdout)
+        self.failed += 1
+        return None
+
+    async def nonce_confirmed(self, network: str, nonce: int) -> bool:
+        """
+        Whether the hot wallet's tx with `nonce` was mined `withdraw.cancel_confirmations` blocks ago or more,
+        from its transaction count at that block. Raises RPCError.
+        """
+        rpc = self.bot.rpc.network(network)
+        address = Web3.toChecksumAddress(self.bot.config['wallet']['eth_address'])
+        confirmations = self.bot.config.get('withdraw', {}).get('cancel_confirmations', 12)
+        head = int(await rpc.call("eth_blockNumber"), 16)
+        count = int(await rpc.call("eth_getTransactionCount", [address, hex(max(head - confirmations, 0))]), 16)
+        return count > nonce
+
+    async def nonce_taken(self, network: str, sent_tx: SentTx, mined: bool) -> bool:
+        """
+        For a rebroadcast that was NONCE_USED: whether another tx surely took its nonce, so it will never be
+        mined. `mined` is whether its receipt was found. A lagging node can miss the receipt of the very tx that
+        used the nonce, so it takes its nonce confirmed and no receipt on `withdraw.cancel_after_checks` checks
+        in a row.
+        """
+        if mined or sent_tx.nonce is None:
+            self.nonce_used.pop(sent_tx.tx_hash, None)
+            return False
+        try:
+            if not await self.nonce_confirmed(network, sent_tx.nonce):
+                return False
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+            return False
+        checks = self.nonce_used[sent_tx.tx_hash] = self.nonce_used.get(sent_tx.tx_hash, 0) + 1
+        if checks < self.bot.config.get('withdraw', {}).get('cancel_after_checks', 3):
+            return False
+        del self.nonce_used[sent_tx.tx_hash]
+        return True
+
+    async def fill_nonce_gaps(self, pending_nonces) -> None:
+        """
+        `pending_nonces` is network => nonces of the withdrawals still PENDING. A nonce between the chain's
+        latest count and the highest of them that no PENDING withdraw has (rejected after a later one was
+        reserved, or reserved by a process that stopped before recording it) holds every tx above it in the
+        node's queue. A gap still there after `withdraw.gap_fill_after` seconds gets a 0-value transfer to
+        the hot wallet itself.
+        """
+        withdraw_config = self.bot.config.get('withdraw', {})
+        address = Web3.toChecksumAddress(self.bot.config['wallet']['eth_address'])
+        now = time.time()
+        for network, nonces in pending_nonces.items():
+            if network not in CHAIN_IDS or len(nonces) == 0:
+                continue
+            try:
+                latest = int(await self.bot.rpc.network(network).call(
+                    "eth_getTransactionCount", [address, "latest"]
+                ), 16)
+                gaps = [nonce for nonce in range(latest, max(nonces)) if nonce not in nonces]
+                seen = self.gaps.setdefault(network, {})
+                for nonce in list(seen.keys()):
+                    if nonce not in gaps:
+                        del seen[nonce]
+                for nonce in gaps[:withdraw_config.get('max_pending', 16)]:
+                    # a nonce reserved a moment ago may not be recorded yet
+                    if now - seen.setdefault(nonce, now) < withdraw_config.get('gap_fill_after', 120):
+                        continue
+                    sent_tx = await self.sign(network, address, value=0, chain_id=CHAIN_IDS[network], nonce=nonce)
+                    status = await self._send_raw(network, sent_tx)
+                    print('WITHDRAW: {} filled nonce gap {} with {}: {}'.format(network, nonce, sent_tx.tx_hash, status))
+                    if status == SENT:
+                        self.gaps_filled += 1
+                    seen[nonce] = now
+            except Exception:
+                traceback.print_exc(file=sys.stdout)
+
+    def stats(self):
+        return {
+            "contracts": len(self.contracts),
+            "sent": self.sent,
+            "failed": self.failed,
+            "rebroadcasted": self.rebroadcasted,
+            "gaps_filled": self.gaps_filled,
+            "sign": self.sign_latency.snapshot(),
+            "nonces": self.nonces.stats()
+        }
@@ -0,0 +1,127 @@
+"""
+Runs the heavy jobs queued in `nft_jobs` (Alchemy token and image fetching, /metagen rarity) outside the
+gateway processes, so they don't add latency to the commands: `python3 worker.py`. With `jobs.enable` the
+bot only queues them. Several workers can run, each claims a job with a lease it renews while running; a job
+whose worker died is taken again once its lease expired.
+"""
+import asyncio
+import json
+import os
+import socket
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import discord
+from discord.ext import commands
+
+from cogs.admin import Admin
+from cogs.alchemy_api import AlchemyAPI
+from cogs.utils import Utils
+from config import load_config
+from database import Database
+from metrics import Registry
+from rpc import RPCPool
+from search_index import AutocompleteIndex
+
+# never connects to Discord, it only carries the attributes the cogs use
+bot = commands.Bot(command_prefix=commands.when_mentioned, intents=discord.Intents.none(), help_command=None)
+bot.config = load_config()
+bot.db = Database(bot.config)
+bot.metrics = Registry()
+bot.rpc = RPCPool(bot.config)
+bot.search_index = AutocompleteIndex()
+bot.rarity_pool = ProcessPoolExecutor(max_workers=bot.config['rarity'].get('process_workers', 1))
+
+
+class JobWorker:
+    def __init__(self, bot, worker_id: str):
+        self.bot = bot
+        self.worker_id = worker_id
+        self.utils = Utils(bot)
+        self.alchemy = AlchemyAPI(bot)
+        self.admin = Admin(bot)
+        self.handlers = {
+            "fetch_nft_tokens": self.fetch_nft_tokens,
+            "fetch_image_in_nft": self.fetch_image_in_nft,
+            "metagen": self.metagen
+        }
+
+    @property
+    def config(self):
+        return self.bot.config.get('jobs', {})
+
+    async def fetch_nft_tokens(self, payload: dict, progress):
+        await self.alchemy.sync_nft_tokens()
+        return "fetched"
+
+    async def fetch_image_in_nft(self, payload: dict, progress):
+        await self.alchemy.sync_nft_images()
+        return "fetched"
+
+    async def metagen(self, payload: dict, progress):
+        return await self.admin.generate_rarity(payload['contract_id'], payload.get('full', False), progress)
+
+    async def _heartbeat(self, job_id: int, lease: int):
+        while True:
+            await asyncio.sleep(lease / 3)
+            if not await self.utils.extend_job(job_id, self.worker_id, lease):
+                print("WORKER: lost the lease of job #{}".format(job_id))
+
+    async def run_job(self, job: dict):
+        lease = self.config.get('lease', 60)
+
+        async def progress(status: str):
+            await self.utils.extend_job(job['job_id'], self.worker_id, lease, status[:256])
+
+        heartbeat = asyncio.create_task(self._heartbeat(job['job_id'], lease))
+        started = time.monotonic()
+        try:
+            result = await self.handlers[job['job_type']](json.loads(job['payload'] or "{}"), progress)
+            status = "DONE"
+        except Exception as e:
+            traceback.print_exc(file=sys.stdout)
+            result = "{}: {}".format(type(e).__name__, e)
+            status = "FAILED" if job['attempts'] >= self.config.get('max_attempts', 3) else "QUEUED"
+        finally:
+            heartbeat.cancel()
+        print("WORKER: job #{} {} {} in {:.1f}s".format(job['job_id'], job['job_type'], status, time.monotonic() - started))
+        await self.utils.finish_job(job['job_id'], self.worker_id, status, result)
+
+    async def run(self):
+        poll = self.config.get('poll_interval', 2.0)
+        while True:
+            job = await self.utils.claim_job(list(self.handlers.keys()), self.worker_id, self.config.get('lease', 60))
+            if job is None:
+                await asyncio.sleep(poll)
+                continue
+            await self.run_job(job)
+
+    async def purge(self):
+        while True:
+            purged = await self.utils.purge_jobs(int(time.time()) - self.config.get('keep_days', 7) * 86400)
+            if purged > 0:
+                print("WORKER: purged {} finished jobs".format(purged))
+            await asyncio.sleep(3600)
+
+
+async def main():
+    async with bot:
+        await bot.db.open()
+        worker_id = "{}:{}".format(socket.gethostname(), os.getpid())
+        concurrency = bot.config.get('jobs', {}).get('concurrency', 2)
+        print("WORKER: {} running {} jobs at once".format(worker_id, concurrency))
+        try:
+            await asyncio.gather(
+                JobWorker(bot, worker_id).purge(),
+                *[JobWorker(bot, worker_id).run() for _ in range(concurrency)]
+            )
+        finally:
+            await bot.db.close()
+            await bot.rpc.close()
+            bot.rarity_pool.shutdown(wait=False, cancel_futures=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())